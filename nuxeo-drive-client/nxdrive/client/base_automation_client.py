@@ -2,6 +2,7 @@
 """ Common Nuxeo Automation client utilities. """
 
 import base64
+import errno
 import hashlib
 import json
 import os
@@ -11,6 +12,8 @@ import sys
 import tempfile
 import time
 import urllib2
+from httplib import IncompleteRead
+from threading import Event, Lock, Thread
 from urllib import urlencode
 from urllib2 import ProxyHandler
 from urlparse import urlparse
@@ -25,13 +28,32 @@ from nxdrive.logging_config import get_logger
 from nxdrive.utils import DEVICE_DESCRIPTIONS, TOKEN_PERMISSION, force_decode, \
     guess_digest_algorithm, guess_mime_type
 
-log = None
+log = get_logger(__name__)
 
 CHANGE_SUMMARY_OPERATION = 'NuxeoDrive.GetChangeSummary'
 DEFAULT_NUXEO_TX_TIMEOUT = 300
 
 DOWNLOAD_TMP_FILE_PREFIX = '.'
 DOWNLOAD_TMP_FILE_SUFFIX = '.nxpart'
+# Expected digest and server validator of a partial download, next to it,
+# and the process downloading it
+DOWNLOAD_STATE_SUFFIX = '.state'
+DOWNLOAD_LOCK_SUFFIX = '.lock'
+# Partial downloads not resumed for longer are removed: their document was
+# likely renamed, moved or deleted remotely meanwhile
+DOWNLOAD_PARTIAL_MAX_AGE = 24 * 3600
+# Segmented downloads: smallest segment, most connections for a file, and
+# shortest time a segment must last at the measured speed of a connection
+SEGMENT_MIN_SIZE = 8 * 1024 ** 2
+SEGMENTS_MAX = 8
+SEGMENT_MIN_TIME = 2
+# Weight of the last segment in the measured speed of a connection
+SEGMENT_SPEED_WEIGHT = 0.3
+# Chunked uploads: size of a chunk, and batch of an interrupted upload kept in
+# the upload temporary folder to resume it, even after a restart
+UPLOAD_CHUNK_SIZE = 20 * 1024 ** 2
+UPLOAD_STATE_PREFIX = 'nxdrive_upload_'
+UPLOAD_STATE_SUFFIX = '.json'
 
 # 1s audit time resolution because of the datetime resolution of MYSQL
 AUDIT_CHANGE_FINDER_TIME_RESOLUTION = 1.0
@@ -40,8 +62,122 @@ socket.setdefaulttimeout(DEFAULT_NUXEO_TX_TIMEOUT)
 
 
 class InvalidBatchException(Exception):
-    if log:
-        log.warning("Invalid batch exception")
+    pass
+
+
+def get_download_state_file(file_out):
+    """ Return the file keeping the state of a partial download, hidden and ignored like it. """
+    if file_out.endswith(DOWNLOAD_TMP_FILE_SUFFIX):
+        file_out = file_out[:-len(DOWNLOAD_TMP_FILE_SUFFIX)]
+    return file_out + DOWNLOAD_STATE_SUFFIX + DOWNLOAD_TMP_FILE_SUFFIX
+
+
+def get_download_lock_file(file_out):
+    """ Return the file telling a partial download is in progress, hidden and ignored like it. """
+    if file_out.endswith(DOWNLOAD_TMP_FILE_SUFFIX):
+        file_out = file_out[:-len(DOWNLOAD_TMP_FILE_SUFFIX)]
+    return file_out + DOWNLOAD_LOCK_SUFFIX + DOWNLOAD_TMP_FILE_SUFFIX
+
+
+def remove_partial_download(file_out):
+    """ Remove a partial download, its state and its lock, if any. """
+    for path in (file_out, get_download_state_file(file_out), get_download_lock_file(file_out)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+_download_locks = Lock()
+
+
+def lock_partial_download(file_out):
+    """
+    Take the lock of a partial download, return False if another download
+    to file_out is in progress.  The lock file is created exclusively and
+    holds the process id: the lock of a previous run is taken over.
+    """
+    lock_file = get_download_lock_file(file_out)
+    pid = str(os.getpid())
+    with _download_locks:
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            with open(lock_file) as f:
+                owner = f.read()
+            if owner == pid:
+                return False
+            log.debug('Taking over the download lock %r of process %s', lock_file, owner)
+            fd = os.open(lock_file, os.O_TRUNC | os.O_WRONLY)
+        with os.fdopen(fd, 'w') as f:
+            f.write(pid)
+    return True
+
+
+def unlock_partial_download(file_out):
+    lock_file = get_download_lock_file(file_out)
+    with _download_locks:
+        if os.path.exists(lock_file):
+            os.remove(lock_file)
+
+
+def clean_partial_downloads(folder, max_age=DOWNLOAD_PARTIAL_MAX_AGE):
+    """
+    Remove the partial downloads of folder and their state not modified for
+    max_age seconds, unless in progress, and the locks of the previous runs.
+    Return the count of removed files.
+    """
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return 0
+    pid = str(os.getpid())
+    expiry = time.time() - max_age
+    removed = 0
+    with _download_locks:
+        for name in names:
+            if not (name.startswith(DOWNLOAD_TMP_FILE_PREFIX) and name.endswith(DOWNLOAD_TMP_FILE_SUFFIX)):
+                continue
+            path = os.path.join(folder, name)
+            base = path[:-len(DOWNLOAD_TMP_FILE_SUFFIX)]
+            is_lock = base.endswith(DOWNLOAD_LOCK_SUFFIX)
+            for suffix in (DOWNLOAD_STATE_SUFFIX, DOWNLOAD_LOCK_SUFFIX):
+                if base.endswith(suffix):
+                    base = base[:-len(suffix)]
+            try:
+                with open(get_download_lock_file(base)) as f:
+                    in_progress = f.read() == pid
+            except IOError:
+                in_progress = False
+            try:
+                if not in_progress and (is_lock or os.path.getmtime(path) < expiry):
+                    os.remove(path)
+                    removed += 1
+            except (IOError, OSError):
+                # Removed meanwhile
+                continue
+    if removed:
+        log.debug('Removed %d stale partial download files from %r', removed, folder)
+    return removed
+
+
+def get_segments_count(size, speed=None):
+    """
+    Return the count of parallel connections to download size bytes, one
+    for the small files.  Splitting a file that a single connection gets in
+    a few seconds only adds round trips, speed is the measured one in bytes/s.
+    """
+    count = min(SEGMENTS_MAX, size // SEGMENT_MIN_SIZE)
+    if speed:
+        count = min(count, int(size / (speed * SEGMENT_MIN_TIME)))
+    return max(1, count)
+
+
+def get_chunks_count(size, chunk_size=None):
+    """ Return the count of chunks of a chunked upload of size bytes. """
+    if chunk_size is None:
+        chunk_size = UPLOAD_CHUNK_SIZE
+    return max(1, (size + chunk_size - 1) // chunk_size)
 
 
 def get_proxies_for_handler(proxy_settings):
@@ -163,8 +299,6 @@ class BaseAutomationClient(BaseClient):
                  ignored_prefixes=None, ignored_suffixes=None,
                  timeout=20, blob_timeout=60, cookie_jar=None,
                  upload_tmp_dir=None, check_suspended=None):
-        global log
-        log = get_logger(__name__)
         # Function to check during long-running processing like upload /
         # download if the synchronization thread needs to be suspended
         self.check_suspended = check_suspended
@@ -222,6 +356,9 @@ class BaseAutomationClient(BaseClient):
         if opener_proxies:
             self.is_proxy = True
 
+        # Download speed of a connection, for the segmented downloads
+        self.segment_speed = None
+
         self.automation_url = server_url + 'site/automation/'
         self.batch_upload_url = 'batch/upload'
         self.batch_execute_url = 'batch/execute'
@@ -388,20 +525,30 @@ class BaseAutomationClient(BaseClient):
             return self._read_response(resp, url)
 
     def execute_with_blob_streaming(self, command, file_path, filename=None,
-                                    mime_type=None, **params):
+                                    mime_type=None, chunked=False, connections=1,
+                                    **params):
         """Execute an Automation operation using a batch upload as an input
 
-        Upload is streamed.
+        Upload is streamed.  With chunked, a large file is uploaded in chunks,
+        by connections parallel requests, and an interrupted upload goes on
+        in the same batch with the chunks the server did not get.
         """
         tick = time.time()
         action = FileAction("Upload", file_path, filename)
+        chunked = chunked and os.path.getsize(file_path) > UPLOAD_CHUNK_SIZE
         try:
             batch_id = None
-            if self.is_new_upload_api_available():
+            if chunked and self.is_new_upload_api_available():
+                batch_id = self._get_upload_state(file_path)
+                if batch_id is not None:
+                    log.debug('Resuming the upload of %r in batch %s', file_path, batch_id)
+            if batch_id is None and self.is_new_upload_api_available():
                 try:
                     # Init resumable upload getting a batch id generated by the server
                     # This batch id is to be used as a resumable session id
                     batch_id = self.init_upload()['batchId']
+                    if chunked:
+                        self._set_upload_state(file_path, batch_id)
                 except NewUploadAPINotAvailable:
                     log.debug('New upload API is not available on server %s', self.server_url)
                     self.new_upload_api_available = False
@@ -409,7 +556,8 @@ class BaseAutomationClient(BaseClient):
                 # New upload API is not available, generate a batch id
                 batch_id = self._generate_unique_id()
             upload_result = self.upload(batch_id, file_path, filename=filename,
-                                        mime_type=mime_type)
+                                        mime_type=mime_type, chunked=chunked,
+                                        connections=connections)
             upload_duration = int(time.time() - tick)
             action.transfer_duration = upload_duration
             # Use upload duration * 2 as Nuxeo transaction timeout
@@ -426,11 +574,15 @@ class BaseAutomationClient(BaseClient):
             if upload_result.get('batchId') is not None:
                 result = self.execute_batch(command, batch_id, '0', tx_timeout,
                                           **params)
+                if chunked:
+                    self.remove_upload_state(file_path)
                 return result
             else:
                 raise ValueError("Bad response from batch upload with id '%s'"
                                  " and file path '%s'" % (batch_id, file_path))
         except InvalidBatchException:
+            # The next try starts a new batch
+            self.remove_upload_state(file_path)
             self.cookie_jar.clear_session_cookies()
         finally:
             self.end_action()
@@ -464,11 +616,14 @@ class BaseAutomationClient(BaseClient):
         return self._read_response(resp, url)
 
     def upload(self, batch_id, file_path, filename=None, file_index=0,
-               mime_type=None):
+               mime_type=None, chunked=False, connections=1):
         """Upload a file through an Automation batch
 
         Uses poster.httpstreaming to stream the upload
         and not load the whole file in memory.
+
+        With chunked and the new batch upload API, the file is sent in
+        chunks, skipping the ones the server already has.
         """
         FileAction("Upload", file_path, filename)
         # Request URL
@@ -498,6 +653,8 @@ class BaseAutomationClient(BaseClient):
         if not self.is_new_upload_api_available():
             headers.update({"X-Batch-Id": batch_id, "X-File-Idx": file_index})
         headers.update(self._get_common_headers())
+        if chunked and self.is_new_upload_api_available():
+            return self._upload_chunks(url, headers, batch_id, file_path, file_index, connections)
 
         # Request data
         input_file = open(file_path, 'rb')
@@ -524,6 +681,157 @@ class BaseAutomationClient(BaseClient):
         self.end_action()
         return self._read_response(resp, url)
 
+    def _upload_chunks(self, url, headers, batch_id, file_path, file_index, connections):
+        """
+        Upload the chunks of the file the server does not have, by parallel
+        requests.  The server answers 308 Resume Incomplete until it gets
+        all of them.
+        """
+        file_size = os.path.getsize(file_path)
+        chunk_count = get_chunks_count(file_size)
+        uploaded = self._get_uploaded_chunks(url)
+        chunks = [index for index in range(chunk_count) if index not in uploaded]
+        log.debug('Uploading %d of the %d chunks of %r in batch %s', len(chunks), chunk_count, file_path,
+                  batch_id)
+        current_action = Action.get_current_action()
+        if current_action:
+            current_action.size = file_size
+            current_action.progress = sum(min(UPLOAD_CHUNK_SIZE, file_size - index * UPLOAD_CHUNK_SIZE)
+                                          for index in uploaded if index < chunk_count)
+        stop = Event()
+        lock = Lock()
+        errors = []
+        threads = [Thread(target=self._upload_chunks_worker, name='ChunkUpload-%d' % index,
+                          args=(url, headers, file_path, file_size, chunk_count, chunks, stop, lock, errors,
+                                current_action))
+                   for index in range(min(max(1, connections), len(chunks)))]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    # Check if synchronization thread was suspended
+                    if self.check_suspended is not None:
+                        self.check_suspended('File upload: %s' % file_path)
+                    thread.join(1)
+        finally:
+            # The chunks being sent are kept by the server, the next ones wait for the next try
+            stop.set()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        self.end_action()
+        return {'batchId': batch_id, 'fileIdx': str(file_index), 'uploadType': 'chunked',
+                'uploaded': 'true', 'chunkCount': chunk_count}
+
+    def _upload_chunks_worker(self, url, headers, file_path, file_size, chunk_count, chunks, stop, lock, errors,
+                              current_action):
+        while not stop.is_set():
+            with lock:
+                if not chunks:
+                    return
+                index = chunks.pop(0)
+            try:
+                self._upload_chunk(url, headers, file_path, file_size, index, chunk_count, lock, current_action)
+            except Exception as e:
+                log.debug('Chunk %d of %r failed: %r', index, file_path, e)
+                with lock:
+                    errors.append(e)
+                stop.set()
+
+    def _upload_chunk(self, url, headers, file_path, file_size, index, chunk_count, lock, current_action):
+        offset = index * UPLOAD_CHUNK_SIZE
+        length = min(UPLOAD_CHUNK_SIZE, file_size - offset)
+        headers = dict(headers)
+        headers.update({
+            "X-Upload-Type": "chunked",
+            "X-Upload-Chunk-Index": index,
+            "X-Upload-Chunk-Count": chunk_count,
+            "Content-Length": length,
+        })
+        with open(file_path, 'rb') as input_file:
+            input_file.seek(offset)
+            data = self._read_chunk(input_file, length, lock, current_action)
+            req = urllib2.Request(url, data, headers)
+            try:
+                resp = self.streaming_opener.open(req, timeout=self.blob_timeout)
+            except urllib2.HTTPError as e:
+                # 308 Resume Incomplete: other chunks are missing
+                if e.code != 308:
+                    log_details = self._log_details(e)
+                    if isinstance(log_details, tuple):
+                        _, _, _, error = log_details
+                        if error and error.startswith("Unable to find batch"):
+                            raise InvalidBatchException()
+                    raise e
+                resp = e
+        resp.close()
+
+    def _read_chunk(self, file_object, length, lock, current_action):
+        while length > 0:
+            r = file_object.read(min(FILE_BUFFER_SIZE, length))
+            if not r:
+                break
+            length -= len(r)
+            if current_action is not None:
+                with lock:
+                    current_action.progress += len(r)
+            yield r
+
+    def _get_uploaded_chunks(self, url):
+        """ Return the indexes of the chunks of the file the server already has. """
+        req = urllib2.Request(url, headers=self._get_common_headers())
+        try:
+            resp = self.opener.open(req, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            # No chunk of the file yet
+            if e.code == 404:
+                return set()
+            raise
+        info = self._read_response(resp, url)
+        if not isinstance(info, dict):
+            return set()
+        return set(int(index) for index in info.get('uploadedChunkIds') or [])
+
+    def get_upload_state_file(self, file_path):
+        """ Return the file keeping the batch of an interrupted chunked upload of file_path. """
+        key = '\n'.join((self.server_url, self.user_id, file_path))
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.upload_tmp_dir,
+                            UPLOAD_STATE_PREFIX + hashlib.sha1(key).hexdigest() + UPLOAD_STATE_SUFFIX)
+
+    def remove_upload_state(self, file_path):
+        state_file = self.get_upload_state_file(file_path)
+        if os.path.exists(state_file):
+            os.remove(state_file)
+
+    def _get_upload_state(self, file_path):
+        """ Return the batch id of the interrupted upload of the same file content, if any. """
+        state_file = self.get_upload_state_file(file_path)
+        if not os.path.exists(state_file):
+            return None
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+        except (IOError, ValueError) as e:
+            log.debug('Cannot read the upload state %r: %r', state_file, e)
+            state = dict()
+        stat = os.stat(file_path)
+        if (state.get('size'), state.get('mtime'), state.get('chunkSize')) != (
+                stat.st_size, stat.st_mtime, UPLOAD_CHUNK_SIZE):
+            # The file changed since, the server has chunks of another content
+            os.remove(state_file)
+            return None
+        return state.get('batchId')
+
+    def _set_upload_state(self, file_path, batch_id):
+        stat = os.stat(file_path)
+        with open(self.get_upload_state_file(file_path), 'w') as f:
+            json.dump({'batchId': batch_id, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                       'chunkSize': UPLOAD_CHUNK_SIZE}, f)
+
     @staticmethod
     def end_action():
         Action.finish_action()
@@ -771,7 +1079,17 @@ class BaseAutomationClient(BaseClient):
                 current_action.progress += buffer_size
             yield r
 
-    def do_get(self, url, file_out=None, digest=None, digest_algorithm=None):
+    def do_get(self, url, file_out=None, digest=None, digest_algorithm=None, segmented=False):
+        """
+        Download the content at url, in memory or to file_out.
+
+        A download to a file with a digest is resumable: the partial file is
+        kept on error, with its state, and the next call only asks for the
+        missing bytes if the expected digest is the same.
+
+        With segmented, a large file is downloaded by several parallel
+        connections, each one getting a byte range.
+        """
         log.trace('Downloading file from %r to %r with digest=%s, digest_algorithm=%s', url, file_out, digest,
                   digest_algorithm)
         h = None
@@ -784,24 +1102,50 @@ class BaseAutomationClient(BaseClient):
                 raise ValueError('Unknow digest method: ' + digest_algorithm)
             h = digester()
         headers = self._get_common_headers()
+        offset = 0
+        if file_out is not None and h is not None:
+            validator = self._get_download_state(file_out, digest)
+            if validator is not None:
+                offset = self._hash_partial_download(file_out, h)
+                if h.copy().hexdigest() == digest:
+                    log.debug('Download of %r already complete', file_out)
+                    os.remove(get_download_state_file(file_out))
+                    return None, file_out
+                if offset:
+                    log.debug('Resuming the download of %r from byte %d', file_out, offset)
+                    headers['Range'] = 'bytes=%d-' % offset
+                    if validator:
+                        # The whole content if it changed meanwhile
+                        headers['If-Range'] = validator
         base_error_message = (
             "Failed to connect to Nuxeo server %r with user %r"
         ) % (self.server_url, self.user_id)
         try:
+            if segmented and file_out is not None and h is not None and not offset:
+                if self._download_segments(url, file_out, digest, digester):
+                    return None, file_out
             log.trace("Calling '%s' with headers: %r", url, headers)
             req = urllib2.Request(url, headers=headers)
             response = self.opener.open(req, timeout=self.blob_timeout)
+            if offset and not self._is_range_response(response, offset):
+                log.debug('Cannot resume the download of %r, starting over', file_out)
+                offset = 0
+                h = digester()
             current_action = Action.get_current_action()
             # Get the size file
             if (current_action
                     and response is not None
                     and response.info() is not None):
-                current_action.size = int(response.info().getheader(
+                current_action.size = offset + int(response.info().getheader(
                                                     'Content-Length', 0))
+                current_action.progress = offset
             if file_out is not None:
                 locker = self.unlock_path(file_out)
                 try:
-                    with open(file_out, "wb") as f:
+                    if h is not None:
+                        self._set_download_state(file_out, digest, response)
+                    received = 0
+                    with open(file_out, "ab" if offset else "wb") as f:
                         while True:
                             # Check if synchronization thread was suspended
                             if self.check_suspended is not None:
@@ -814,15 +1158,21 @@ class BaseAutomationClient(BaseClient):
                                 current_action.progress += (
                                                     self.get_download_buffer())
                             f.write(buffer_)
+                            received += len(buffer_)
                             if h is not None:
                                 h.update(buffer_)
+                    # httplib does not tell when the connection ends too early
+                    info = response.info()
+                    expected = info.getheader('Content-Length') if info is not None else None
+                    if expected is not None and received < int(expected):
+                        raise IncompleteRead('%d bytes' % received, int(expected) - received)
                     if digest is not None:
                         actual_digest = h.hexdigest()
                         if digest != actual_digest:
-                            if os.path.exists(file_out):
-                                os.remove(file_out)
+                            remove_partial_download(file_out)
                             raise CorruptedFile("Corrupted file %r: expected digest = %s, actual digest = %s"
                                                 % (file_out, digest, actual_digest))
+                        os.remove(get_download_state_file(file_out))
                     return None, file_out
                 finally:
                     self.lock_path(file_out, locker)
@@ -840,6 +1190,12 @@ class BaseAutomationClient(BaseClient):
             if e.code == 401 or e.code == 403:
                 raise Unauthorized(self.server_url, self.user_id, e.code)
             else:
+                if e.code == 416 and offset:
+                    # The partial file does not match the content, next try starts over
+                    remove_partial_download(file_out)
+                elif e.code == 404 and file_out is not None:
+                    # The document is gone, nothing to resume
+                    remove_partial_download(file_out)
                 e.msg = base_error_message + ": HTTP error %d" % e.code
                 raise e
         except Exception as e:
@@ -847,6 +1203,189 @@ class BaseAutomationClient(BaseClient):
                 e.msg = base_error_message + ": " + e.msg
             raise
 
+    def _download_segments(self, url, file_out, digest, digester):
+        """
+        Download the content in parallel byte ranges written at their offset
+        in the preallocated file_out, hashing the bytes in a row from the
+        start as they come, then check its digest.  Return False, without
+        downloading anything, if it is not worth it or the server does not
+        accept the ranges.
+        """
+        headers = self._get_common_headers()
+        headers['Range'] = 'bytes=0-0'
+        response = self.opener.open(urllib2.Request(url, headers=headers), timeout=self.blob_timeout)
+        try:
+            if not self._is_range_response(response, 0):
+                return False
+            size = int(response.info().getheader('Content-Range').rsplit('/', 1)[1])
+        finally:
+            response.close()
+        count = get_segments_count(size, self.segment_speed)
+        if count < 2:
+            return False
+        log.debug('Downloading %r in %d segments of %d bytes', file_out, count, size // count)
+        bounds = [size * index // count for index in range(count + 1)]
+        segments = [[bounds[index], bounds[index + 1], 0] for index in range(count)]
+        current_action = Action.get_current_action()
+        if current_action:
+            current_action.size = size
+        locker = self.unlock_path(file_out)
+        try:
+            with open(file_out, 'wb') as f:
+                f.truncate(size)
+            validator = self._set_download_state(file_out, digest, response)
+            stops = [Event() for _ in segments]
+            lock = Lock()
+            errors = []
+            threads = [Thread(target=self._download_segment, name='Segment-%d' % index,
+                              args=(url, file_out, segments, index, validator, stops, lock, errors, current_action))
+                       for index in range(count)]
+            for thread in threads:
+                thread.start()
+            h = digester()
+            hashed = 0
+            try:
+                for thread in threads:
+                    while thread.is_alive():
+                        # Check if synchronization thread was suspended
+                        if self.check_suspended is not None:
+                            self.check_suspended('File download: %s' % file_out)
+                        hashed = self._hash_segments(file_out, segments, h, hashed)
+                        thread.join(1)
+            finally:
+                for stop in stops:
+                    stop.set()
+                for thread in threads:
+                    thread.join()
+                if errors or any(done < end - start for start, end, done in segments):
+                    # Keep what the next try can resume from: the first bytes in a row
+                    with open(file_out, 'r+b') as f:
+                        f.truncate(self._get_segments_prefix(segments))
+            if errors:
+                raise errors[0]
+            self._hash_segments(file_out, segments, h, hashed)
+            actual_digest = h.hexdigest()
+            if digest != actual_digest:
+                remove_partial_download(file_out)
+                raise CorruptedFile("Corrupted file %r: expected digest = %s, actual digest = %s"
+                                    % (file_out, digest, actual_digest))
+            os.remove(get_download_state_file(file_out))
+            return True
+        finally:
+            self.lock_path(file_out, locker)
+
+    def _download_segment(self, url, file_out, segments, index, validator, stops, lock, errors, current_action):
+        """ Download the byte range of the segment [start, end, done], at its offset. """
+        segment = segments[index]
+        start, end, _ = segment
+        stop = stops[index]
+        try:
+            headers = self._get_common_headers()
+            headers['Range'] = 'bytes=%d-%d' % (start, end - 1)
+            if validator:
+                # Not a range of another content
+                headers['If-Range'] = validator
+            begin = time.time()
+            response = self.opener.open(urllib2.Request(url, headers=headers), timeout=self.blob_timeout)
+            if not self._is_range_response(response, start):
+                raise IOError('Range %r not served for %r' % (headers['Range'], file_out))
+            # Unbuffered, the bytes counted as done can be hashed
+            with open(file_out, 'r+b', 0) as f:
+                f.seek(start)
+                while not stop.is_set() and segment[2] < end - start:
+                    buffer_ = response.read(min(self.get_download_buffer(), end - start - segment[2]))
+                    if buffer_ == '':
+                        raise IncompleteRead('%d bytes' % segment[2], end - start - segment[2])
+                    f.write(buffer_)
+                    segment[2] += len(buffer_)
+                    if current_action:
+                        with lock:
+                            current_action.progress += len(buffer_)
+            speed = segment[2] / max(time.time() - begin, 0.001)
+            with lock:
+                if self.segment_speed is None:
+                    self.segment_speed = speed
+                else:
+                    self.segment_speed += SEGMENT_SPEED_WEIGHT * (speed - self.segment_speed)
+        except Exception as e:
+            log.debug('Segment %d-%d of %r failed: %r', start, end, file_out, e)
+            with lock:
+                errors.append(e)
+            # Only the bytes in a row from the start are kept, the segments before go on
+            for stop in stops[index + 1:]:
+                stop.set()
+
+    @staticmethod
+    def _get_segments_prefix(segments):
+        """ Return the count of the bytes in a row from the start downloaded by the segments. """
+        prefix = 0
+        for start, end, done in segments:
+            prefix = start + done
+            if done < end - start:
+                break
+        return prefix
+
+    def _hash_segments(self, file_out, segments, h, offset):
+        """ Hash the bytes in a row downloaded by the segments after offset, return the new offset. """
+        prefix = self._get_segments_prefix(segments)
+        if prefix <= offset:
+            return offset
+        with open(file_out, 'rb') as f:
+            f.seek(offset)
+            while offset < prefix:
+                buffer_ = f.read(min(self.get_download_buffer(), prefix - offset))
+                if buffer_ == '':
+                    break
+                h.update(buffer_)
+                offset += len(buffer_)
+        return offset
+
+    @staticmethod
+    def _get_download_state(file_out, digest):
+        """ Return the validator of the partial download of the same content, '' if none, else None. """
+        state_file = get_download_state_file(file_out)
+        if not os.path.exists(file_out) or not os.path.exists(state_file):
+            return None
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+        except (IOError, ValueError) as e:
+            log.debug('Cannot read the download state %r: %r', state_file, e)
+            return None
+        if state.get('digest') != digest:
+            return None
+        return state.get('validator') or ''
+
+    @staticmethod
+    def _set_download_state(file_out, digest, response):
+        # A strong ETag, else the last modification date, tells if the content changed
+        info = response.info()
+        validator = info.getheader('ETag') if info is not None else None
+        if validator is None or validator.startswith('W/'):
+            validator = info.getheader('Last-Modified') if info is not None else None
+        with open(get_download_state_file(file_out), 'w') as f:
+            json.dump({'digest': digest, 'validator': validator}, f)
+        return validator
+
+    def _hash_partial_download(self, file_out, h):
+        """ Rebuild the hash state over the bytes already downloaded, return their count. """
+        size = 0
+        with open(file_out, 'rb') as f:
+            while True:
+                buffer_ = f.read(self.get_download_buffer())
+                if buffer_ == '':
+                    return size
+                h.update(buffer_)
+                size += len(buffer_)
+
+    @staticmethod
+    def _is_range_response(response, offset):
+        if response.getcode() != 206:
+            return False
+        # bytes <first>-<last>/<length>
+        content_range = response.info().getheader('Content-Range', '')
+        return content_range.startswith('bytes %d-' % offset)
+
     @staticmethod
     def get_download_buffer():
         return FILE_BUFFER_SIZE
@@ -417,6 +417,10 @@ FolderType=Generic
                 return None
 
     # Getters
+    def get_digest_func(self):
+        """ Return the function of the digests of the local files. """
+        return self._digest_func
+
     def get_info(self, ref, raise_if_missing=True):
         if isinstance(ref, bytes):
             ref = unicode(ref)
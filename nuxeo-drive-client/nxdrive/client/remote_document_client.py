@@ -195,6 +195,8 @@ class RemoteDocumentClient(BaseAutomationClient):
         filename=None,
         mime_type=None,
         apply_versioning_policy=False,
+        chunked=False,
+        connections=1,
     ):
         """Update a document by streaming the file with the given path"""
         ref = self._check_ref(ref)
@@ -205,7 +207,8 @@ class RemoteDocumentClient(BaseAutomationClient):
         if self.is_nuxeo_drive_attach_blob():
             params.update({'applyVersioningPolicy': apply_versioning_policy})
         self.execute_with_blob_streaming(
-            op_name, file_path, filename=filename, mime_type=mime_type, **params)
+            op_name, file_path, filename=filename, mime_type=mime_type,
+            chunked=chunked, connections=connections, **params)
 
     def delete(self, ref, use_trash=True):
         op_input = "doc:" + self._check_ref(ref)
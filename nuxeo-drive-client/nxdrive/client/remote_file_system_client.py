@@ -7,8 +7,9 @@ from collections import namedtuple
 from datetime import datetime
 from threading import current_thread
 
-from nxdrive.client.base_automation_client import BaseAutomationClient, \
-    DOWNLOAD_TMP_FILE_PREFIX, DOWNLOAD_TMP_FILE_SUFFIX
+from nxdrive.client.base_automation_client import BaseAutomationClient, CorruptedFile, \
+    DOWNLOAD_TMP_FILE_PREFIX, DOWNLOAD_TMP_FILE_SUFFIX, lock_partial_download, remove_partial_download, \
+    unlock_partial_download
 from nxdrive.client.common import NotFound
 from nxdrive.engine.activity import FileAction
 from nxdrive.logging_config import get_logger
@@ -88,33 +89,51 @@ class RemoteFileSystemClient(BaseAutomationClient):
         return content
 
     def stream_content(self, fs_item_id, file_path, parent_fs_item_id=None,
-                       fs_item_info=None, file_out=None):
+                       fs_item_info=None, file_out=None, segmented=False):
         """Stream the binary content of a file system item to a tmp file
 
+        A large file is downloaded by parallel connections with segmented.
+        Return the tmp file and its digest, checked while written, or None
+        if the server gave none.
+
         Raises NotFound if file system item with id fs_item_id
         cannot be found
         """
-        if fs_item_info is None:
-            fs_item_info = self.get_info(fs_item_id,
-                                         parent_fs_item_id=parent_fs_item_id)
-        download_url = self.server_url + fs_item_info.download_url
         file_name = os.path.basename(file_path)
+        resumable, locked = True, False
         if file_out is None:
+            # Always the same file for the same path, a retry resumes the download
             file_dir = os.path.dirname(file_path)
-            file_out = os.path.join(file_dir, DOWNLOAD_TMP_FILE_PREFIX + file_name
-                                                    + str(current_thread().ident) + DOWNLOAD_TMP_FILE_SUFFIX)
-        FileAction("Download", file_out, file_name, 0)
+            file_out = os.path.join(file_dir, DOWNLOAD_TMP_FILE_PREFIX + file_name + DOWNLOAD_TMP_FILE_SUFFIX)
+            locked = resumable = lock_partial_download(file_out)
+            if not locked:
+                # Another processor downloads the same file, this one is not kept on error
+                log.debug('Download to %r in progress, using a file of the thread', file_out)
+                file_out = os.path.join(file_dir, DOWNLOAD_TMP_FILE_PREFIX + file_name
+                                        + str(current_thread().ident) + DOWNLOAD_TMP_FILE_SUFFIX)
         try:
-            _, tmp_file = self.do_get(download_url, file_out=file_out,
-                                      digest=fs_item_info.digest,
-                                      digest_algorithm=fs_item_info.digest_algorithm)
+            if fs_item_info is None:
+                fs_item_info = self.get_info(fs_item_id,
+                                             parent_fs_item_id=parent_fs_item_id)
+            download_url = self.server_url + fs_item_info.download_url
+            FileAction("Download", file_out, file_name, 0)
+            try:
+                _, tmp_file = self.do_get(download_url, file_out=file_out,
+                                          digest=fs_item_info.digest,
+                                          digest_algorithm=fs_item_info.digest_algorithm,
+                                          segmented=segmented)
+            finally:
+                self.end_action()
         except Exception as e:
-            if os.path.exists(file_out):
-                os.remove(file_out)
+            # Kept to be resumed if there is a digest to check it, unless the document is gone or corrupted
+            if (not resumable or fs_item_info is None or fs_item_info.digest is None
+                    or isinstance(e, (NotFound, CorruptedFile))):
+                remove_partial_download(file_out)
             raise e
         finally:
-            self.end_action()
-        return tmp_file
+            if locked:
+                unlock_partial_download(file_out)
+        return tmp_file, fs_item_info.digest
 
     def get_children_info(self, fs_item_id):
         children = self.execute("NuxeoDrive.GetChildren", id=fs_item_id)
@@ -150,14 +169,18 @@ class RemoteFileSystemClient(BaseAutomationClient):
         finally:
             os.remove(file_path)
 
-    def stream_file(self, parent_id, file_path, filename=None, mime_type=None, overwrite=False):
+    def stream_file(self, parent_id, file_path, filename=None, mime_type=None, overwrite=False,
+                    chunked=False, connections=1):
         """Create a document by streaming the file with the given path
         :param overwrite Allows to overwrite an existing document with the same title on the server.
+        :param chunked Upload a large file in chunks, by connections parallel requests.
         """
         fs_item = self.execute_with_blob_streaming("NuxeoDrive.CreateFile",
                                                    file_path,
                                                    filename=filename,
                                                    mime_type=mime_type,
+                                                   chunked=chunked,
+                                                   connections=connections,
                                                    parentId=parent_id,
                                                    overwrite=overwrite)
         return self.file_to_info(fs_item)
@@ -182,11 +205,13 @@ class RemoteFileSystemClient(BaseAutomationClient):
             os.remove(file_path)
 
     def stream_update(self, fs_item_id, file_path, parent_fs_item_id=None,
-                      filename=None):
+                      filename=None, chunked=False, connections=1):
         """Update a document by streaming the file with the given path"""
         fs_item = self.execute_with_blob_streaming('NuxeoDrive.UpdateFile',
                                                    file_path,
                                                    filename=filename,
+                                                   chunked=chunked,
+                                                   connections=connections,
                                                    id=fs_item_id,
                                                    parentId=parent_fs_item_id)
         return self.file_to_info(fs_item)
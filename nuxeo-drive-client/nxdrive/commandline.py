@@ -30,6 +30,9 @@ DEFAULT_HANDSHAKE_TIMEOUT = 60
 DEFAULT_TIMEOUT = 20
 DEFAULT_UPDATE_CHECK_DELAY = 3600
 DEFAULT_MAX_ERRORS = 3
+DEFAULT_UPLOAD_CONNECTIONS = 4
+DEFAULT_MIN_PROCESSORS = 1
+DEFAULT_MAX_PROCESSORS = 16
 DEFAULT_UPDATE_SITE_URL = 'http://community.nuxeo.com/static/drive/'
 USAGE = """ndrive [command]
 
@@ -149,6 +152,38 @@ class CliHandler(object):
             "--debug-pydev", default=False, action="store_true",
             help="Allow debugging with a PyDev server."
         )
+        common_parser.add_argument(
+            "--db-wal", default=False, action="store_true",
+            help="Use a write-ahead log for the databases, readers do not wait for the writer."
+        )
+        common_parser.add_argument(
+            "--db-profile", default=False, action="store_true",
+            help="Profile the engine database queries, reported in the engine metrics."
+        )
+        common_parser.add_argument(
+            "--compact-db", default=False, action="store_true",
+            help="Rebuild the engine databases at startup, releasing all their free pages."
+        )
+        common_parser.add_argument(
+            "--segmented-download", default=False, action="store_true",
+            help="Download the large files by several parallel connections."
+        )
+        common_parser.add_argument(
+            "--chunked-upload", default=False, action="store_true",
+            help="Upload the large files in chunks, resumed after a failure."
+        )
+        common_parser.add_argument(
+            "--upload-connections", default=DEFAULT_UPLOAD_CONNECTIONS, type=int,
+            help="Number of parallel connections of a chunked upload."
+        )
+        common_parser.add_argument(
+            "--min-processors", default=DEFAULT_MIN_PROCESSORS, type=int,
+            help="Minimum number of file processors started from the throughput, besides the two dedicated ones."
+        )
+        common_parser.add_argument(
+            "--max-processors", default=DEFAULT_MAX_PROCESSORS, type=int,
+            help="Maximum number of file processors started from the throughput, besides the two dedicated ones."
+        )
         common_parser.add_argument(
             "--delay", default=self.default_remote_watcher_delay, type=int,
             help="Delay in seconds for remote polling.")
@@ -210,7 +210,8 @@ class DirectEdit(Worker):
             if url is not None:
                 remote_client.do_get(url, file_out=file_out,
                                      digest=info.digest,
-                                     digest_algorithm=info.digest_algorithm)
+                                     digest_algorithm=info.digest_algorithm,
+                                     segmented=engine.use_segmented_download())
             else:
                 remote_client.get_blob(info, file_out=file_out)
         return file_out
@@ -410,7 +411,9 @@ class DirectEdit(Worker):
                     self.directEditConflict.emit(os.path.basename(ref), ref, remote_info.digest)
                     continue
                 log.debug('Uploading file %s', self._local_client.abspath(ref))
-                remote_client.stream_update(uid, self._local_client.abspath(ref), apply_versioning_policy=True)
+                remote_client.stream_update(uid, self._local_client.abspath(ref), apply_versioning_policy=True,
+                                            chunked=engine.use_chunked_upload(),
+                                            connections=engine.get_upload_connections())
                 # Update hash value
                 dir_path = os.path.dirname(ref)
                 self._local_client.set_remote_id(dir_path, current_digest, 'nxdirecteditdigest')
@@ -1,17 +1,127 @@
 # coding: utf-8
+import heapq
+import random
 import time
+from itertools import count
 from threading import Lock
 
+# Spread of the retries around their backoff delay, as a ratio of the delay
+RETRY_JITTER = 0.1
+
+
+def jittered(delay, ratio=RETRY_JITTER):
+    """ Delay randomly moved by up to ratio of it, so that the retries do not come in bursts. """
+    return delay * random.uniform(1 - ratio, 1 + ratio)
+
+
+class RetryScheduler(object):
+    """
+    Items to retry ordered by deadline, at most one by id.
+
+    A min-heap gives the next deadline and pops the due items in
+    O(log n); the entry of a rescheduled or removed item is only marked
+    as removed and skipped when it reaches the top of the heap.
+    """
+
+    _REMOVED = object()
+
+    def __init__(self):
+        self._heap = []
+        self._entries = dict()
+        self._lock = Lock()
+        # Keep the push order between the items of the same deadline
+        self._counter = count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, item_id):
+        return item_id in self._entries
+
+    def push(self, item_id, item, deadline):
+        """ Schedule the item at the deadline, replacing its previous schedule. """
+        self._lock.acquire()
+        try:
+            self._remove(item_id)
+            entry = [deadline, next(self._counter), item_id, item]
+            self._entries[item_id] = entry
+            heapq.heappush(self._heap, entry)
+        finally:
+            self._lock.release()
+
+    def _remove(self, item_id):
+        entry = self._entries.pop(item_id, None)
+        if entry is None:
+            return None
+        item = entry[-1]
+        entry[-1] = self._REMOVED
+        return item
+
+    def remove(self, item_id):
+        self._lock.acquire()
+        try:
+            return self._remove(item_id)
+        finally:
+            self._lock.release()
+
+    def _top(self):
+        while self._heap and self._heap[0][-1] is self._REMOVED:
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+    def next_deadline(self):
+        """ Deadline of the next item, None when empty. """
+        self._lock.acquire()
+        try:
+            entry = self._top()
+            return entry[0] if entry is not None else None
+        finally:
+            self._lock.release()
+
+    def pop(self, cur_time=None):
+        """ Remove and return the next item if its deadline is passed, else None. """
+        if cur_time is None:
+            cur_time = time.time()
+        self._lock.acquire()
+        try:
+            entry = self._top()
+            if entry is None or entry[0] >= cur_time:
+                return None
+            heapq.heappop(self._heap)
+            del self._entries[entry[2]]
+            return entry[-1]
+        finally:
+            self._lock.release()
+
+    def reschedule_all(self, deadline):
+        """ Move all the items to the same deadline, keeping their order. """
+        self._lock.acquire()
+        try:
+            entries = sorted(self._entries.values())
+            for entry in entries:
+                entry[0] = deadline
+            self._heap = entries
+        finally:
+            self._lock.release()
+
+    def items(self):
+        self._lock.acquire()
+        try:
+            return [entry[-1] for entry in sorted(self._entries.values())]
+        finally:
+            self._lock.release()
+
 
 class BlacklistItem(object):
 
-    def __init__(self, item_id, item, next_try=30):
+    def __init__(self, item_id, item, next_try=30, jitter=RETRY_JITTER):
         self._count = 1
         self._next_try = None
         self._item = item
         self._item_id = item_id
         self._interval = next_try
-        self._next_try = next_try + int(time.time())
+        self._jitter = jitter
+        self._next_try = jittered(next_try, jitter) + int(time.time())
 
     def check(self, cur_time=None):
         if cur_time is None:
@@ -21,6 +131,9 @@ class BlacklistItem(object):
     def get_id(self):
         return self._item_id
 
+    def get_next_try(self):
+        return self._next_try
+
     def get(self):
         return self._item
 
@@ -28,25 +141,22 @@ class BlacklistItem(object):
         cur_time = int(time.time())
         self._count = self._count + 1
         if next_try is not None:
-            self._next_try = next_try + cur_time
+            self._next_try = jittered(next_try, self._jitter) + cur_time
         else:
-            self._next_try = self._count * self._interval + cur_time
+            self._next_try = jittered(self._count * self._interval, self._jitter) + cur_time
 
 
 class BlacklistQueue(object):
+    """ Items retried after a delay growing with their failures, spread like the errors of the queue manager. """
 
-    def __init__(self, delay=30):
-        self._queue = dict()
-        self._lock = Lock()
+    def __init__(self, delay=30, jitter=RETRY_JITTER):
+        self._queue = RetryScheduler()
         self._delay = delay
+        self._jitter = jitter
 
     def push(self, id_obj, obj):
-        item = BlacklistItem(item_id=id_obj, item=obj, next_try=self._delay)
-        self._lock.acquire()
-        try:
-            self._queue[item.get_id()] = item
-        finally:
-            self._lock.release()
+        item = BlacklistItem(item_id=id_obj, item=obj, next_try=self._delay, jitter=self._jitter)
+        self._queue.push(item.get_id(), item, item.get_next_try())
 
     def repush(self, item, increase_wait=True):
         if not isinstance(item, BlacklistItem):
@@ -55,19 +165,7 @@ class BlacklistQueue(object):
             item.increase()
         else:
             item.increase(next_try=self._delay)
-        self._lock.acquire()
-        try:
-            self._queue[item.get_id()] = item
-        finally:
-            self._lock.release()
+        self._queue.push(item.get_id(), item, item.get_next_try())
 
     def get(self):
-        cur_time = int(time.time())
-        self._lock.acquire()
-        try:
-            for item in self._queue.values():
-                if item.check(cur_time=cur_time):
-                    del self._queue[item.get_id()]
-                    return item
-        finally:
-            self._lock.release()
+        return self._queue.pop(int(time.time()))
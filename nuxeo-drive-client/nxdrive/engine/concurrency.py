@@ -0,0 +1,121 @@
+# coding: utf-8
+import socket
+import time
+from threading import Lock
+from urllib2 import HTTPError, URLError
+
+# Seconds of activity between two adjustments of the processors count
+ADAPTIVE_WINDOW = 10
+# Relative throughput increase an additional processor has to bring
+ADAPTIVE_GAIN = 0.05
+# Windows without trying to grow again after a useless additional processor
+ADAPTIVE_HOLD = 6
+# Server answers telling it is overloaded
+CONGESTION_HTTP_CODES = (429, 503)
+
+
+def is_congestion(exception):
+    """ Return True if the exception tells the server or the network is overloaded. """
+    if isinstance(exception, HTTPError):
+        return exception.code in CONGESTION_HTTP_CODES
+    if isinstance(exception, URLError):
+        return isinstance(exception.reason, socket.timeout)
+    return isinstance(exception, socket.timeout)
+
+
+class ConcurrencyController(object):
+    """
+    Choose the number of processors from the observed throughput, AIMD style.
+
+    At the end of each window with pending items: any congestion halves
+    the level, an additional processor that did not increase the files/s
+    or bytes/s is released, otherwise one more processor is tried.
+    """
+
+    def __init__(self, level, min_level, max_level, window=ADAPTIVE_WINDOW):
+        self.min_level = min_level
+        self.max_level = max_level
+        self.level = max(min_level, min(max_level, level))
+        self.window = window
+        self._lock = Lock()
+        self._window_start = time.time()
+        self._files = 0
+        self._bytes = 0
+        self._congestions = 0
+        # Rates of the previous window, and if the level grew after it
+        self._rates = None
+        self._grown = False
+        self._hold = 0
+        self._metrics = {'processors_files_rate': 0, 'processors_bytes_rate': 0, 'processors_congestions': 0}
+
+    def record_sync(self, size=0):
+        self._lock.acquire()
+        try:
+            self._files += 1
+            self._bytes += size or 0
+        finally:
+            self._lock.release()
+
+    def record_congestion(self):
+        self._lock.acquire()
+        try:
+            self._congestions += 1
+            self._metrics['processors_congestions'] += 1
+        finally:
+            self._lock.release()
+
+    def update(self, backlog, cur_time=None):
+        """ Return the level to use, changed only at the end of a window. """
+        if cur_time is None:
+            cur_time = time.time()
+        self._lock.acquire()
+        try:
+            elapsed = cur_time - self._window_start
+            if elapsed < self.window:
+                return self.level
+            rates = (self._files / elapsed, self._bytes / elapsed)
+            level = self.level
+            if self._congestions:
+                # Multiplicative decrease
+                level = max(self.min_level, level // 2)
+                self._hold = ADAPTIVE_HOLD
+            elif backlog:
+                if self._grown and not self._improved(rates):
+                    # The last processor did not pay
+                    level = max(self.min_level, level - 1)
+                    self._hold = ADAPTIVE_HOLD
+                elif self._hold:
+                    self._hold -= 1
+                else:
+                    # Additive increase
+                    level = min(self.max_level, level + 1)
+            self._grown = level > self.level
+            self.level = level
+            self._rates = rates
+            self._metrics['processors_files_rate'], self._metrics['processors_bytes_rate'] = rates
+            self._window_start = cur_time
+            self._files = self._bytes = self._congestions = 0
+            return self.level
+        finally:
+            self._lock.release()
+
+    def _improved(self, rates):
+        if self._rates is None:
+            return True
+        return any(rate > previous * (1 + ADAPTIVE_GAIN) for rate, previous in zip(rates, self._rates))
+
+    def set_max_level(self, max_level):
+        """ Lower or raise the upper bound, the current level is brought under it. """
+        self._lock.acquire()
+        try:
+            self.max_level = max(self.min_level, max_level)
+            self.level = min(self.level, self.max_level)
+        finally:
+            self._lock.release()
+
+    def get_metrics(self):
+        metrics = dict(self._metrics)
+        metrics['processors_level'] = self.level
+        metrics['processors_min'] = self.min_level
+        metrics['processors_max'] = self.max_level
+        return metrics
@@ -1,9 +1,13 @@
 # coding: utf-8
-import inspect
 import os
+import random
 import sqlite3
+import sys
+from bisect import bisect_left
+from collections import OrderedDict
 from datetime import datetime
-from threading import RLock, current_thread, local
+from threading import Lock, RLock, current_thread, local
+from time import sleep, time
 
 from PyQt4.QtCore import QObject, pyqtSignal
 
@@ -13,6 +17,32 @@ log = get_logger(__name__)
 
 SCHEMA_VERSION = "schema_version"
 
+# Prepared statements kept by connection, more than the distinct DAO queries
+DB_CACHED_STATEMENTS = 256
+# Seconds to wait for a lock held by another connection
+DB_BUSY_TIMEOUT = 30
+# Seconds spent retrying a statement still locked after the busy timeout
+DB_RETRY_BUDGET = 10.0
+DB_RETRY_MIN_DELAY = 0.01
+DB_RETRY_MAX_DELAY = 1.0
+# Free pages ratio of the database above which it is compacted when idle
+COMPACT_MIN_RATIO = 0.1
+# Free pages released by compaction step
+COMPACT_STEP_PAGES = 1024
+# States lookups kept in memory, see StateCache
+STATE_CACHE_SIZE = 1000
+# States read by chunk when loading the queue
+QUEUE_LOAD_CHUNK = 1000
+# Pages written to the WAL before an automatic checkpoint
+WAL_AUTOCHECKPOINT = 1000
+# Bounds of the transactions grouping the writes of a batch
+BATCH_MAX_COUNT = 1000
+BATCH_MAX_DELAY = 1.0
+# Values bound in one IN clause, below the default SQLITE_MAX_VARIABLE_NUMBER of 999
+MAX_IN_VALUES = 500
+# Error counts from which the StatesCounts rows share the same bucket
+MAX_ERROR_BUCKET = 10
+
 # Summary status from last known pair of states
 # (local_state, remote_state)
 PAIR_STATES = {
@@ -55,24 +85,181 @@ PAIR_STATES = {
 }
 
 
+class ContentionMetrics(object):
+    """ Lock contention counters by query site, the DAO method running the statement. """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._sites = dict()
+
+    def record(self, site, retries, wait, failed):
+        self._lock.acquire()
+        try:
+            metrics = self._sites.setdefault(site, {'retries': 0, 'wait': 0.0, 'failures': 0})
+            metrics['retries'] += retries
+            metrics['wait'] += wait
+            if failed:
+                metrics['failures'] += 1
+        finally:
+            self._lock.release()
+
+    def get_metrics(self):
+        self._lock.acquire()
+        try:
+            sites = {site: dict(metrics) for site, metrics in self._sites.iteritems()}
+        finally:
+            self._lock.release()
+        return {
+            'db_retries': sum(metrics['retries'] for metrics in sites.itervalues()),
+            'db_wait': sum(metrics['wait'] for metrics in sites.itervalues()),
+            'db_failures': sum(metrics['failures'] for metrics in sites.itervalues()),
+            'db_contention': sites,
+        }
+
+
+class QueryProfiler(object):
+    """ Statements count, latency histogram and rows returned by query site. """
+
+    # Upper bounds of the latency histogram buckets, in milliseconds
+    BUCKETS = (1, 5, 10, 50, 100, 500, 1000)
+
+    def __init__(self):
+        self._lock = Lock()
+        self._sites = dict()
+
+    def _get_site_metrics(self, site):
+        metrics = self._sites.get(site)
+        if metrics is None:
+            metrics = self._sites[site] = {'calls': 0, 'time': 0.0, 'rows': 0,
+                                           'histogram': [0] * (len(self.BUCKETS) + 1)}
+        return metrics
+
+    def record(self, site, duration):
+        bucket = bisect_left(self.BUCKETS, duration * 1000)
+        self._lock.acquire()
+        try:
+            metrics = self._get_site_metrics(site)
+            metrics['calls'] += 1
+            metrics['time'] += duration
+            metrics['histogram'][bucket] += 1
+        finally:
+            self._lock.release()
+
+    def add_rows(self, site, count):
+        self._lock.acquire()
+        try:
+            self._get_site_metrics(site)['rows'] += count
+        finally:
+            self._lock.release()
+
+    def get_metrics(self):
+        labels = ['%dms' % bound for bound in self.BUCKETS] + ['more']
+        self._lock.acquire()
+        try:
+            return {site: {'calls': metrics['calls'], 'time': metrics['time'], 'rows': metrics['rows'],
+                           'histogram': dict(zip(labels, metrics['histogram']))}
+                    for site, metrics in self._sites.iteritems()}
+        finally:
+            self._lock.release()
+
+
 class AutoRetryCursor(sqlite3.Cursor):
     def execute(self, *args, **kwargs):
+        return self._retry(super(AutoRetryCursor, self).execute, *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self._retry(super(AutoRetryCursor, self).executemany, *args, **kwargs)
+
+    def _retry(self, method, *args, **kwargs):
+        """
+        Run the statement, retrying while the database is locked beyond
+        the busy timeout, with a jittered exponential backoff.
+        """
+        budget = getattr(self.connection, 'retry_budget', DB_RETRY_BUDGET)
+        delay = DB_RETRY_MIN_DELAY
         count = 0
+        start = None
         while True:
             count += 1
             try:
-                obj = super(AutoRetryCursor, self).execute(*args, **kwargs)
+                obj = method(*args, **kwargs)
                 if count > 1:
                     log.trace('Result returned from try #%d', count)
+                    self._record(count - 1, time() - start, False)
                 return obj
             except sqlite3.OperationalError as e:
-                log.trace('Retry locked database #%d', count)
-                if count > 5:
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    raise e
+                if start is None:
+                    start = time()
+                elapsed = time() - start
+                if elapsed >= budget:
+                    self._record(count - 1, elapsed, True)
                     raise e
+                wait = min(random.uniform(delay / 2, delay), budget - elapsed)
+                log.trace('Retry locked database #%d in %dms', count, wait * 1000)
+                sleep(wait)
+                delay = min(delay * 2, DB_RETRY_MAX_DELAY)
+
+    def _record(self, retries, wait, failed):
+        metrics = getattr(self.connection, 'metrics', None)
+        if metrics is None:
+            return
+        metrics.record(self._get_site(), retries, wait, failed)
+
+    def _get_site(self):
+        """ Name of the function running the statement, out of the cursor methods. """
+        frame = sys._getframe(1)
+        while frame.f_locals.get('self') is self:
+            frame = frame.f_back
+        return frame.f_code.co_name
+
+
+class ProfiledCursor(AutoRetryCursor):
+    """ Cursor feeding the QueryProfiler of its connection. """
+
+    _site = None
+
+    def _retry(self, method, *args, **kwargs):
+        start = time()
+        try:
+            return super(ProfiledCursor, self)._retry(method, *args, **kwargs)
+        finally:
+            self._site = self._get_site()
+            self.connection.profiler.record(self._site, time() - start)
+
+    def _add_rows(self, count):
+        if count:
+            self.connection.profiler.add_rows(self._site, count)
+
+    def fetchone(self):
+        row = super(ProfiledCursor, self).fetchone()
+        self._add_rows(int(row is not None))
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super(ProfiledCursor, self).fetchmany(*args, **kwargs)
+        self._add_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super(ProfiledCursor, self).fetchall()
+        self._add_rows(len(rows))
+        return rows
+
+    def next(self):
+        row = super(ProfiledCursor, self).next()
+        self._add_rows(1)
+        return row
 
 
 class AutoRetryConnection(sqlite3.Connection):
+    # Set to a QueryProfiler to profile the statements
+    profiler = None
+
     def cursor(self):
+        if self.profiler is not None:
+            return super(AutoRetryConnection, self).cursor(ProfiledCursor)
         return super(AutoRetryConnection, self).cursor(AutoRetryCursor)
 
 
@@ -110,17 +297,196 @@ class StateRow(sqlite3.Row):
             self.remote_state = remote_state
 
 
+class DocPair(object):
+    """
+    A state, as read by EngineDAO._select_states.
+
+    The columns are slots filled from the cursor tuple: lighter than a
+    sqlite3.Row and read without any lookup by name.
+    """
+
+    # Columns of the States table
+    STATE_COLUMNS = (
+        'id', 'last_local_updated', 'last_remote_updated', 'local_digest', 'remote_digest',
+        'local_basename', 'remote_ref', 'local_parent_path_id', 'remote_parent_ref',
+        'remote_parent_path_id', 'local_name', 'remote_name', 'size', 'folderish', 'local_state',
+        'remote_state', 'pair_state', 'remote_can_rename', 'remote_can_delete',
+        'remote_can_update', 'remote_can_create_child', 'last_remote_modifier', 'last_sync_date',
+        'error_count', 'last_sync_error_date', 'last_error', 'last_error_details', 'version',
+        'processor', 'last_transfer')
+    # Columns rebuilt from the interned paths
+    PATH_COLUMNS = ('local_path', 'local_parent_path', 'remote_parent_path')
+    COLUMNS = STATE_COLUMNS + PATH_COLUMNS
+    # Set by the queue manager on a pair in error
+    __slots__ = COLUMNS + ('error_next_try',)
+
+    def __init__(self, row):
+        (self.id, self.last_local_updated, self.last_remote_updated, self.local_digest, self.remote_digest,
+         self.local_basename, self.remote_ref, self.local_parent_path_id, self.remote_parent_ref,
+         self.remote_parent_path_id, self.local_name, self.remote_name, self.size, self.folderish,
+         self.local_state, self.remote_state, self.pair_state, self.remote_can_rename,
+         self.remote_can_delete, self.remote_can_update, self.remote_can_create_child,
+         self.last_remote_modifier, self.last_sync_date, self.error_count, self.last_sync_error_date,
+         self.last_error, self.last_error_details, self.version, self.processor, self.last_transfer,
+         self.local_path, self.local_parent_path, self.remote_parent_path) = row
+        self.error_next_try = 0
+
+    def __repr__(self):
+        return ('<{name}[{cls.id!r}]'
+                ' local_path={cls.local_path!r},'
+                ' remote_ref={cls.remote_ref!r},'
+                ' local_state={cls.local_state!r},'
+                ' remote_state={cls.remote_state!r},'
+                ' pair_state={cls.pair_state!r}'
+                '>'
+                ).format(name=type(self).__name__, cls=self)
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.COLUMNS)
+
+    def __eq__(self, other):
+        return isinstance(other, DocPair) and self._values() == other._values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def is_readonly(self):
+        if self.folderish:
+            return self.remote_can_create_child == 0
+        return (self.remote_can_delete & self.remote_can_rename
+                & self.remote_can_update) == 0
+
+    def update_state(self, local_state=None, remote_state=None):
+        if local_state is not None:
+            self.local_state = local_state
+        if remote_state is not None:
+            self.remote_state = remote_state
+
+
+def doc_pair_factory(cursor, row):
+    """ Row factory of the engine: a DocPair for a state, a StateRow for any other row. """
+    if len(row) == len(DocPair.COLUMNS) and cursor.description[-1][0] == 'remote_parent_path':
+        return DocPair(row)
+    return StateRow(cursor, row)
+
+
+class StateCache(object):
+    """
+    Bounded LRU cache of the states lookups.
+
+    Any write clears it: a lookup that started before the clear is not
+    stored, it may have read the state before the write was committed.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+
+    def get(self, key, loader):
+        """ Return the cached value of the key, or the one returned by loader(). """
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                # Move to the most recently used end
+                value = self._entries.pop(key)
+                self._entries[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+            generation = self._generation
+        finally:
+            self._lock.release()
+        value = loader()
+        self._lock.acquire()
+        try:
+            if generation == self._generation:
+                self._entries[key] = value
+                if len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+        return value
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def get_metrics(self):
+        return {'state_cache_hits': self.hits, 'state_cache_misses': self.misses,
+                'state_cache_size': len(self._entries)}
+
+
+class FilterTrie(object):
+    """
+    Compiled filter paths: a tree of the path segments where a node is
+    True when its path is filtered.
+
+    Telling if a path or any of its ancestors is filtered only walks the
+    path segments, whatever the number of filters.
+    """
+
+    def __init__(self, paths=()):
+        self._root = {}
+        self._filtered = False
+        for path in paths:
+            self._add(path)
+
+    @staticmethod
+    def _split(path):
+        return [segment for segment in path.split('/') if segment]
+
+    def _add(self, path):
+        segments = self._split(path)
+        if not segments:
+            self._filtered = True
+            return
+        node = self._root
+        for segment in segments[:-1]:
+            child = node.get(segment)
+            if child is True:
+                # An ancestor is already filtered
+                return
+            if child is None:
+                child = node[segment] = {}
+            node = child
+        node[segments[-1]] = True
+
+    def match(self, path):
+        """ Return True if the path or one of its ancestors is filtered. """
+        if self._filtered:
+            return True
+        node = self._root
+        for segment in self._split(path):
+            node = node.get(segment)
+            if node is None:
+                return False
+            if node is True:
+                return True
+        return False
+
+
 class LogLock(object):
     def __init__(self):
         self._lock = RLock()
 
     def acquire(self):
-        log.trace("lock acquire: %s", inspect.stack()[1][3])
+        log.trace("lock acquire: %s", sys._getframe(1).f_code.co_name)
         self._lock.acquire()
         log.trace("lock acquired")
 
     def release(self):
-        log.trace("lock release: %s", inspect.stack()[1][3])
+        log.trace("lock release: %s", sys._getframe(1).f_code.co_name)
         self._lock.release()
 
 
@@ -132,12 +498,54 @@ class FakeLock(object):
         pass
 
 
+class WriteBatch(object):
+    """ Uncommitted writes of a thread and the actions waiting for their commit. """
+
+    def __init__(self, max_count, max_delay):
+        self.max_count = max_count
+        self.max_delay = max_delay
+        self.depth = 1
+        self.count = 0
+        self.started = None
+        self.commits = 0
+        self._deferred = []
+
+    def add(self):
+        if self.count == 0:
+            self.started = time()
+        self.count += 1
+
+    def is_due(self):
+        return (self.count >= self.max_count
+                or self.count > 0 and time() - self.started >= self.max_delay)
+
+    def defer(self, callback, *args, **kwargs):
+        self._deferred.append((callback, args, kwargs))
+
+    def committed(self):
+        """ Reset the batch and return the deferred actions. """
+        if self.count > 0:
+            self.commits += 1
+        self.count = 0
+        self.started = None
+        deferred, self._deferred = self._deferred, []
+        return deferred
+
+
 class ConfigurationDAO(QObject):
 
-    def __init__(self, db):
+    def __init__(self, db, wal=False, busy_timeout=DB_BUSY_TIMEOUT, retry_budget=DB_RETRY_BUDGET,
+                 cached_statements=DB_CACHED_STATEMENTS, profile=False):
         super(ConfigurationDAO, self).__init__()
-        log.debug("Create DAO on %s", db)
+        log.debug("Create DAO on %s (WAL: %r)", db, wal)
         self._db = db
+        # Write-ahead log: the readers do not wait for the writer
+        self.wal = wal
+        self.busy_timeout = busy_timeout
+        self.retry_budget = retry_budget
+        self.cached_statements = cached_statements
+        self._contention = ContentionMetrics()
+        self._profiler = QueryProfiler() if profile else None
         migrate = os.path.exists(self._db)
         # For testing purpose only should always be True
         self.share_connection = True
@@ -145,6 +553,8 @@ class ConfigurationDAO(QObject):
         self.schema_version = self.get_schema_version()
         self.in_tx = None
         self._tx_lock = RLock()
+        # Write batches by thread
+        self._batches = dict()
         # If we dont share connection no need to lock
         if self.share_connection:
             self._lock = RLock()
@@ -157,7 +567,7 @@ class ConfigurationDAO(QObject):
         c = self._conn.cursor()
         self._init_db(c)
         if migrate:
-            res = c.execute("SELECT value FROM Configuration WHERE name='"+SCHEMA_VERSION+"'").fetchone()
+            res = c.execute("SELECT value FROM Configuration WHERE name=?", (SCHEMA_VERSION,)).fetchone()
             if res is None:
                 schema = 0
             else:
@@ -175,6 +585,13 @@ class ConfigurationDAO(QObject):
     def get_schema_version(self):
         return 1
 
+    def get_metrics(self):
+        """ Lock contention metrics, overall and by query site, and the profile if enabled. """
+        metrics = self._contention.get_metrics()
+        if self._profiler is not None:
+            metrics['db_profile'] = self._profiler.get_metrics()
+        return metrics
+
     def acquire_lock(self):
         self._lock.acquire()
 
@@ -212,8 +629,18 @@ class ConfigurationDAO(QObject):
             self.update_config(SCHEMA_VERSION, 1)
 
     def _init_db(self, cursor):
-        # http://www.stevemcarthur.co.uk/blog/post/some-kind-of-disk-io-error-occurred-sqlite
-        cursor.execute("PRAGMA journal_mode = MEMORY")
+        # Only effective on a new database, legacy ones are converted by a full VACUUM
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        if self.wal:
+            mode = cursor.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+            if mode.lower() != 'wal':
+                # Network file systems do not support the shared memory
+                log.warning("Cannot use WAL journal mode on %s, got %r", self._db, mode)
+                self.wal = False
+                cursor.execute("PRAGMA synchronous = FULL")
+        if not self.wal:
+            # http://www.stevemcarthur.co.uk/blog/post/some-kind-of-disk-io-error-occurred-sqlite
+            cursor.execute("PRAGMA journal_mode = MEMORY")
         self._create_configuration_table(cursor)
 
     def _create_configuration_table(self, cursor):
@@ -222,14 +649,33 @@ class ConfigurationDAO(QObject):
     def _create_main_conn(self):
         log.debug("Create main connexion on %s (dir exists: %d / file exists: %d)",
                     self._db, os.path.exists(os.path.dirname(self._db)), os.path.exists(self._db))
-        self._conn = AutoRetryConnection(self._db, check_same_thread=False)
+        self._conn = self._connect()
         self._connections.append(self._conn)
 
+    def _connect(self):
+        # Dont check same thread for closing purpose
+        con = AutoRetryConnection(self._db, check_same_thread=False, timeout=self.busy_timeout,
+                                  cached_statements=self.cached_statements)
+        con.retry_budget = self.retry_budget
+        con.metrics = self._contention
+        con.profiler = self._profiler
+        if self.wal:
+            # A commit only syncs the WAL, still safe from corruption
+            con.execute("PRAGMA synchronous = NORMAL")
+            con.execute("PRAGMA wal_autocheckpoint = %d" % WAL_AUTOCHECKPOINT)
+        return con
+
     def _log_trace(self, query):
         log.trace(query)
 
     def dispose(self):
         log.debug("Disposing sqlite database %r", self.get_db())
+        if self.wal and self._conn is not None:
+            try:
+                # Leave an empty WAL behind
+                self.checkpoint('TRUNCATE')
+            except sqlite3.Error as e:
+                log.debug("Cannot checkpoint %r: %r", self.get_db(), e)
         for con in self._connections:
             con.close()
         self._connections = []
@@ -251,19 +697,24 @@ class ConfigurationDAO(QObject):
         return self._get_read_connection(factory)
 
     def _get_read_connection(self, factory=StateRow):
+        batch = self._get_batch()
+        if batch is not None and batch.count:
+            # Read the uncommitted writes of the batch
+            self._conn.row_factory = factory
+            return self._conn
         # If in transaction
         if self.in_tx is not None:
-            if current_thread().ident != self.in_tx:
+            if current_thread().ident == self.in_tx:
+                # Return the write connection
+                return self._conn
+            if not self.wal:
                 log.trace("In transaction wait for read connection")
                 # Wait for the thread in transaction to finished
                 self._tx_lock.acquire()
                 self._tx_lock.release()
-            else:
-                # Return the write connection
-                return self._conn
+            # With a WAL the readers see the last committed data
         if not hasattr(self._conns, '_conn') or self._conns._conn is None:
-            # Dont check same thread for closing purpose
-            self._conns._conn = AutoRetryConnection(self._db, check_same_thread=False)
+            self._conns._conn = self._connect()
             self._connections.append(self._conns._conn)
         self._conns._conn.row_factory = factory
             # Python3.3 feature
@@ -283,6 +734,136 @@ class ConfigurationDAO(QObject):
         self._lock.release()
         self._tx_lock.release()
         self.in_tx = None
+        self._committed()
+
+    def _get_batch(self):
+        return self._batches.get(current_thread().ident)
+
+    def begin_batch(self, max_count=BATCH_MAX_COUNT, max_delay=BATCH_MAX_DELAY):
+        """
+        Group the following writes of the current thread in transactions
+        committed every max_count writes or max_delay seconds.
+        The batches can be nested, only the outer one counts.
+        """
+        batch = self._get_batch()
+        if batch is not None:
+            batch.depth += 1
+            return
+        self._batches[current_thread().ident] = WriteBatch(max_count, max_delay)
+
+    def end_batch(self):
+        batch = self._get_batch()
+        if batch is None:
+            return
+        batch.depth -= 1
+        if batch.depth > 0:
+            return
+        try:
+            self.commit_batch()
+        finally:
+            del self._batches[current_thread().ident]
+            log.trace("Batch ended after %d commits", batch.commits)
+
+    def commit_batch(self):
+        """ Commit the pending writes of the current thread batch, if any. """
+        batch = self._get_batch()
+        if batch is None:
+            return
+        self._lock.acquire()
+        try:
+            if batch.count:
+                self._get_write_connection().commit()
+            deferred = batch.committed()
+        finally:
+            self._lock.release()
+        self._committed()
+        for callback, args, kwargs in deferred:
+            callback(*args, **kwargs)
+
+    def _commit_write(self, con):
+        """ Commit a write, unless a transaction or a batch groups it. """
+        batch = self._get_batch()
+        if batch is None:
+            if self.auto_commit:
+                con.commit()
+                self._committed()
+            return
+        batch.add()
+        if batch.is_due():
+            self.commit_batch()
+
+    def _committed(self):
+        """ Called once writes are committed, for the caches. """
+        pass
+
+    def _reads_uncommitted(self):
+        """ Whether the reads of the current thread see writes not committed yet. """
+        batch = self._get_batch()
+        return (batch is not None and batch.count > 0) or self.in_tx == current_thread().ident
+
+    def checkpoint(self, mode='PASSIVE'):
+        """
+        Copy the WAL content back into the database.
+
+        :param mode: PASSIVE, FULL, RESTART or TRUNCATE
+        :return: (busy, WAL pages, checkpointed pages) or None without WAL
+        """
+        if not self.wal:
+            return None
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            return tuple(con.execute("PRAGMA wal_checkpoint(%s)" % mode).fetchone())
+        finally:
+            self._lock.release()
+
+    def vacuum(self):
+        """
+        Rebuild the whole database with incremental auto vacuum, releasing
+        all its free pages.  The full VACUUM rewrites the whole file and
+        blocks the other connections until it ends: only forced at startup,
+        see --compact-db.
+        """
+        self._lock.acquire()
+        try:
+            self._vacuum(self._get_write_connection().cursor())
+        finally:
+            self._lock.release()
+
+    def _vacuum(self, cursor):
+        log.debug("Vacuum sqlite %s", self._db)
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+        log.debug("Vacuum sqlite finished")
+
+    def compact(self, max_pages=COMPACT_STEP_PAGES, min_ratio=COMPACT_MIN_RATIO):
+        """
+        Release free pages to the file system, by steps of max_pages,
+        once they exceed min_ratio of the database.
+        A database created without incremental auto vacuum releases
+        nothing until converted, see EngineDAO._migrate_db().
+
+        :return: the number of pages released
+        """
+        self._lock.acquire()
+        try:
+            if self.in_tx is not None or any(batch.count for batch in self._batches.values()):
+                # A PRAGMA would commit the pending writes
+                return 0
+            con = self._get_write_connection()
+            if con.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return 0
+            pages = con.execute("PRAGMA page_count").fetchone()[0]
+            free = con.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free or float(free) / pages < min_ratio:
+                return 0
+            con.execute("PRAGMA incremental_vacuum(%d)" % max_pages).fetchall()
+            con.commit()
+            released = free - con.execute("PRAGMA freelist_count").fetchone()[0]
+            log.trace("Released %d free pages out of %d", released, free)
+            return released
+        finally:
+            self._lock.release()
 
     def commit(self):
         if self.auto_commit:
@@ -292,6 +873,7 @@ class ConfigurationDAO(QObject):
             self._get_write_connection().commit()
         finally:
             self._lock.release()
+        self._committed()
 
     def _delete_config(self, cursor, name):
         cursor.execute("DELETE FROM Configuration WHERE name=?", (name,))
@@ -302,8 +884,7 @@ class ConfigurationDAO(QObject):
             con = self._get_write_connection()
             c = con.cursor()
             self._delete_config(c, name)
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -317,8 +898,7 @@ class ConfigurationDAO(QObject):
                 c.execute("INSERT OR IGNORE INTO Configuration(value,name) VALUES(?,?)", (value,name))
             else:
                 c.execute("DELETE FROM Configuration WHERE name=?", (name,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -358,8 +938,7 @@ class ManagerDAO(ConfigurationDAO):
                        notification.action,
                        notification.flags,
                        ))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -369,8 +948,7 @@ class ManagerDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("DELETE FROM AutoLock WHERE path = ?", (path,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -385,13 +963,11 @@ class ManagerDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("INSERT INTO AutoLock(path,process,remote_id) VALUES(?,?,?)", (path, process, doc_id))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         except sqlite3.IntegrityError:
             # Already there just update the process
             c.execute("UPDATE AutoLock SET process=?, remote_id=? WHERE path=?", (process, doc_id, path))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -410,8 +986,7 @@ class ManagerDAO(ConfigurationDAO):
                        notification.description,
                        notification.uid,
                        ))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -430,8 +1005,7 @@ class ManagerDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("UPDATE Notifications SET flags = (flags | " + str(Notification.FLAG_DISCARD) + ") WHERE uid=? AND (flags & " + str(Notification.FLAG_DISCARDABLE) + ") = " + str(Notification.FLAG_DISCARDABLE), (uid,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -441,8 +1015,7 @@ class ManagerDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("DELETE FROM Notifications WHERE uid=?", (uid,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -464,8 +1037,7 @@ class ManagerDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("UPDATE Engines SET local_folder=? WHERE uid=?", (path, engine))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -475,8 +1047,7 @@ class ManagerDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("INSERT INTO Engines(local_folder, engine, uid, name) VALUES(?,?,?,?)", (path, engine, key, name))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
             result = c.execute("SELECT * FROM Engines WHERE uid=?", (key,)).fetchone()
         finally:
             self._lock.release()
@@ -488,8 +1059,7 @@ class ManagerDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("DELETE FROM Engines WHERE uid=?", (uid,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -497,26 +1067,51 @@ class ManagerDAO(ConfigurationDAO):
 class EngineDAO(ConfigurationDAO):
     newConflict = pyqtSignal(object)
 
-    def __init__(self, db, state_factory=StateRow):
-        self._filters = None
+    # Rebuild the path columns from the interned paths
+    _local_path = ("CASE WHEN local_basename IS NULL OR local_basename = '' OR lp.path IS NULL OR lp.path = ''"
+                   "     THEN local_basename"
+                   "     WHEN lp.path = '/' THEN '/' || local_basename"
+                   "     ELSE lp.path || '/' || local_basename END")
+    # Last part of the remote_ref, after its last '#'
+    _remote_ref_suffix = "substr(remote_ref, length(rtrim(remote_ref, replace(remote_ref, '#', ''))) + 1)"
+    _select_states = ("SELECT " + ", ".join("States." + name for name in DocPair.STATE_COLUMNS) + ","
+                      " " + _local_path + " AS local_path,"
+                      " lp.path AS local_parent_path,"
+                      " rp.path AS remote_parent_path"
+                      " FROM States"
+                      " LEFT JOIN LocalPaths lp ON lp.id = States.local_parent_path_id"
+                      " LEFT JOIN RemotePaths rp ON rp.id = States.remote_parent_path_id")
+
+    def __init__(self, db, state_factory=doc_pair_factory, cache_size=STATE_CACHE_SIZE, **kwargs):
+        self._filters = FilterTrie()
         self._queue_manager = None
-        super(EngineDAO, self).__init__(db)
+        # Only the DocPair records can be copied out of the cache
+        self._state_cache = None
+        if cache_size and state_factory is doc_pair_factory:
+            self._state_cache = StateCache(cache_size)
+        super(EngineDAO, self).__init__(db, **kwargs)
         self._state_factory = state_factory
-        self._filters = self.get_filters()
-        self._items_count = None
-        self._items_count = self.get_syncing_count()
+        self._load_filters()
         self.reinit_processors()
+        self.clean_paths()
 
     def get_schema_version(self):
-        return 3
+        return 8
 
     def _migrate_state(self, cursor):
         try:
-            self._migrate_table(cursor, 'States')
+            if self._has_legacy_paths(cursor):
+                self._migrate_state_paths(cursor)
+            else:
+                self._migrate_table(cursor, 'States')
         except sqlite3.IntegrityError:
             # If we cannot smoothly migrate harder migration
             cursor.execute("DROP TABLE if exists StatesMigration")
             self._reinit_states(cursor)
+        # Indexes and triggers followed the renamed table and were dropped with it
+        self._create_state_indexes(cursor)
+        self._create_state_counts(cursor)
+        self._rebuild_state_counts(cursor)
 
     def _migrate_db(self, cursor, version):
         if version < 1:
@@ -530,6 +1125,49 @@ class EngineDAO(ConfigurationDAO):
         if version < 3:
             self._migrate_state(cursor)
             self.update_config(SCHEMA_VERSION, 3)
+        if version < 4:
+            # Indexes are created along the interned paths of version 5
+            self.update_config(SCHEMA_VERSION, 4)
+        if version < 5:
+            if self._has_legacy_paths(cursor):
+                self._migrate_state(cursor)
+            self._create_state_indexes(cursor)
+            self.update_config(SCHEMA_VERSION, 5)
+        if version < 6:
+            self._create_state_counts(cursor)
+            self._rebuild_state_counts(cursor)
+            self.update_config(SCHEMA_VERSION, 6)
+        if version < 7:
+            # Replaced by the partial indexes of the hot pairs
+            cursor.execute("DROP INDEX if exists idx_states_to_sync")
+            cursor.execute("DROP INDEX if exists idx_states_error_count")
+            cursor.execute("DROP INDEX if exists idx_states_processor")
+            self._create_state_indexes(cursor)
+            self.update_config(SCHEMA_VERSION, 7)
+        if version < 8:
+            # Created without incremental auto vacuum, compact() releases nothing until converted once
+            if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                self._vacuum(cursor)
+            self.update_config(SCHEMA_VERSION, 8)
+
+    def _has_legacy_paths(self, cursor):
+        # Before version 5 each state held its full paths
+        return 'local_path' in self._get_columns(cursor, 'States')
+
+    def _migrate_state_paths(self, cursor):
+        cursor.execute("ALTER TABLE States RENAME TO StatesMigration")
+        self._create_state_table(cursor, force=True)
+        source_cols = self._get_columns(cursor, 'StatesMigration')
+        cols = [col for col in self._get_columns(cursor, 'States') if col in source_cols]
+        query = ("INSERT INTO States(" + ', '.join(cols) + ", local_parent_path_id, local_basename, remote_parent_path_id)"
+                 " VALUES(" + ', '.join('?' * (len(cols) + 3)) + ")")
+        rows = cursor.connection.cursor().execute("SELECT local_path, local_parent_path, remote_parent_path, "
+                                                  + ', '.join(cols) + " FROM StatesMigration")
+        for row in rows:
+            local_parent_path_id, local_basename = self._get_local_path_ids(cursor, row[0], row[1])
+            remote_parent_path_id = self._get_path_id(cursor, 'RemotePaths', row[2])
+            cursor.execute(query, tuple(row)[3:] + (local_parent_path_id, local_basename, remote_parent_path_id))
+        cursor.execute("DROP TABLE StatesMigration")
 
     def _reinit_database(self):
         self.reinit_states()
@@ -547,27 +1185,137 @@ class EngineDAO(ConfigurationDAO):
             statement = 'if not exists '
         # Cannot force UNIQUE for local_path as duplicate can have virtual the same path until they are resolved by Processor
         # Should improve that
+        # Paths are interned in LocalPaths and RemotePaths: a state only holds the id of its parent folder path and
+        # its local basename, see _select_states for the path columns
         cursor.execute("CREATE TABLE "+statement+"States(id INTEGER NOT NULL, last_local_updated TIMESTAMP,"
-          + "last_remote_updated TIMESTAMP, local_digest VARCHAR, remote_digest VARCHAR, local_path VARCHAR,"
-          + "remote_ref VARCHAR, local_parent_path VARCHAR, remote_parent_ref VARCHAR, remote_parent_path VARCHAR,"
+          + "last_remote_updated TIMESTAMP, local_digest VARCHAR, remote_digest VARCHAR, local_basename VARCHAR,"
+          + "remote_ref VARCHAR, local_parent_path_id INTEGER, remote_parent_ref VARCHAR, remote_parent_path_id INTEGER,"
           + "local_name VARCHAR, remote_name VARCHAR, size INTEGER DEFAULT (0), folderish INTEGER, local_state VARCHAR DEFAULT('unknown'), remote_state VARCHAR DEFAULT('unknown'),"
           + "pair_state VARCHAR DEFAULT('unknown'), remote_can_rename INTEGER, remote_can_delete INTEGER, remote_can_update INTEGER,"
           + "remote_can_create_child INTEGER, last_remote_modifier VARCHAR,"
           + "last_sync_date TIMESTAMP, error_count INTEGER DEFAULT (0), last_sync_error_date TIMESTAMP, last_error VARCHAR, last_error_details TEXT, version INTEGER DEFAULT (0), processor INTEGER DEFAULT (0), last_transfer VARCHAR, PRIMARY KEY (id),"
-          +  "UNIQUE(remote_ref, remote_parent_ref), UNIQUE(remote_ref, local_path));")
+          +  "UNIQUE(remote_ref, remote_parent_ref), UNIQUE(remote_ref, local_parent_path_id, local_basename));")
+
+    @staticmethod
+    def _create_paths_tables(cursor):
+        cursor.execute("CREATE TABLE if not exists LocalPaths(id INTEGER NOT NULL, path VARCHAR NOT NULL, PRIMARY KEY(id), UNIQUE(path))")
+        cursor.execute("CREATE TABLE if not exists RemotePaths(id INTEGER NOT NULL, path VARCHAR NOT NULL, PRIMARY KEY(id), UNIQUE(path))")
+
+    def _create_state_indexes(self, cursor):
+        # Every watchdog event, scanned folder or queued pair goes through
+        # one of those lookups, without them each is a full scan of States
+        cursor.execute("CREATE INDEX if not exists idx_states_local_path ON States(local_parent_path_id, local_basename)")
+        cursor.execute("CREATE INDEX if not exists idx_states_remote_parent_path ON States(remote_parent_path_id)")
+        cursor.execute("CREATE INDEX if not exists idx_states_remote_parent_ref ON States(remote_parent_ref, remote_name)")
+        cursor.execute("CREATE INDEX if not exists idx_states_remote_digest ON States(remote_digest, pair_state)")
+        cursor.execute("CREATE INDEX if not exists idx_states_pair_state ON States(pair_state, folderish, last_sync_date)")
+        cursor.execute("CREATE INDEX if not exists idx_states_last_sync_date ON States(last_sync_date)")
+        if sqlite3.sqlite_version_info >= (3, 9, 0):
+            # Suffix lookup of get_first_state_from_partial_remote
+            cursor.execute("CREATE INDEX if not exists idx_states_remote_ref_suffix ON States("
+                           + self._remote_ref_suffix + ")")
+        if sqlite3.sqlite_version_info >= (3, 8, 0):
+            # Partial indexes on the hot pairs, not synchronized, in error or
+            # being processed: their size does not depend on the tree size.
+            # They are only used by the planner for queries embedding their
+            # condition as is.
+            cursor.execute("CREATE INDEX if not exists idx_states_hot ON States(pair_state) WHERE "
+                           + self._get_hot_condition())
+            cursor.execute("CREATE INDEX if not exists idx_states_errors ON States(error_count) WHERE "
+                           + self._get_error_condition())
+            cursor.execute("CREATE INDEX if not exists idx_states_processing ON States(processor) WHERE processor != 0")
+        else:
+            cursor.execute("CREATE INDEX if not exists idx_states_errors ON States(error_count)")
+            cursor.execute("CREATE INDEX if not exists idx_states_processing ON States(processor)")
+
+    def _create_state_counts(self, cursor):
+        # Number and size of the states by bucket, kept exact by the triggers
+        # so the status counts do not go through the whole States table
+        cursor.execute("CREATE TABLE if not exists StatesCounts(pair_state VARCHAR NOT NULL, folderish INTEGER NOT NULL,"
+                       " errors INTEGER NOT NULL, count INTEGER NOT NULL, size INTEGER NOT NULL,"
+                       " PRIMARY KEY(pair_state, folderish, errors))")
+        bucket = ("IFNULL({0}.pair_state, ''), IFNULL({0}.folderish, -1),"
+                  " MIN(IFNULL({0}.error_count, 0), " + str(MAX_ERROR_BUCKET) + ")")
+        match = "(pair_state, folderish, errors) = (" + bucket + ")"
+        if sqlite3.sqlite_version_info < (3, 15, 0):
+            # No row values
+            match = ("pair_state = IFNULL({0}.pair_state, '') AND folderish = IFNULL({0}.folderish, -1)"
+                     " AND errors = MIN(IFNULL({0}.error_count, 0), " + str(MAX_ERROR_BUCKET) + ")")
+        add = ("INSERT OR IGNORE INTO StatesCounts(pair_state, folderish, errors, count, size)"
+               " VALUES(" + bucket + ", 0, 0);"
+               " UPDATE StatesCounts SET count = count + 1, size = size + IFNULL({0}.size, 0) WHERE " + match + ";")
+        remove = ("UPDATE StatesCounts SET count = count - 1, size = size - IFNULL({0}.size, 0)"
+                  " WHERE " + match + ";")
+        cursor.execute("CREATE TRIGGER if not exists states_counts_insert AFTER INSERT ON States"
+                       " BEGIN " + add.format('NEW') + " END")
+        cursor.execute("CREATE TRIGGER if not exists states_counts_delete AFTER DELETE ON States"
+                       " BEGIN " + remove.format('OLD') + " END")
+        cursor.execute("CREATE TRIGGER if not exists states_counts_update"
+                       " AFTER UPDATE OF pair_state, folderish, error_count, size ON States"
+                       " WHEN OLD.pair_state IS NOT NEW.pair_state OR OLD.folderish IS NOT NEW.folderish"
+                       " OR OLD.error_count IS NOT NEW.error_count OR OLD.size IS NOT NEW.size"
+                       " BEGIN " + remove.format('OLD') + " " + add.format('NEW') + " END")
+
+    def _get_state_counts_query(self):
+        return ("SELECT IFNULL(pair_state, ''), IFNULL(folderish, -1),"
+                " MIN(IFNULL(error_count, 0), " + str(MAX_ERROR_BUCKET) + "), COUNT(*), IFNULL(SUM(size), 0)"
+                " FROM States GROUP BY 1, 2, 3")
+
+    def _rebuild_state_counts(self, cursor):
+        cursor.execute("DELETE FROM StatesCounts")
+        cursor.execute("INSERT INTO StatesCounts(pair_state, folderish, errors, count, size) "
+                       + self._get_state_counts_query())
+
+    def check_state_counts(self):
+        """
+        Compare the maintained counts to the States content, fix them if needed.
+
+        :return: True if the counts were exact
+        """
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            expected = set(tuple(row) for row in c.execute(self._get_state_counts_query()))
+            current = set(tuple(row) for row in c.execute("SELECT pair_state, folderish, errors, count, size"
+                                                          " FROM StatesCounts WHERE count != 0 OR size != 0"))
+            if expected == current:
+                return True
+            log.warning("Inconsistent states counts, rebuilding them: %r instead of %r",
+                        sorted(current - expected), sorted(expected - current))
+            self._rebuild_state_counts(c)
+            self._commit_write(con)
+            return False
+        finally:
+            self._lock.release()
 
     def _init_db(self, cursor):
         super(EngineDAO, self)._init_db(cursor)
         cursor.execute("CREATE TABLE if not exists Filters(path STRING NOT NULL, PRIMARY KEY(path))")
         cursor.execute("CREATE TABLE if not exists RemoteScan(path STRING NOT NULL, PRIMARY KEY(path))")
         cursor.execute("CREATE TABLE if not exists ToRemoteScan(path STRING NOT NULL, PRIMARY KEY(path))")
+        self._create_paths_tables(cursor)
         self._create_state_table(cursor)
+        if not self._has_legacy_paths(cursor):
+            # A legacy table gets its indexes and counts once migrated
+            self._create_state_indexes(cursor)
+            self._create_state_counts(cursor)
 
     def _get_read_connection(self, factory=None):
         if factory is None:
             factory = self._state_factory
         return super(EngineDAO, self)._get_read_connection(factory)
 
+    def _committed(self):
+        if self._state_cache is not None:
+            self._state_cache.clear()
+
+    def get_metrics(self):
+        metrics = super(EngineDAO, self).get_metrics()
+        if self._state_cache is not None:
+            metrics.update(self._state_cache.get_metrics())
+        return metrics
+
     def acquire_state(self, thread_id, row_id):
         if self.acquire_processor(thread_id, row_id):
             # Avoid any lock for this call by using the write connection
@@ -587,9 +1335,8 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             # TO_REVIEW Might go back to primary key id
-            c.execute("UPDATE States SET processor=0 WHERE processor=?", (processor_id,))
-            if self.auto_commit:
-                con.commit()
+            c.execute("UPDATE States SET processor=0 WHERE processor != 0 AND processor=?", (processor_id,))
+            self._commit_write(con)
         finally:
             self._lock.release()
         res = c.rowcount > 0
@@ -605,8 +1352,7 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("UPDATE States SET processor=? WHERE id=? AND (processor=0 OR processor=?)", (thread_id, row_id, thread_id))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
         res = c.rowcount == 1
@@ -620,6 +1366,11 @@ class EngineDAO(ConfigurationDAO):
     def _reinit_states(self, cursor):
         cursor.execute("DROP TABLE States")
         self._create_state_table(cursor, force=True)
+        self._create_state_indexes(cursor)
+        self._create_state_counts(cursor)
+        cursor.execute("DELETE FROM StatesCounts")
+        cursor.execute("DELETE FROM LocalPaths")
+        cursor.execute("DELETE FROM RemotePaths")
         self._delete_config(cursor, "remote_last_sync_date")
         self._delete_config(cursor, "remote_last_event_log_id")
         self._delete_config(cursor, "remote_last_event_last_root_definitions")
@@ -633,24 +1384,20 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             self._reinit_states(c)
             con.commit()
-            log.trace("Vacuum sqlite")
-            con.execute("VACUUM")
-            log.trace("Vacuum sqlite finished")
         finally:
             self._lock.release()
+        self._committed()
 
     def reinit_processors(self):
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            c.execute("UPDATE States SET processor=0")
-            c.execute("UPDATE States SET error_count=0, last_sync_error_date=NULL, last_error = NULL WHERE pair_state='synchronized'")
-            if self.auto_commit:
-                con.commit()
-            log.trace("Vacuum sqlite")
-            con.execute("VACUUM")
-            log.trace("Vacuum sqlite finished")
+            c.execute("UPDATE States SET processor=0 WHERE processor != 0")
+            # The unary + keeps the planner on the small errors index
+            c.execute("UPDATE States SET error_count=0, last_sync_error_date=NULL, last_error = NULL"
+                      " WHERE +pair_state='synchronized' AND " + self._get_error_condition())
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -662,11 +1409,12 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET remote_state='deleted', pair_state=?"
             c.execute(update + " WHERE id=?", ('remotely_deleted', doc_pair.id))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_remote_condition(doc_pair), ('parent_remotely_deleted',))
+                condition, params = self._get_recursive_remote_condition(doc_pair)
+                c.execute(update + condition, ('parent_remotely_deleted',) + params)
             # Only queue parent
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, 'remotely_deleted')
-            if self.auto_commit:
-                con.commit()
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, 'remotely_deleted',
+                                   remote_ref=doc_pair.remote_ref)
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -677,7 +1425,8 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             # Check parent to see current pair state
-            parent = c.execute("SELECT * FROM States WHERE local_path=?", (doc_pair.local_parent_path,)).fetchone()
+            condition, params = self._get_local_path_condition(doc_pair.local_parent_path)
+            parent = c.execute(self._select_states + " WHERE " + condition, params).fetchone()
             if parent is not None and (parent.pair_state == 'locally_deleted' or parent.pair_state == 'parent_locally_deleted'):
                 current_state = 'parent_locally_deleted'
             else:
@@ -685,15 +1434,16 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET local_state='deleted', pair_state=?"
             c.execute(update + " WHERE id=?", (current_state, doc_pair.id))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair), ('parent_locally_deleted',))
-            if self.auto_commit:
-                con.commit()
+                condition, params = self._get_recursive_condition(doc_pair)
+                c.execute(update + condition, ('parent_locally_deleted',) + params)
+            self._commit_write(con)
         finally:
             self._lock.release()
             self._queue_manager.interrupt_processors_on(doc_pair.local_path, exact_match=False)
             # Only queue parent
             if current_state is not None and current_state == "locally_deleted":
-                self._queue_pair_state(doc_pair.id, doc_pair.folderish, current_state)
+                self._queue_pair_state(doc_pair.id, doc_pair.folderish, current_state,
+                                       remote_ref=doc_pair.remote_ref)
 
     def insert_local_state(self, info, parent_path):
         pair_state = PAIR_STATES.get(('created', 'unknown'))
@@ -703,18 +1453,18 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             name = os.path.basename(info.path)
+            local_parent_path_id, local_basename = self._get_local_path_ids(c, info.path, parent_path)
             c.execute("INSERT INTO States(last_local_updated, local_digest, "
-                      + "local_path, local_parent_path, local_name, folderish, size, local_state, remote_state, pair_state)"
-                      + " VALUES(?,?,?,?,?,?,?,'created','unknown',?)", (info.last_modification_time, digest, info.path,
-                                                    parent_path, name, info.folderish, info.size, pair_state))
+                      + "local_basename, local_parent_path_id, local_name, folderish, size, local_state, remote_state, pair_state)"
+                      + " VALUES(?,?,?,?,?,?,?,'created','unknown',?)", (info.last_modification_time, digest, local_basename,
+                                                    local_parent_path_id, name, info.folderish, info.size, pair_state))
             row_id = c.lastrowid
-            parent = c.execute("SELECT * FROM States WHERE local_path=?", (parent_path,)).fetchone()
+            condition, params = self._get_local_path_condition(parent_path)
+            parent = c.execute(self._select_states + " WHERE " + condition, params).fetchone()
             # Dont queue if parent is not yet created
             if (parent is None and parent_path == '') or (parent is not None and parent.pair_state != "locally_created"):
-                self._queue_pair_state(row_id, info.folderish, pair_state)
-            if self.auto_commit:
-                con.commit()
-            self._items_count = self._items_count + 1
+                self._queue_pair_state(row_id, info.folderish, pair_state, size=info.size)
+            self._commit_write(con)
         finally:
             self._lock.release()
         return row_id
@@ -722,43 +1472,100 @@ class EngineDAO(ConfigurationDAO):
     def get_last_files(self, number, direction=''):
         c = self._get_read_connection(factory=self._state_factory).cursor()
         condition = ''
+        params = ()
         if direction == 'remote':
-            condition = 'AND last_transfer = "upload"'
+            condition = 'AND last_transfer = ?'
+            params = ('upload',)
         elif direction == 'local':
-            condition = 'AND last_transfer = "download"'
-        return c.execute('SELECT *'
-                         '  FROM States'
-                         ' WHERE pair_state = "synchronized"'
+            condition = 'AND last_transfer = ?'
+            params = ('download',)
+        return c.execute(self._select_states +
+                         " WHERE pair_state = 'synchronized'"
                          '   AND folderish = 0'
                          '       {}'
                          ' ORDER BY last_sync_date DESC'
-                         ' LIMIT {}'.format(condition, number)).fetchall()
+                         ' LIMIT ?'.format(condition), params + (number,)).fetchall()
 
     def _get_to_sync_condition(self):
-        return "pair_state != 'synchronized' AND pair_state != 'unsynchronized'"
+        return self._get_hot_condition() + " AND pair_state != 'unsynchronized'"
 
-    def register_queue_manager(self, manager):
-        # Prevent any update while init queue
+    @staticmethod
+    def _get_hot_condition():
+        return "pair_state != 'synchronized'"
+
+    @staticmethod
+    def _get_error_condition():
+        return "(error_count != 0 OR last_sync_error_date IS NOT NULL OR last_error IS NOT NULL)"
+
+    def register_queue_manager(self, manager, load=True):
         self._lock.acquire()
         try:
             self._queue_manager = manager
-            con = self._get_write_connection(factory=self._state_factory)
-            c = con.cursor()
-            # Order by path to be sure to process parents before childs
-            pairs = c.execute("SELECT * FROM States WHERE " + self._get_to_sync_condition() + " ORDER BY local_path ASC").fetchall()
-            folders = dict()
-            for pair in pairs:
-                # Add all the folders
-                if pair.folderish:
-                    folders[pair.local_path] = True
-                if pair.local_parent_path not in folders:
-                    self._queue_manager.push_ref(pair.id, pair.folderish, pair.pair_state)
-        # Dont block everything if queue manager fail
-        # TODO As the error should be fatal not sure we need this
         finally:
             self._lock.release()
+        if load:
+            self.load_queue()
+
+    def load_queue(self, chunk_size=QUEUE_LOAD_CHUNK):
+        """
+        Push the states to synchronize to the queue manager, by chunks of ids
+        read under the lock so the processors can start on the first ones.
+        The children of a folder to synchronize are left to its processing.
+
+        :return: the number of states pushed
+        """
+        condition = self._get_to_sync_condition()
+        self._lock.acquire()
+        try:
+            c = self._get_write_connection().cursor()
+            folders = set(row[0] for row in c.execute(
+                "SELECT " + self._local_path + " FROM States"
+                " LEFT JOIN LocalPaths lp ON lp.id = States.local_parent_path_id"
+                " WHERE " + condition + " AND folderish=1"))
+            pair_states = [row[0] for row in c.execute(
+                "SELECT DISTINCT pair_state FROM StatesCounts WHERE " + condition + " AND pair_state != ''"
+                " AND count > 0")]
+        finally:
+            self._lock.release()
+        count = 0
+        for pair_state in pair_states:
+            last_id = 0
+            while last_id is not None:
+                self._lock.acquire()
+                try:
+                    c = self._get_write_connection().cursor()
+                    # The size is unknown until there is a local file
+                    rows = c.execute("SELECT States.id, folderish, lp.path,"
+                                     " CASE WHEN local_state='unknown' THEN NULL ELSE size END, remote_ref FROM States"
+                                     " LEFT JOIN LocalPaths lp ON lp.id = States.local_parent_path_id"
+                                     " WHERE " + condition + " AND pair_state=? AND States.id > ?"
+                                     " ORDER BY States.id LIMIT ?", (pair_state, last_id, chunk_size)).fetchall()
+                    for row_id, folderish, local_parent_path, size, remote_ref in rows:
+                        if local_parent_path not in folders:
+                            self._queue_manager.push_ref(row_id, folderish, pair_state, size=size,
+                                                         remote_ref=remote_ref)
+                            count += 1
+                    last_id = rows[-1][0] if len(rows) == chunk_size else None
+                finally:
+                    self._lock.release()
+        log.debug("Loaded %d states in the queue", count)
+        return count
 
-    def _queue_pair_state(self, row_id, folderish, pair_state, pair=None):
+    @staticmethod
+    def _get_queue_size(row):
+        """ Size of the file of a pair, None until there is a local file. """
+        return None if row.local_state == 'unknown' else row.size
+
+    def _queue_pair_state(self, row_id, folderish, pair_state, pair=None, size=None, remote_ref=None):
+        batch = self._get_batch()
+        if batch is not None:
+            # The processors must not see the row before the batch commit
+            batch.defer(self._push_pair_state, row_id, folderish, pair_state, pair=pair, size=size,
+                        remote_ref=remote_ref)
+        else:
+            self._push_pair_state(row_id, folderish, pair_state, pair=pair, size=size, remote_ref=remote_ref)
+
+    def _push_pair_state(self, row_id, folderish, pair_state, pair=None, size=None, remote_ref=None):
         if (self._queue_manager is not None
                 and pair_state not in ('synchronized', 'unsynchronized')):
             if pair_state == 'conflicted':
@@ -766,7 +1573,7 @@ class EngineDAO(ConfigurationDAO):
                 self.newConflict.emit(row_id)
             else:
                 log.trace("Push to queue: %s, pair=%r", pair_state, pair)
-                self._queue_manager.push_ref(row_id, folderish, pair_state)
+                self._queue_manager.push_ref(row_id, folderish, pair_state, size=size, remote_ref=remote_ref)
         else:
             log.trace("Will not push pair: %s, pair=%r", pair_state, pair)
 
@@ -779,14 +1586,13 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("UPDATE States SET last_transfer=? WHERE id=?", (transfer, row_id))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
     def get_dedupe_pair(self, name, parent, row_id):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE id != ? AND local_name=? AND remote_parent_ref=?",
+        return c.execute(self._select_states + " WHERE States.id != ? AND local_name=? AND remote_parent_ref=?",
                                     (row_id, name, parent)).fetchone()
 
     def remove_local_path(self, row_id):
@@ -794,9 +1600,8 @@ class EngineDAO(ConfigurationDAO):
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            c.execute("UPDATE States SET local_path='' WHERE id=?", (row_id,))
-            if self.auto_commit:
-                con.commit()
+            c.execute("UPDATE States SET local_basename='' WHERE id=?", (row_id,))
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -804,9 +1609,7 @@ class EngineDAO(ConfigurationDAO):
         row.pair_state = self._get_pair_state(row)
         log.trace('Updating local state for row=%r with info=%r', row, info)
 
-        version = ''
         if versionned:
-            version = ', version = version + 1'
             log.trace('Increasing version to %d for pair %r',
                       row.version + 1, row)
 
@@ -815,41 +1618,41 @@ class EngineDAO(ConfigurationDAO):
         try:
             con = self._get_write_connection()
             c = con.cursor()
+            local_parent_path_id, local_basename = self._get_local_path_ids(c, info.path, parent_path)
             c.execute('UPDATE States'
                       '   SET last_local_updated = ?,'
                       '       local_digest = ?,'
-                      '       local_path = ?,'
-                      '       local_parent_path = ?,'
+                      '       local_basename = ?,'
+                      '       local_parent_path_id = ?,'
                       '       local_name = ?,'
                       '       local_state = ?,'
                       '       size = ?,'
                       '       remote_state = ?,'
-                      '       pair_state = ?'
-                      '       {version}'
-                      ' WHERE id = ?'.format(version=version),
+                      '       pair_state = ?,'
+                      '       version = version + ?'
+                      ' WHERE id = ?',
                       (
                           info.last_modification_time,
                           row.local_digest,
-                          info.path,
-                          parent_path,
+                          local_basename,
+                          local_parent_path_id,
                           os.path.basename(info.path),
                           row.local_state,
                           info.size,
                           row.remote_state,
                           row.pair_state,
+                          int(versionned),
                           row.id,
                       ))
             if queue:
-                parent = c.execute('SELECT *'
-                                   '  FROM States'
-                                   ' WHERE local_path = ?',
-                                   (parent_path,)).fetchone()
+                condition, params = self._get_local_path_condition(parent_path)
+                parent = c.execute(self._select_states + ' WHERE ' + condition, params).fetchone()
                 # Don't queue if parent is not yet created
                 if ((not parent and not parent_path)
                         or (parent and parent.local_state != 'created')):
-                    self._queue_pair_state(row.id, info.folderish, row.pair_state, pair=row)
-            if self.auto_commit:
-                con.commit()
+                    self._queue_pair_state(row.id, info.folderish, row.pair_state, pair=row, size=info.size,
+                                           remote_ref=row.remote_ref)
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -858,40 +1661,49 @@ class EngineDAO(ConfigurationDAO):
 
     def get_valid_duplicate_file(self, digest):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_digest=? AND pair_state='synchronized'", (digest,)).fetchone()
+        return c.execute(self._select_states + " WHERE remote_digest=? AND pair_state='synchronized'", (digest,)).fetchone()
 
     def get_remote_descendants(self, path):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_path LIKE ?", (path + '%',)).fetchall()
+        return c.execute(self._select_states + " WHERE remote_parent_path_id IN"
+                         " (SELECT id FROM RemotePaths WHERE path >= ? AND path < ?)",
+                         self._get_prefix_range(path)).fetchall()
 
     def get_remote_descendants_from_ref(self, ref):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_path LIKE ?", ('%' + ref + '%',)).fetchall()
+        # The folder paths recorded by the children of ref, then the paths under them by index range
+        return c.execute(self._select_states + " WHERE remote_parent_path_id IN"
+                         " (SELECT d.id FROM RemotePaths p, RemotePaths d WHERE p.id IN"
+                         "   (SELECT remote_parent_path_id FROM States WHERE remote_parent_ref=?)"
+                         "  AND (d.path = p.path OR (d.path >= p.path || '/' AND d.path < p.path || '0')))",
+                         (ref,)).fetchall()
 
     def get_remote_children(self, ref):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_ref=?", (ref,)).fetchall()
+        return c.execute(self._select_states + " WHERE remote_parent_ref=?", (ref,)).fetchall()
 
     def get_new_remote_children(self, ref):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_ref=? AND remote_state='created' AND local_state='unknown'", (ref,)).fetchall()
+        return c.execute(self._select_states + " WHERE remote_parent_ref=? AND remote_state='created' AND local_state='unknown'", (ref,)).fetchall()
 
     def get_unsynchronized_count(self):
-        return self.get_count("pair_state='unsynchronized'")
+        return self._get_state_count("pair_state='unsynchronized'")
 
     def get_conflict_count(self):
-        return self.get_count("pair_state='conflicted'")
+        return self._get_state_count("pair_state='conflicted'")
 
     def get_error_count(self, threshold=3):
-        return self.get_count("error_count > " + str(threshold))
+        if threshold >= MAX_ERROR_BUCKET:
+            return self.get_count(self._get_error_condition() + " AND error_count > ?", (threshold,))
+        return self._get_state_count("errors > ?", (threshold,))
 
     def get_syncing_count(self, threshold=3):
-        query = "pair_state!='synchronized' AND pair_state!='conflicted' AND pair_state!='unsynchronized' AND error_count < " + str(threshold)
-        count = self.get_count(query)
-        if self._items_count is not None and count != self._items_count:
-            log.trace("Cache Syncing count incorrect should be %d was %d", count, self._items_count)
-            self._items_count = count
-        return count
+        if threshold > MAX_ERROR_BUCKET:
+            # Keep the to sync condition as is so the partial index is used
+            query = self._get_to_sync_condition() + " AND pair_state != 'conflicted' AND error_count < ?"
+            return self.get_count(query, (threshold,))
+        return self._get_state_count(self._get_to_sync_condition() + " AND pair_state != 'conflicted'"
+                                     " AND pair_state != '' AND errors < ?", (threshold,))
 
     def get_sync_count(self, filetype=None):
         query = "pair_state='synchronized'"
@@ -899,43 +1711,94 @@ class EngineDAO(ConfigurationDAO):
             query = query + " AND folderish=0"
         elif filetype == "folder":
             query = query + " AND folderish=1"
-        return self.get_count(query)
+        return self._get_state_count(query)
 
-    def get_count(self, condition=None):
+    def _get_state_count(self, condition, params=()):
+        c = self._get_read_connection(factory=self._state_factory).cursor()
+        return c.execute("SELECT IFNULL(SUM(count), 0) FROM StatesCounts WHERE " + condition, params).fetchone()[0]
+
+    def get_count(self, condition=None, params=()):
         query = "SELECT COUNT(*) as count FROM States"
         if condition is not None:
             query = query + " WHERE " + condition
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute(query).fetchone().count
+        return c.execute(query, params).fetchone().count
 
     def get_global_size(self):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT SUM(size) as sum FROM States WHERE pair_state='synchronized'").fetchone().sum
+        return c.execute("SELECT SUM(size) as sum FROM StatesCounts"
+                         " WHERE pair_state='synchronized' AND count > 0").fetchone().sum
 
     def get_unsynchronizeds(self):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE pair_state='unsynchronized'").fetchall()
+        return c.execute(self._select_states + " WHERE " + self._get_hot_condition()
+                         + " AND pair_state='unsynchronized'").fetchall()
 
     def get_conflicts(self):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE pair_state='conflicted'").fetchall()
+        return c.execute(self._select_states + " WHERE " + self._get_hot_condition()
+                         + " AND pair_state='conflicted'").fetchall()
 
     def get_errors(self, limit=3):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE error_count>?", (limit,)).fetchall()
+        return c.execute(self._select_states + " WHERE " + self._get_error_condition() + " AND error_count>?",
+                         (limit,)).fetchall()
 
     def get_local_children(self, path):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE local_parent_path=?", (path,)).fetchall()
+        return c.execute(self._select_states + " WHERE local_parent_path_id = (SELECT id FROM LocalPaths WHERE path=?)",
+                         (path,)).fetchall()
 
     def get_states_from_partial_local(self, path):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE local_path LIKE ?", (path + '%',)).fetchall()
+        # Either the parent path starts with the given path, or it is the
+        # parent of the given path and the basename starts with the remaining
+        parent, name = self._split_local_path(path)
+        return c.execute(self._select_states +
+                         " WHERE local_parent_path_id IN (SELECT id FROM LocalPaths WHERE path >= ? AND path < ?)"
+                         "    OR (local_parent_path_id = (SELECT id FROM LocalPaths WHERE path=?)"
+                         "        AND local_basename >= ? AND local_basename < ?)",
+                         self._get_prefix_range(path) + (parent,) + self._get_prefix_range(name)).fetchall()
 
     def get_first_state_from_partial_remote(self, ref):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_ref LIKE ? ORDER BY last_remote_updated ASC LIMIT 1",
-                         ('%' + ref,)).fetchone()
+        if sqlite3.sqlite_version_info < (3, 9, 0):
+            return c.execute(self._select_states + " WHERE remote_ref LIKE ? ORDER BY last_remote_updated ASC LIMIT 1",
+                             ('%' + ref,)).fetchone()
+        # Narrowed by the last part of the ref through its index
+        return c.execute(self._select_states + " WHERE " + self._remote_ref_suffix + " = ? AND remote_ref LIKE ?"
+                         " ORDER BY last_remote_updated ASC LIMIT 1", (ref.rsplit('#', 1)[-1], '%' + ref)).fetchone()
+
+    def get_normal_states_from_remote(self, refs):
+        """ Bulk get_normal_state_from_remote(), return the states by remote_ref. """
+        states = dict()
+        refs = list(refs)
+        c = self._get_read_connection(factory=self._state_factory).cursor()
+        for i in range(0, len(refs), MAX_IN_VALUES):
+            chunk = refs[i:i + MAX_IN_VALUES]
+            rows = c.execute(self._select_states + " WHERE remote_ref IN (" + ",".join("?" * len(chunk)) + ")",
+                             chunk).fetchall()
+            for row in rows:
+                states.setdefault(row.remote_ref, row)
+        return states
+
+    def get_states_from_local_paths(self, paths):
+        """ Bulk get_state_from_local(), return the states by local_path. """
+        states = dict()
+        paths = list(paths)
+        c = self._get_read_connection(factory=self._state_factory).cursor()
+        for i in range(0, len(paths), MAX_IN_VALUES // 2):
+            chunk = paths[i:i + MAX_IN_VALUES // 2]
+            parents = set(self._split_local_path(path)[0] for path in chunk)
+            names = set(self._split_local_path(path)[1] for path in chunk)
+            rows = c.execute(self._select_states + " WHERE local_parent_path_id IN"
+                             " (SELECT id FROM LocalPaths WHERE path IN (" + ",".join("?" * len(parents)) + "))"
+                             " AND local_basename IN (" + ",".join("?" * len(names)) + ")",
+                             list(parents) + list(names)).fetchall()
+            for row in rows:
+                if row.local_path in chunk:
+                    states[row.local_path] = row
+        return states
 
     def get_normal_state_from_remote(self, ref):
         # TODO Select the only states that is not a collection
@@ -949,11 +1812,19 @@ class EngineDAO(ConfigurationDAO):
         if path == '/':
             path = ""
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_ref=? AND remote_parent_path=?", (ref,path)).fetchone()
+        return c.execute(self._select_states + " WHERE remote_ref=?"
+                         " AND remote_parent_path_id = (SELECT id FROM RemotePaths WHERE path=?)", (ref, path)).fetchone()
 
     def get_states_from_remote(self, ref):
+        if self._state_cache is None or self._reads_uncommitted():
+            return self._get_states_from_remote(ref)
+        values = self._state_cache.get(('remote', ref), lambda: [
+            state._values() for state in self._get_states_from_remote(ref)])
+        return [DocPair(state) for state in values]
+
+    def _get_states_from_remote(self, ref):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_ref=?", (ref,)).fetchall()
+        return c.execute(self._select_states + " WHERE remote_ref=?", (ref,)).fetchall()
 
     def get_state_from_id(self, row_id, from_write=False):
         # Dont need to read from write as auto_commit is True
@@ -965,25 +1836,98 @@ class EngineDAO(ConfigurationDAO):
                 c = self._get_write_connection(factory=self._state_factory).cursor()
             else:
                 c = self._get_read_connection(factory=self._state_factory).cursor()
-            state = c.execute("SELECT * FROM States WHERE id=?", (row_id,)).fetchone()
+            state = c.execute(self._select_states + " WHERE States.id=?", (row_id,)).fetchone()
         finally:
             if from_write:
                 self._lock.release()
         return state
 
     def _get_recursive_condition(self, doc_pair):
-        res = (" WHERE (local_parent_path LIKE '" + self._escape(doc_pair.local_path) + "/%'"
-                    + " OR local_parent_path = '" + self._escape(doc_pair.local_path) + "')")
+        res = (" WHERE local_parent_path_id IN"
+               " (SELECT id FROM LocalPaths WHERE path = ? OR (path >= ? AND path < ?))")
+        params = (doc_pair.local_path,) + self._get_prefix_range(doc_pair.local_path + '/')
         if doc_pair.remote_ref is not None:
-            res += " AND remote_parent_path LIKE '" + self._escape(doc_pair.remote_parent_path +
-                    '/' + doc_pair.remote_ref) + "%'"
-        return res
+            res += " AND remote_parent_path_id IN (SELECT id FROM RemotePaths WHERE path >= ? AND path < ?)"
+            params += self._get_prefix_range(doc_pair.remote_parent_path + '/' + doc_pair.remote_ref)
+        return res, params
 
     def _get_recursive_remote_condition(self, doc_pair):
-        remote_path = (self._escape(doc_pair.remote_parent_path)
-                       + '/' + self._escape(doc_pair.remote_name))
-        return (' WHERE remote_parent_path LIKE "{0}/%"'
-                '       OR remote_parent_path = "{0}"').format(remote_path)
+        remote_path = doc_pair.remote_parent_path + '/' + doc_pair.remote_name
+        return (" WHERE remote_parent_path_id IN"
+                " (SELECT id FROM RemotePaths WHERE path = ? OR (path >= ? AND path < ?))",
+                (remote_path,) + self._get_prefix_range(remote_path + '/'))
+
+    def _get_path_id(self, cursor, table, path):
+        """ Return the id of the interned path, interning it if needed. """
+        if path is None:
+            return None
+        row = cursor.execute("SELECT id FROM " + table + " WHERE path=?", (path,)).fetchone()
+        if row is not None:
+            return row[0]
+        cursor.execute("INSERT INTO " + table + "(path) VALUES(?)", (path,))
+        return cursor.lastrowid
+
+    def _get_local_path_ids(self, cursor, local_path, local_parent_path):
+        """ Return the parent path id and the basename a local path is stored as. """
+        if not local_path:
+            # No local path, keep track of the parent anyway
+            return self._get_path_id(cursor, 'LocalPaths', local_parent_path), local_path
+        parent, name = self._split_local_path(local_path)
+        return self._get_path_id(cursor, 'LocalPaths', parent), name
+
+    def _get_local_path_condition(self, path):
+        parent, name = self._split_local_path(path)
+        return ("local_parent_path_id = (SELECT id FROM LocalPaths WHERE path=?) AND local_basename=?",
+                (parent, name))
+
+    @staticmethod
+    def _split_local_path(path):
+        """ Split a local path into its parent path and basename, reverse of the local_path column. """
+        if not path or path == '/' or '/' not in path:
+            return '', path
+        parent, name = path.rsplit('/', 1)
+        return parent or '/', name
+
+    @staticmethod
+    def _get_prefix_range(prefix):
+        """ Bounds of the strings starting with prefix, unlike LIKE they can use an index. """
+        if isinstance(prefix, str):
+            prefix = prefix.decode('utf-8')
+        if not prefix:
+            return u'', u'\U0010ffff'
+        return prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+    def _move_paths(self, cursor, table, path, new_path):
+        """
+        Move an interned path and its sub paths. Only the folders paths are
+        rewritten, the states under them keep the same parent path ids.
+        """
+        column = 'local_parent_path_id' if table == 'LocalPaths' else 'remote_parent_path_id'
+        paths = cursor.execute("SELECT id, path FROM " + table + " WHERE path = ? OR (path >= ? AND path < ?)",
+                               (path,) + self._get_prefix_range(path + '/')).fetchall()
+        for path_id, old_path in paths:
+            target = new_path + old_path[len(path):]
+            existing = cursor.execute("SELECT id FROM " + table + " WHERE path=?", (target,)).fetchone()
+            if existing is None:
+                cursor.execute("UPDATE " + table + " SET path=? WHERE id=?", (target, path_id))
+            else:
+                # Already interned: merge the states on it
+                cursor.execute("UPDATE States SET " + column + "=? WHERE " + column + "=?", (existing[0], path_id))
+                cursor.execute("DELETE FROM " + table + " WHERE id=?", (path_id,))
+
+    def clean_paths(self):
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            # One index lookup by folder path rather than reading all the states
+            c.execute("DELETE FROM LocalPaths WHERE NOT EXISTS"
+                      " (SELECT 1 FROM States WHERE local_parent_path_id = LocalPaths.id)")
+            c.execute("DELETE FROM RemotePaths WHERE NOT EXISTS"
+                      " (SELECT 1 FROM States WHERE remote_parent_path_id = RemotePaths.id)")
+            self._commit_write(con)
+        finally:
+            self._lock.release()
 
     def update_remote_parent_path(self, doc_pair, new_path):
         self._lock.acquire()
@@ -991,15 +1935,11 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             if doc_pair.folderish:
-                remote_path = doc_pair.remote_parent_path + "/" + doc_pair.remote_ref
-                query = "UPDATE States SET remote_parent_path='%s/%s' || substr(remote_parent_path,%d)" % (
-                    self._escape(new_path), self._escape(doc_pair.remote_ref), len(remote_path) + 1)
-                query = query + self._get_recursive_remote_condition(doc_pair)
-                log.trace("Update remote_parent_path: " + query)
-                c.execute(query)
-            c.execute("UPDATE States SET remote_parent_path=? WHERE id=?", (new_path, doc_pair.id))
-            if self.auto_commit:
-                con.commit()
+                self._move_paths(c, 'RemotePaths', doc_pair.remote_parent_path + '/' + doc_pair.remote_ref,
+                                 new_path + '/' + doc_pair.remote_ref)
+            c.execute("UPDATE States SET remote_parent_path_id=? WHERE id=?",
+                      (self._get_path_id(c, 'RemotePaths', new_path), doc_pair.id))
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -1008,9 +1948,11 @@ class EngineDAO(ConfigurationDAO):
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            c.execute("UPDATE States SET local_parent_path=?, local_path=? WHERE id=?", (doc_pair.local_parent_path, doc_pair.local_path, doc_pair.id))
-            if self.auto_commit:
-                con.commit()
+            local_parent_path_id, local_basename = self._get_local_path_ids(c, doc_pair.local_path,
+                                                                            doc_pair.local_parent_path)
+            c.execute("UPDATE States SET local_parent_path_id=?, local_basename=? WHERE id=?",
+                      (local_parent_path_id, local_basename, doc_pair.id))
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -1022,17 +1964,11 @@ class EngineDAO(ConfigurationDAO):
             if doc_pair.folderish:
                 if new_path == '/':
                     new_path = ''
-                escaped_new_path = self._escape(new_path)
-                escaped_new_name = self._escape(new_name)
-                query = ("UPDATE States SET local_parent_path='%s/%s' || substr(local_parent_path,%d), local_path='%s/%s' || substr(local_path,%d)" %
-                         (escaped_new_path, escaped_new_name, len(doc_pair.local_path) + 1,
-                          escaped_new_path, escaped_new_name, len(doc_pair.local_path)+1))
-                query = query + self._get_recursive_condition(doc_pair)
-                c.execute(query)
+                self._move_paths(c, 'LocalPaths', doc_pair.local_path, new_path + '/' + new_name)
             # Dont need to update the path as it is refresh later
-            c.execute("UPDATE States SET local_parent_path=? WHERE id=?", (new_path, doc_pair.id))
-            if self.auto_commit:
-                con.commit()
+            c.execute("UPDATE States SET local_parent_path_id=? WHERE id=?",
+                      (self._get_path_id(c, 'LocalPaths', new_path), doc_pair.id))
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -1044,10 +1980,11 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET local_digest=NULL, last_local_updated=NULL, local_name=NULL, remote_state='deleted', pair_state='remotely_deleted'"
             c.execute(update + " WHERE id=?", (doc_pair.id,))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
-            if self.auto_commit:
-                con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+                condition, params = self._get_recursive_condition(doc_pair)
+                c.execute(update + condition, params)
+            self._commit_write(con)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state,
+                                   size=self._get_queue_size(doc_pair), remote_ref=doc_pair.remote_ref)
         finally:
             self._lock.release()
 
@@ -1057,12 +1994,13 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             update = "UPDATE States SET local_digest=NULL, last_local_updated=NULL, local_name=NULL, remote_state='created', pair_state='remotely_created'"
-            c.execute(update + " WHERE id=" + str(doc_pair.id))
+            c.execute(update + " WHERE id=?", (doc_pair.id,))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
-            if self.auto_commit:
-                con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+                condition, params = self._get_recursive_condition(doc_pair)
+                c.execute(update + condition, params)
+            self._commit_write(con)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state,
+                                   size=self._get_queue_size(doc_pair), remote_ref=doc_pair.remote_ref)
         finally:
             self._lock.release()
 
@@ -1071,13 +2009,14 @@ class EngineDAO(ConfigurationDAO):
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            update = "UPDATE States SET remote_digest=NULL, remote_ref=NULL, remote_parent_ref=NULL, remote_parent_path=NULL, last_remote_updated=NULL, remote_name=NULL, remote_state='unknown', local_state='created', pair_state='locally_created'"
-            c.execute(update + " WHERE id=" + str(doc_pair.id))
+            update = "UPDATE States SET remote_digest=NULL, remote_ref=NULL, remote_parent_ref=NULL, remote_parent_path_id=NULL, last_remote_updated=NULL, remote_name=NULL, remote_state='unknown', local_state='created', pair_state='locally_created'"
+            c.execute(update + " WHERE id=?", (doc_pair.id,))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
-            if self.auto_commit:
-                con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+                condition, params = self._get_recursive_condition(doc_pair)
+                c.execute(update + condition, params)
+            self._commit_write(con)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state,
+                                   size=self._get_queue_size(doc_pair), remote_ref=doc_pair.remote_ref)
         finally:
             self._lock.release()
 
@@ -1089,17 +2028,28 @@ class EngineDAO(ConfigurationDAO):
             c.execute("DELETE FROM States WHERE id=?", (doc_pair.id,))
             if doc_pair.folderish:
                 if remote_recursion:
-                    c.execute("DELETE FROM States" + self._get_recursive_remote_condition(doc_pair))
+                    condition, params = self._get_recursive_remote_condition(doc_pair)
                 else:
-                    c.execute("DELETE FROM States" + self._get_recursive_condition(doc_pair))
-            if self.auto_commit:
-                con.commit()
+                    condition, params = self._get_recursive_condition(doc_pair)
+                c.execute("DELETE FROM States" + condition, params)
+            self._commit_write(con)
         finally:
             self._lock.release()
 
     def get_state_from_local(self, path):
+        if self._state_cache is None or self._reads_uncommitted():
+            return self._get_state_from_local(path)
+
+        def load():
+            state = self._get_state_from_local(path)
+            return state._values() if state is not None else None
+        values = self._state_cache.get(('local', path), load)
+        return DocPair(values) if values is not None else None
+
+    def _get_state_from_local(self, path):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE local_path=?", (path,)).fetchone()
+        condition, params = self._get_local_path_condition(path)
+        return c.execute(self._select_states + " WHERE " + condition, params).fetchone()
 
     def insert_remote_state(self, info, remote_parent_path, local_path, local_parent_path):
         pair_state = PAIR_STATES.get(('unknown','created'))
@@ -1107,38 +2057,103 @@ class EngineDAO(ConfigurationDAO):
         try:
             con = self._get_write_connection()
             c = con.cursor()
+            remote_parent_path_id = self._get_path_id(c, 'RemotePaths', remote_parent_path)
+            local_parent_path_id, local_basename = self._get_local_path_ids(c, local_path, local_parent_path)
             c.execute("INSERT INTO States (remote_ref, remote_parent_ref, " +
-                      "remote_parent_path, remote_name, last_remote_updated, remote_can_rename," +
+                      "remote_parent_path_id, remote_name, last_remote_updated, remote_can_rename," +
                       "remote_can_delete, remote_can_update, " +
                       "remote_can_create_child, last_remote_modifier, remote_digest," +
-                      "folderish, last_remote_modifier, local_path, local_parent_path, remote_state, local_state, pair_state, local_name)" +
+                      "folderish, last_remote_modifier, local_basename, local_parent_path_id, remote_state, local_state, pair_state, local_name)" +
                       " VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,'created','unknown',?, ?)",
-                      (info.uid, info.parent_uid, remote_parent_path, info.name,
+                      (info.uid, info.parent_uid, remote_parent_path_id, info.name,
                        info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
                        info.can_create_child, info.last_contributor, info.digest, info.folderish, info.last_contributor,
-                       local_path, local_parent_path, pair_state, info.name))
+                       local_basename, local_parent_path_id, pair_state, info.name))
             row_id = c.lastrowid
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
             # Check if parent is not in creation
-            parent = c.execute("SELECT * FROM States WHERE remote_ref=?", (info.parent_uid,)).fetchone()
+            parent = c.execute(self._select_states + " WHERE remote_ref=?", (info.parent_uid,)).fetchone()
             if (parent is None and local_parent_path == '') or (parent is not None and parent.pair_state != "remotely_created"):
-                self._queue_pair_state(row_id, info.folderish, pair_state)
-            self._items_count = self._items_count + 1
+                self._queue_pair_state(row_id, info.folderish, pair_state, remote_ref=info.uid)
         finally:
             self._lock.release()
         return row_id
 
+    def insert_remote_states(self, states):
+        """
+        Bulk insert_remote_state() in one statement, for a scroll page.
+
+        :param states: list of (info, remote_parent_path, local_path, local_parent_path)
+        :return: the ids of the inserted rows, by state, a duplicated one is only inserted once
+        """
+        if not states:
+            return []
+        pair_state = PAIR_STATES.get(('unknown', 'created'))
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            path_ids = dict()
+
+            def get_path_id(table, path):
+                if (table, path) not in path_ids:
+                    path_ids[(table, path)] = self._get_path_id(c, table, path)
+                return path_ids[(table, path)]
+
+            # Remote ref and parent are the unique key of the states: a scroll page can list a
+            # document twice, and a document can be under two parents
+            keys = set()
+            params = []
+            for info, remote_parent_path, local_path, local_parent_path in states:
+                if (info.uid, info.parent_uid) in keys:
+                    continue
+                keys.add((info.uid, info.parent_uid))
+                parent, name = local_parent_path, local_path
+                if local_path:
+                    parent, name = self._split_local_path(local_path)
+                params.append((info.uid, info.parent_uid, get_path_id('RemotePaths', remote_parent_path), info.name,
+                               info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
+                               info.can_create_child, info.last_contributor, info.digest, info.folderish,
+                               name, get_path_id('LocalPaths', parent), pair_state, info.name))
+            # Under the lock, the rows inserted next are the only ones after it
+            last_id = c.execute("SELECT IFNULL(MAX(id), 0) FROM States").fetchone()[0]
+            c.executemany("INSERT INTO States (remote_ref, remote_parent_ref, remote_parent_path_id, remote_name,"
+                          " last_remote_updated, remote_can_rename, remote_can_delete, remote_can_update,"
+                          " remote_can_create_child, last_remote_modifier, remote_digest, folderish,"
+                          " local_basename, local_parent_path_id, remote_state, local_state, pair_state, local_name)"
+                          " VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,'created','unknown',?,?)", params)
+            ids = dict(((row[1], row[2]), row[0]) for row in c.execute(
+                "SELECT id, remote_ref, remote_parent_ref FROM States WHERE id > ?", (last_id,)))
+            self._commit_write(con)
+            # Check if parents are not in creation
+            parents = self._get_pair_states_from_remote(c, set(state[0].parent_uid for state in states))
+            row_ids = []
+            queued = set()
+            for info, _, _, local_parent_path in states:
+                row_id = ids[(info.uid, info.parent_uid)]
+                row_ids.append(row_id)
+                if row_id in queued:
+                    continue
+                queued.add(row_id)
+                parent = parents.get(info.parent_uid)
+                if (parent is None and local_parent_path == '') or (parent is not None and parent != "remotely_created"):
+                    self._queue_pair_state(row_id, info.folderish, pair_state, remote_ref=info.uid)
+        finally:
+            self._lock.release()
+        return row_ids
+
     def queue_children(self, row):
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            children = c.execute("SELECT * FROM States WHERE remote_parent_ref=? or local_parent_path=? AND " +
-                                    self._get_to_sync_condition(), (row.remote_ref, row.local_path)).fetchall()
+            children = c.execute(self._select_states + " WHERE (remote_parent_ref=? OR local_parent_path_id ="
+                                 " (SELECT id FROM LocalPaths WHERE path=?)) AND " +
+                                 self._get_to_sync_condition(), (row.remote_ref, row.local_path)).fetchall()
             log.debug("Queuing %d children of '%r'", len(children), row)
             for child in children:
-                self._queue_pair_state(child.id, child.folderish, child.pair_state)
+                self._queue_pair_state(child.id, child.folderish, child.pair_state,
+                                       size=self._get_queue_size(child), remote_ref=child.remote_ref)
         finally:
             self._lock.release()
 
@@ -1150,8 +2165,7 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("UPDATE States SET last_error=?, last_sync_error_date=?, error_count = error_count + ?, last_error_details=? " +
                       "WHERE id=?", (error, error_date, incr, details, row.id))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
         row.last_error = error
@@ -1170,10 +2184,9 @@ class EngineDAO(ConfigurationDAO):
                       '       error_count=0'
                       ' WHERE id=?',
                       (last_error, row.id))
-            if self.auto_commit:
-                con.commit()
-            self._queue_pair_state(row.id, row.folderish, row.pair_state)
-            self._items_count = self._items_count + 1
+            self._commit_write(con)
+            self._queue_pair_state(row.id, row.folderish, row.pair_state, size=self._get_queue_size(row),
+                                   remote_ref=row.remote_ref)
         finally:
             self._lock.release()
         row.last_error = None
@@ -1187,13 +2200,12 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("UPDATE States SET local_state='synchronized', remote_state='modified', pair_state='remotely_modified', last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
                       " WHERE id=? AND version=?", (row.id, row.version))
-            self._queue_pair_state(row.id, row.folderish, "remotely_modified")
-            if self.auto_commit:
-                con.commit()
+            self._queue_pair_state(row.id, row.folderish, "remotely_modified", size=self._get_queue_size(row),
+                                   remote_ref=row.remote_ref)
+            self._commit_write(con)
         finally:
             self._lock.release()
         if c.rowcount == 1:
-            self._items_count = self._items_count + 1
             return True
         return False
 
@@ -1205,13 +2217,12 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("UPDATE States SET local_state='resolved', remote_state='unknown', pair_state=?, last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
                       " WHERE id=? AND version=?", (pair_state, row.id, row.version))
-            self._queue_pair_state(row.id, row.folderish, pair_state)
-            if self.auto_commit:
-                con.commit()
+            self._queue_pair_state(row.id, row.folderish, pair_state, size=self._get_queue_size(row),
+                                   remote_ref=row.remote_ref)
+            self._commit_write(con)
         finally:
             self._lock.release()
         if c.rowcount == 1:
-            self._items_count = self._items_count + 1
             return True
         return False
 
@@ -1223,12 +2234,10 @@ class EngineDAO(ConfigurationDAO):
             c.execute("UPDATE States SET pair_state='conflicted' WHERE id=?",
                       (row.id, ))
             self.newConflict.emit(row.id)
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
         if c.rowcount == 1:
-            self._items_count = self._items_count - 1
             return True
         return False
 
@@ -1240,8 +2249,7 @@ class EngineDAO(ConfigurationDAO):
             c.execute("UPDATE States SET pair_state='unsynchronized', last_sync_date=?, processor = 0," +
                       "last_error=?, error_count=0, last_sync_error_date=NULL WHERE id=?",
                       (datetime.utcnow(), last_error, row.id))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -1284,8 +2292,7 @@ class EngineDAO(ConfigurationDAO):
                           row.id,
                           version,
                       ))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -1307,16 +2314,16 @@ class EngineDAO(ConfigurationDAO):
                           '       error_count = 0,'
                           '       last_sync_error_date = NULL'
                           ' WHERE id = ?'
-                          '       AND local_path = ?'
+                          '       AND ' + self._get_local_path_condition(row.local_path)[0] +
                           '       AND remote_name = ?'
                           '       AND remote_ref = ?'
                           '       AND remote_parent_ref = ?',
                           (row.local_state, row.remote_state, row.pair_state,
-                           datetime.utcnow(), row.id, row.local_path,
-                           row.remote_name, row.remote_ref,
-                           row.remote_parent_ref))
-                if self.auto_commit:
-                    con.commit()
+                           datetime.utcnow(), row.id)
+                          + self._get_local_path_condition(row.local_path)[1]
+                          + (row.remote_name, row.remote_ref,
+                             row.remote_parent_ref))
+                self._commit_write(con)
             finally:
                 self._lock.release()
             result = c.rowcount == 1
@@ -1325,7 +2332,7 @@ class EngineDAO(ConfigurationDAO):
             log.trace('Was not able to synchronize state: %r', row)
             con = self._get_read_connection()
             c = con.cursor()
-            row2 = c.execute('SELECT * FROM States WHERE id = ?',
+            row2 = c.execute(self._select_states + ' WHERE States.id = ?',
                              (row.id,)).fetchone()
             if row2 is None:
                 log.trace('No more row')
@@ -1338,9 +2345,92 @@ class EngineDAO(ConfigurationDAO):
         return result
 
     def update_remote_state(self, row, info, remote_parent_path=None, versionned=True, queue=True, force_update=False, no_digest=False):
-        row.pair_state = self._get_pair_state(row)
         if remote_parent_path is None:
             remote_parent_path = row.remote_parent_path
+        if not self._prepare_remote_update(row, info, remote_parent_path, force_update=force_update):
+            return
+
+        if versionned:
+            log.trace('Increasing version to %d for pair %r', row.version + 1, row)
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            query = "UPDATE States SET remote_ref=?, remote_parent_ref=?, " + \
+                      "remote_parent_path_id=?, remote_name=?, last_remote_updated=?, remote_can_rename=?," + \
+                      "remote_can_delete=?, remote_can_update=?, " + \
+                      "remote_can_create_child=?, last_remote_modifier=?, remote_digest=IFNULL(?, remote_digest)," + \
+                      " local_state=?, remote_state=?, pair_state=?, version=version+? WHERE id=?"
+            c.execute(query,
+                      (info.uid, info.parent_uid, self._get_path_id(c, 'RemotePaths', remote_parent_path), info.name,
+                       info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
+                       info.can_create_child, info.last_contributor, None if no_digest else info.digest,
+                       row.local_state, row.remote_state, row.pair_state, int(versionned), row.id))
+            self._commit_write(con)
+            if queue:
+                # Check if parent is not in creation
+                parent = c.execute(self._select_states + " WHERE remote_ref=?", (info.parent_uid,)).fetchone()
+                # Parent can be None if the parent is filtered
+                if (parent is not None and parent.pair_state != "remotely_created") or parent is None:
+                    self._queue_pair_state(row.id, info.folderish, row.pair_state,
+                                           size=self._get_queue_size(row), remote_ref=info.uid)
+        finally:
+            self._lock.release()
+
+    def update_remote_states(self, updates):
+        """
+        Bulk update_remote_state() in one statement, for a scroll page.
+
+        :param updates: list of (row, info), the remote parent path is kept
+        """
+        updates = [(row, info) for row, info in updates
+                   if self._prepare_remote_update(row, info, row.remote_parent_path)]
+        if not updates:
+            return
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            path_ids = dict()
+            params = []
+            for row, info in updates:
+                path = row.remote_parent_path
+                if path not in path_ids:
+                    path_ids[path] = self._get_path_id(c, 'RemotePaths', path)
+                params.append((info.uid, info.parent_uid, path_ids[path], info.name,
+                               info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
+                               info.can_create_child, info.last_contributor, info.digest, row.local_state,
+                               row.remote_state, row.pair_state, row.id))
+            c.executemany("UPDATE States SET remote_ref=?, remote_parent_ref=?, remote_parent_path_id=?,"
+                          " remote_name=?, last_remote_updated=?, remote_can_rename=?, remote_can_delete=?,"
+                          " remote_can_update=?, remote_can_create_child=?, last_remote_modifier=?,"
+                          " remote_digest=IFNULL(?, remote_digest), local_state=?, remote_state=?, pair_state=?,"
+                          " version=version+1 WHERE id=?", params)
+            self._commit_write(con)
+            parents = self._get_pair_states_from_remote(c, set(info.parent_uid for _, info in updates))
+            for row, info in updates:
+                # Parent can be None if the parent is filtered
+                if parents.get(info.parent_uid) != "remotely_created":
+                    self._queue_pair_state(row.id, info.folderish, row.pair_state,
+                                           size=self._get_queue_size(row), remote_ref=info.uid)
+        finally:
+            self._lock.release()
+
+    def _get_pair_states_from_remote(self, cursor, refs):
+        """ Return the pair state of the first state of each remote_ref. """
+        pair_states = dict()
+        refs = list(refs)
+        for i in range(0, len(refs), MAX_IN_VALUES):
+            chunk = refs[i:i + MAX_IN_VALUES]
+            rows = cursor.execute("SELECT remote_ref, pair_state FROM States WHERE remote_ref IN ("
+                                  + ",".join("?" * len(chunk)) + ")", chunk).fetchall()
+            for row in rows:
+                pair_states.setdefault(row[0], row[1])
+        return pair_states
+
+    def _prepare_remote_update(self, row, info, remote_parent_path, force_update=False):
+        """ Compute the new states of the row, return False if it is not dirty. """
+        row.pair_state = self._get_pair_state(row)
 
         # Check if it really needs an update
         if (row.remote_ref == info.uid
@@ -1359,7 +2449,7 @@ class EngineDAO(ConfigurationDAO):
             if info.digest == row.remote_digest and not force_update:
                 log.trace('Not updating remote state (not dirty)'
                           ' for row=%r with info=%r', row, info)
-                return
+                return False
 
         log.trace('Updating remote state for row=%r with info=%r (force=%r)',
                   row, info, force_update)
@@ -1373,38 +2463,7 @@ class EngineDAO(ConfigurationDAO):
             # created ones.
             row.remote_state = 'modified'
             row.pair_state = self._get_pair_state(row)
-
-        version = ''
-        if versionned:
-            version = ', version=version+1'
-            log.trace('Increasing version to %d for pair %r', row.version + 1, row)
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            query = "UPDATE States SET remote_ref=?, remote_parent_ref=?, " + \
-                      "remote_parent_path=?, remote_name=?, last_remote_updated=?, remote_can_rename=?," + \
-                      "remote_can_delete=?, remote_can_update=?, " + \
-                      "remote_can_create_child=?, last_remote_modifier=?,"
-            if not no_digest and info.digest is not None:
-                query = query + "remote_digest='" + info.digest + "',"
-            query = query + " local_state=?," + \
-                      "remote_state=?, pair_state=?" + version + " WHERE id=?"
-            c.execute(query,
-                      (info.uid, info.parent_uid, remote_parent_path, info.name,
-                       info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
-                       info.can_create_child, info.last_contributor, row.local_state,
-                       row.remote_state, row.pair_state, row.id))
-            if self.auto_commit:
-                con.commit()
-            if queue:
-                # Check if parent is not in creation
-                parent = c.execute("SELECT * FROM States WHERE remote_ref=?", (info.parent_uid,)).fetchone()
-                # Parent can be None if the parent is filtered
-                if (parent is not None and parent.pair_state != "remotely_created") or parent is None:
-                    self._queue_pair_state(row.id, info.folderish, row.pair_state)
-        finally:
-            self._lock.release()
+        return True
 
     def _clean_filter_path(self, path):
         if not path.endswith("/"):
@@ -1421,8 +2480,7 @@ class EngineDAO(ConfigurationDAO):
             c.execute("DELETE FROM ToRemoteScan WHERE path LIKE ?", (path+'%',))
             # ADD IT
             c.execute("INSERT INTO ToRemoteScan(path) VALUES(?)", (path,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         except sqlite3.IntegrityError:
             pass
         finally:
@@ -1436,8 +2494,7 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             # ADD IT
             c.execute("DELETE FROM ToRemoteScan WHERE path=?", (path,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         except sqlite3.IntegrityError:
             pass
         finally:
@@ -1455,8 +2512,7 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             # ADD IT
             c.execute("INSERT INTO RemoteScan(path) VALUES(?)", (path,))
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         except sqlite3.IntegrityError:
             pass
         finally:
@@ -1468,8 +2524,7 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("DELETE FROM RemoteScan")
-            if self.auto_commit:
-                con.commit()
+            self._commit_write(con)
         finally:
             self._lock.release()
 
@@ -1481,13 +2536,15 @@ class EngineDAO(ConfigurationDAO):
 
     def get_previous_sync_file(self, ref, sync_mode=None):
         mode_condition = ""
+        params = ()
         if sync_mode is not None:
-            mode_condition = "AND last_transfer='" + sync_mode + "' "
+            mode_condition = "AND last_transfer=? "
+            params = (sync_mode,)
         state = self.get_normal_state_from_remote(ref)
         if state is None:
             return None
         c = self._get_read_connection().cursor()
-        return c.execute(u"SELECT * FROM States WHERE last_sync_date>? " + mode_condition + self.get_batch_sync_ignore() + " ORDER BY last_sync_date ASC LIMIT 1", (state.last_sync_date,)).fetchone()
+        return c.execute(self._select_states + u" WHERE last_sync_date>? " + mode_condition + self.get_batch_sync_ignore() + " ORDER BY last_sync_date ASC LIMIT 1", (state.last_sync_date,) + params).fetchone()
 
     @staticmethod
     def get_batch_sync_ignore():
@@ -1495,29 +2552,32 @@ class EngineDAO(ConfigurationDAO):
 
     def get_next_sync_file(self, ref, sync_mode=None):
         mode_condition = ""
+        params = ()
         if sync_mode is not None:
-            mode_condition = "AND last_transfer='" + sync_mode + "' "
+            mode_condition = "AND last_transfer=? "
+            params = (sync_mode,)
         state = self.get_normal_state_from_remote(ref)
         if state is None:
             return None
         c = self._get_read_connection().cursor()
-        return c.execute(u"SELECT * FROM States WHERE last_sync_date<? " + mode_condition + self.get_batch_sync_ignore() + " ORDER BY last_sync_date DESC LIMIT 1", (state.last_sync_date,)).fetchone()
+        return c.execute(self._select_states + u" WHERE last_sync_date<? " + mode_condition + self.get_batch_sync_ignore() + " ORDER BY last_sync_date DESC LIMIT 1", (state.last_sync_date,) + params).fetchone()
 
     def get_next_folder_file(self, ref):
         state = self.get_normal_state_from_remote(ref)
         c = self._get_read_connection().cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_ref=? AND remote_name > ? AND folderish=0 ORDER BY remote_name ASC LIMIT 1", (state.remote_parent_ref,state.remote_name)).fetchone()
+        return c.execute(self._select_states + " WHERE remote_parent_ref=? AND remote_name > ? AND folderish=0 ORDER BY remote_name ASC LIMIT 1", (state.remote_parent_ref,state.remote_name)).fetchone()
 
     def get_previous_folder_file(self, ref):
         state = self.get_normal_state_from_remote(ref)
         c = self._get_read_connection().cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_ref=? AND remote_name < ? AND folderish=0 ORDER BY remote_name DESC LIMIT 1", (state.remote_parent_ref,state.remote_name)).fetchone()
+        return c.execute(self._select_states + " WHERE remote_parent_ref=? AND remote_name < ? AND folderish=0 ORDER BY remote_name DESC LIMIT 1", (state.remote_parent_ref,state.remote_name)).fetchone()
 
     def is_filter(self, path):
-        path = self._clean_filter_path(path)
-        if any([path.startswith(filter_obj.path) for filter_obj in self._filters]):
-            return True
-        return False
+        return self._filters.match(path)
+
+    def _load_filters(self):
+        # Swap the whole trie so that a concurrent lookup never sees a partial one
+        self._filters = FilterTrie(filter_obj.path for filter_obj in self.get_filters())
 
     def get_filters(self):
         c = self._get_read_connection().cursor()
@@ -1538,10 +2598,8 @@ class EngineDAO(ConfigurationDAO):
             # ADD IT
             c.execute("INSERT INTO Filters(path) VALUES(?)", (path,))
             # TODO ADD THIS path AS remotely_deleted
-            if self.auto_commit:
-                con.commit()
-            self._filters = self.get_filters()
-            self._items_count = self.get_syncing_count()
+            self._commit_write(con)
+            self._load_filters()
         finally:
             self._lock.release()
 
@@ -1552,13 +2610,7 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("DELETE FROM Filters WHERE path LIKE ?", (path + '%',))
-            if self.auto_commit:
-                con.commit()
-            self._filters = self.get_filters()
-            self._items_count = self.get_syncing_count()
+            self._commit_write(con)
+            self._load_filters()
         finally:
             self._lock.release()
-
-    @staticmethod
-    def _escape(_str):
-        return _str.replace("'", "''")
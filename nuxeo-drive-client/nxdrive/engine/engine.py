@@ -1,6 +1,7 @@
 # coding: utf-8
 import datetime
 import os
+import sqlite3
 import urllib2
 from cookielib import CookieJar
 from threading import Thread, current_thread
@@ -164,8 +165,11 @@ class Engine(QObject):
         self._invalid_credentials = False
         self._offline_state = False
         self._threads = list()
+        self._compact_thread = None
         self._client_cache_timestamps = dict()
         self._dao = self._create_dao()
+        if self._manager.compact_db:
+            self._dao.vacuum()
         if binder is not None:
             self.bind(binder)
         self._load_configuration()
@@ -421,8 +425,9 @@ class Engine(QObject):
 
     def _create_queue_manager(self, processors):
         if self._manager.debug:
-            return QueueManager(self, self._dao, max_file_processors=2)
-        return QueueManager(self, self._dao)
+            return QueueManager(self, self._dao, max_file_processors=2, adaptive=False)
+        return QueueManager(self, self._dao, min_processors=self._manager.min_processors,
+                            max_processors=self._manager.max_processors)
 
     def _create_remote_watcher(self, delay):
         return RemoteWatcher(self, self._dao, delay)
@@ -435,7 +440,7 @@ class Engine(QObject):
                                 "ndrive_" + self.uid + ".db")
 
     def _create_dao(self):
-        return EngineDAO(self._get_db_file())
+        return EngineDAO(self._get_db_file(), wal=self._manager.db_wal, profile=self._manager.db_profile)
 
     def get_remote_url(self):
         server_link = self._dao.get_config("server_url", "")
@@ -584,6 +589,9 @@ class Engine(QObject):
                 self.syncPartialCompleted.emit()
                 return
             self._dao.update_config("last_sync_date", datetime.datetime.utcnow())
+            # Idle, a good time to fold the WAL back into the database
+            self._dao.checkpoint()
+            self._compact_db()
             if local_metrics['last_event'] == 0:
                 log.trace('No watchdog event detected but sync is completed')
             if self._sync_started:
@@ -591,6 +599,21 @@ class Engine(QObject):
             log.trace('Emitting syncCompleted for engine %s', self.uid)
             self.syncCompleted.emit()
 
+    def _compact_db(self):
+        """ Release the database free pages by steps while the engine stays idle. """
+        if self._compact_thread is not None and self._compact_thread.is_alive():
+            return
+
+        def run():
+            try:
+                while not self._stopped and not self._sync_started and self._dao.compact():
+                    pass
+            except sqlite3.Error as e:
+                log.debug("Cannot compact the database: %r", e)
+        self._compact_thread = Thread(target=run, name='Compaction')
+        self._compact_thread.daemon = True
+        self._compact_thread.start()
+
     def _thread_finished(self):
         for thread in self._threads:
             if thread == self._local_watcher.get_thread():
@@ -636,6 +659,8 @@ class Engine(QObject):
         metrics["unsynchronized_files"] = self._dao.get_unsynchronized_count()
         metrics["files_size"] = self._dao.get_global_size()
         metrics["invalid_credentials"] = self._invalid_credentials
+        # Database lock contention
+        metrics.update(self._dao.get_metrics())
         return metrics
 
     def get_conflicts(self):
@@ -687,6 +712,8 @@ class Engine(QObject):
         self._stopped = True
         log.trace('Engine %s stopping', self.uid)
         self._stop.emit()
+        # The idle processors wait for an item, not for the signal
+        self._queue_manager.shutdown_processors()
         for thread in self._threads:
             if not thread.wait(5000):
                 log.warning('Thread is not responding - terminate it')
@@ -702,6 +729,9 @@ class Engine(QObject):
             self._remote_watcher.get_thread().wait(5000)
         if not self._local_watcher.get_thread().isRunning():
             self._local_watcher.get_thread().wait(5000)
+        # The compaction stops after its current step
+        if self._compact_thread is not None:
+            self._compact_thread.join()
         # Soft locks needs to be reinit in case of threads termination
         Processor.soft_locks = dict()
         log.trace('Engine %s stopped', self.uid)
@@ -713,6 +743,15 @@ class Engine(QObject):
     def use_trash():
         return True
 
+    def use_segmented_download(self):
+        return self._manager.segmented_download
+
+    def use_chunked_upload(self):
+        return self._manager.chunked_upload
+
+    def get_upload_connections(self):
+        return self._manager.upload_connections
+
     def get_update_infos(self, client=None):
         if client is None:
             client = self.get_remote_doc_client()
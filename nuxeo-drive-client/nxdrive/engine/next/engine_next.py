@@ -29,8 +29,9 @@ class EngineNext(Engine):
     def _create_queue_manager(self, processors):
         from nxdrive.engine.next.queue_manager import QueueManager
         if self._manager.debug:
-            return QueueManager(self, self._dao, max_file_processors=2)
-        return QueueManager(self, self._dao)
+            return QueueManager(self, self._dao, max_file_processors=2, adaptive=False)
+        return QueueManager(self, self._dao, min_processors=self._manager.min_processors,
+                            max_processors=self._manager.max_processors)
 
     def _create_local_watcher(self):
         from nxdrive.engine.next.simple_watcher import SimpleWatcher
@@ -41,8 +41,9 @@ class Processor(OldProcessor):
         if pair:
             shutil.copy(local_client.abspath(pair.local_path), file_out)
             return file_out
-        tmp_file = remote_client.stream_content( doc_pair.remote_ref, file_path,
-                                parent_fs_item_id=doc_pair.remote_parent_ref, file_out=file_out)
+        tmp_file, _ = remote_client.stream_content( doc_pair.remote_ref, file_path,
+                                parent_fs_item_id=doc_pair.remote_parent_ref, file_out=file_out,
+                                segmented=self._engine.use_segmented_download())
         self._update_speed_metrics()
         return tmp_file
 
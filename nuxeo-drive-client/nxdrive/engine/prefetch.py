@@ -0,0 +1,162 @@
+# coding: utf-8
+import time
+from Queue import Empty, Queue
+from threading import Event, Lock, Thread, current_thread
+
+from nxdrive.client.common import NotFound
+from nxdrive.logging_config import get_logger
+
+log = get_logger(__name__)
+# Locally changed pairs looked ahead in the queues
+PREFETCH_SIZE = 20
+# Concurrent GetFileSystemItem calls
+PREFETCH_WORKERS = 4
+# Seconds a prefetched remote info can be used
+PREFETCH_TTL = 5
+# Seconds a processor waits for the remote info being prefetched
+PREFETCH_WAIT = 10
+# Seconds an idle fetching thread waits before ending
+PREFETCH_IDLE_WAIT = 2
+
+
+class RemoteInfoPrefetcher(object):
+    """
+    Fetch the remote infos of the next locally changed pairs while the
+    processors handle the current ones.
+
+    Each processor checks the remote state of the locally changed pair it
+    handles, that is a round trip before any transfer.  The infos of the
+    pairs coming next in the queues are fetched by a few concurrent calls
+    and kept a short time, each one is used once.
+    """
+
+    def __init__(self, engine, size=PREFETCH_SIZE, workers=PREFETCH_WORKERS, ttl=PREFETCH_TTL):
+        self._engine = engine
+        self.size = size
+        self.workers = workers
+        self.ttl = ttl
+        self._lock = Lock()
+        # Remote ref to (deadline, remote info or None if not found)
+        self._infos = dict()
+        # Remote ref being fetched to its end event
+        self._pending = dict()
+        # Row ids looked at and not processed yet
+        self._seen = set()
+        self._refs = Queue()
+        self._threads = []
+        self._metrics = {'prefetch_hits': 0, 'prefetch_misses': 0, 'prefetch_errors': 0}
+
+    def prefetch(self, items):
+        """
+        Start fetching the remote infos of the locally changed pairs among
+        the queue items, from the remote refs they were pushed with.
+        """
+        refs = []
+        for item in items:
+            # A locally created pair has no remote ref yet
+            if (item.pair_state is None or not item.pair_state.startswith('locally')
+                    or item.pair_state == 'locally_created' or item.remote_ref is None
+                    or item.id in self._seen):
+                continue
+            self._seen.add(item.id)
+            refs.append(item.remote_ref)
+            if len(refs) >= self.size:
+                break
+        if not refs:
+            return
+        self._lock.acquire()
+        try:
+            self._clean()
+            for remote_ref in refs:
+                if remote_ref in self._pending or remote_ref in self._infos:
+                    continue
+                self._pending[remote_ref] = Event()
+                self._refs.put(remote_ref)
+            while len(self._threads) < min(self.workers, self._refs.qsize()):
+                thread = Thread(target=self._run, name='RemoteInfoPrefetcher')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _clean(self):
+        cur_time = time.time()
+        for remote_ref, (deadline, _) in self._infos.items():
+            if deadline < cur_time:
+                del self._infos[remote_ref]
+        if len(self._seen) > self.size * 10:
+            self._seen.clear()
+
+    def _run(self):
+        try:
+            while not self._engine.is_stopped():
+                try:
+                    remote_ref = self._refs.get(timeout=PREFETCH_IDLE_WAIT)
+                except Empty:
+                    self._lock.acquire()
+                    try:
+                        # The refs put meanwhile count on this thread
+                        if self._refs.empty():
+                            return
+                    finally:
+                        self._lock.release()
+                    continue
+                self._fetch(remote_ref)
+        finally:
+            self._lock.acquire()
+            try:
+                self._threads.remove(current_thread())
+            finally:
+                self._lock.release()
+
+    def _fetch(self, remote_ref):
+        info = None
+        fetched = False
+        try:
+            remote_client = self._engine.get_remote_client()
+            if remote_client is not None:
+                info = remote_client.get_info(remote_ref, raise_if_missing=False)
+                fetched = True
+        except Exception as e:
+            # The processor will ask for it again
+            log.debug("Cannot prefetch the remote info of %r: %r", remote_ref, e)
+        self._lock.acquire()
+        try:
+            if fetched:
+                self._infos[remote_ref] = (time.time() + self.ttl, info)
+            else:
+                self._metrics['prefetch_errors'] += 1
+            self._pending.pop(remote_ref).set()
+        finally:
+            self._lock.release()
+
+    def get_info(self, remote_client, doc_pair):
+        """ Return the remote info of the pair from the prefetched ones, or fetch it. """
+        remote_ref = doc_pair.remote_ref
+        self._lock.acquire()
+        try:
+            self._seen.discard(doc_pair.id)
+            event = self._pending.get(remote_ref)
+        finally:
+            self._lock.release()
+        if event is not None:
+            # Do not ask twice for the same item
+            event.wait(PREFETCH_WAIT)
+        self._lock.acquire()
+        try:
+            deadline, info = self._infos.pop(remote_ref, (0, None))
+            hit = deadline >= time.time()
+            self._metrics['prefetch_hits' if hit else 'prefetch_misses'] += 1
+        finally:
+            self._lock.release()
+        if not hit:
+            return remote_client.get_info(remote_ref)
+        if info is None:
+            raise NotFound("Could not find '%s' on '%s'" % (remote_ref, remote_client.server_url))
+        return info
+
+    def get_metrics(self):
+        metrics = dict(self._metrics)
+        metrics['prefetched_infos'] = len(self._infos)
+        return metrics
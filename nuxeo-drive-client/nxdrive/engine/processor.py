@@ -9,14 +9,15 @@ from urllib2 import HTTPError
 from PyQt4.QtCore import pyqtSignal
 
 from nxdrive.client.base_automation_client import DOWNLOAD_TMP_FILE_PREFIX, \
-    DOWNLOAD_TMP_FILE_SUFFIX
+    DOWNLOAD_TMP_FILE_SUFFIX, remove_partial_download
 from nxdrive.client.common import DuplicationDisabledError, NotFound, \
     UNACCESSIBLE_HASH, safe_filename
 from nxdrive.engine.activity import Action
+from nxdrive.engine.concurrency import is_congestion
 from nxdrive.engine.workers import EngineWorker, PairInterrupt, ThreadInterrupt
 from nxdrive.logging_config import get_logger
 from nxdrive.osi import AbstractOSIntegration
-from nxdrive.utils import current_milli_time, is_generated_tmp_file
+from nxdrive.utils import current_milli_time, guess_digest_algorithm, is_generated_tmp_file
 
 log = get_logger(__name__)
 
@@ -146,6 +147,8 @@ class Processor(EngineWorker):
 
     def _execute(self):
         while 'There are items in the queue':
+            # The processor waits for the next item, it does not handle any pair meanwhile
+            self._current_doc_pair = None
             item = self._get_item()
             if not item:
                 break
@@ -208,8 +211,8 @@ class Processor(EngineWorker):
                 if (doc_pair.pair_state.startswith('locally')
                         and doc_pair.remote_ref is not None):
                     try:
-                        remote_info = remote_client.get_info(
-                            doc_pair.remote_ref)
+                        remote_info = self._engine.get_queue_manager().get_remote_info(
+                            remote_client, doc_pair)
                         if (remote_info.digest != doc_pair.remote_digest
                                 and doc_pair.remote_digest is not None):
                             doc_pair.remote_state = 'modified'
@@ -241,6 +244,10 @@ class Processor(EngineWorker):
                         # The parent folder has been renamed sooner
                         # in the current synchronization
                         doc_pair.local_parent_path = parent_pair.local_path
+                    elif parent_pair and self._engine.get_queue_manager().is_pending(parent_pair.id):
+                        # The parent folder is not created yet
+                        self._postpone_pair(doc_pair, 'PARENT_UNSYNC', parent=parent_pair.id)
+                        continue
                     else:
                         self._dao.remove_state(doc_pair)
                         continue
@@ -306,11 +313,16 @@ class Processor(EngineWorker):
                 if soft_lock is not None:
                     self._unlock_soft_path(soft_lock)
                 self._dao.release_state(self._thread_id)
+                if doc_pair is not None:
+                    # Its children can go on
+                    self._engine.get_queue_manager().release_dependents(doc_pair)
             self._interact()
 
     def _handle_pair_handler_exception(self, doc_pair, handler_name, e):
         if isinstance(e, IOError) and e.errno == 28:
             self._engine.noSpaceLeftOnDevice.emit()
+        if is_congestion(e):
+            self._engine.get_queue_manager().record_congestion()
         log.exception(repr(e))
         self.increase_error(doc_pair, "SYNC_HANDLER_%s" % handler_name, exception=e)
 
@@ -331,6 +343,7 @@ class Processor(EngineWorker):
     def _update_speed_metrics(self):
         action = Action.get_last_file_action()
         if action:
+            self._current_metrics["size"] = action.size
             duration = action.end_time - action.start_time
             # Too fast for clock resolution
             if duration <= 0:
@@ -400,6 +413,8 @@ class Processor(EngineWorker):
                     local_client.abspath(doc_pair.local_path),
                     parent_fs_item_id=doc_pair.remote_parent_ref,
                     filename=doc_pair.remote_name,  # Use remote name to avoid rename in case of duplicate
+                    chunked=self._engine.use_chunked_upload(),
+                    connections=self._engine.get_upload_connections(),
                 )
                 self._dao.update_last_transfer(doc_pair.id, "upload")
                 self._update_speed_metrics()
@@ -431,12 +446,15 @@ class Processor(EngineWorker):
         # TODO Select the only states that is not a collection
         return self._dao.get_normal_state_from_remote(ref)
 
-    def _postpone_pair(self, doc_pair, reason='', interval=None):
-        """ Wait 60 sec for it. """
+    def _postpone_pair(self, doc_pair, reason='', interval=None, parent=None):
+        """ Wait 60 sec for it, or until the end of the processing of the parent if given. """
 
         log.trace("Postpone creation of local file(%s): %r", reason, doc_pair)
         doc_pair.error_count = 1
-        self._engine.get_queue_manager().push_error(doc_pair, exception=None, interval=interval)
+        if parent is not None:
+            self._engine.get_queue_manager().push_after(doc_pair, parent, interval=interval)
+        else:
+            self._engine.get_queue_manager().push_error(doc_pair, exception=None, interval=interval)
 
     def _synchronize_locally_resolved(self, doc_pair, local_client, remote_client):
         """ NXDRIVE-766: processes a locally resolved conflict. """
@@ -485,6 +503,10 @@ class Processor(EngineWorker):
                 self._dao.unsynchronize_state(doc_pair, 'PARENT_UNSYNC')
                 self._handle_unsynchronized(local_client, doc_pair)
                 return
+            if parent_pair is not None and self._engine.get_queue_manager().is_pending(parent_pair.id):
+                # The parent folder is not created remotely yet
+                self._postpone_pair(doc_pair, 'PARENT_UNSYNC', parent=parent_pair.id)
+                return
             raise ValueError(
                 "Parent folder of %s, %s is not bound to a remote folder"
                 % (doc_pair.local_path, doc_pair.local_parent_path))
@@ -593,7 +615,9 @@ class Processor(EngineWorker):
                         return
                 fs_item_info = remote_client.stream_file(
                     parent_ref, local_client.abspath(doc_pair.local_path),
-                    filename=name, overwrite=overwrite)
+                    filename=name, overwrite=overwrite,
+                    chunked=self._engine.use_chunked_upload(),
+                    connections=self._engine.get_upload_connections())
                 remote_ref = fs_item_info.uid
                 self._dao.update_last_transfer(doc_pair.id, "upload")
                 self._update_speed_metrics()
@@ -757,22 +781,31 @@ class Processor(EngineWorker):
                              + DOWNLOAD_TMP_FILE_SUFFIX))
 
     def _download_content(self, local_client, remote_client, doc_pair, file_path):
+        """
+        Return the downloaded tmp file and its local digest, known from the
+        transfer, or None if it has to be computed.
+        """
         # Check if the file is already on the HD
         pair = self._dao.get_valid_duplicate_file(doc_pair.remote_digest)
         if pair:
             file_out = self._get_temporary_file(file_path)
             locker = local_client.unlock_path(file_out)
             try:
+                remove_partial_download(file_out)
                 shutil.copy(local_client.abspath(pair.local_path), file_out)
             finally:
                 local_client.lock_path(file_out, locker)
-            return file_out
+            return file_out, pair.local_digest
 
-        tmp_file = remote_client.stream_content(
+        tmp_file, digest = remote_client.stream_content(
                                 doc_pair.remote_ref, file_path,
-                                parent_fs_item_id=doc_pair.remote_parent_ref)
+                                parent_fs_item_id=doc_pair.remote_parent_ref,
+                                segmented=self._engine.use_segmented_download())
         self._update_speed_metrics()
-        return tmp_file
+        if digest is not None and guess_digest_algorithm(digest) != local_client.get_digest_func().lower():
+            # Not comparable to the local digests
+            digest = None
+        return tmp_file, digest
 
     def _update_remotely(self, doc_pair, local_client, remote_client, is_renaming):
         os_path = local_client.abspath(doc_pair.local_path)
@@ -782,14 +815,15 @@ class Processor(EngineWorker):
         else:
             new_os_path = os_path
         log.debug("Updating content of local file '%s'.", os_path)
-        self.tmp_file = self._download_content(local_client, remote_client, doc_pair, new_os_path)
+        self.tmp_file, digest = self._download_content(local_client, remote_client, doc_pair, new_os_path)
         # Delete original file and rename tmp file
         remote_id = local_client.get_remote_id(doc_pair.local_path)
         local_client.delete_final(doc_pair.local_path)
         if remote_id is not None:
             local_client.set_remote_id(local_client.get_path(self.tmp_file), doc_pair.remote_ref)
         updated_info = local_client.rename(local_client.get_path(self.tmp_file), doc_pair.remote_name)
-        doc_pair.local_digest = updated_info.get_digest()
+        # Hashed while downloaded, the file is not read again
+        doc_pair.local_digest = digest or updated_info.get_digest()
         self._dao.update_last_transfer(doc_pair.id, "download")
         self._refresh_local_state(doc_pair, updated_info)
 
@@ -823,7 +857,7 @@ class Processor(EngineWorker):
 
                 if not new_parent_pair:
                     # A move to a folder that has not yet been processed
-                    self._postpone_pair(doc_pair, reason='PARENT_UNSYNC')
+                    self._postpone_pair(doc_pair, reason='PARENT_UNSYNC', parent=doc_pair.remote_parent_ref)
                     return
 
                 if not is_move and not is_renaming:
@@ -921,6 +955,10 @@ class Processor(EngineWorker):
                 self._dao.unsynchronize_state(doc_pair, 'PARENT_UNSYNC')
                 self._handle_unsynchronized(local_client, doc_pair)
                 return
+            if self._engine.get_queue_manager().is_pending(parent_pair.id):
+                # The parent folder is not created locally yet
+                self._postpone_pair(doc_pair, 'PARENT_UNSYNC', parent=parent_pair.id)
+                return
             # Illegal state: report the error and let's wait for the
             # parent folder issue to get resolved first
             raise ValueError(
@@ -989,7 +1027,9 @@ class Processor(EngineWorker):
                                                                 name)
                 log.debug("Creating local file '%s' in '%s'", name,
                           local_client.abspath(parent_pair.local_path))
-                tmp_file = self._download_content(local_client, remote_client, doc_pair, os_path)
+                tmp_file, digest = self._download_content(local_client, remote_client, doc_pair, os_path)
+                # Hashed while downloaded, the file is not read again by _refresh_local_state
+                doc_pair.local_digest = digest
                 tmp_file_path = local_client.get_path(tmp_file)
                 # Set remote id on tmp file already
                 local_client.set_remote_id(tmp_file_path, doc_pair.remote_ref)
@@ -1011,9 +1051,7 @@ class Processor(EngineWorker):
                     self._engine.set_local_folder_lock(doc_pair.local_path)
                 else:
                     # Check for nxpart to clean up
-                    file_out = self._get_temporary_file(local_client.abspath(doc_pair.local_path))
-                    if os.path.exists(file_out):
-                        os.remove(file_out)
+                    remove_partial_download(self._get_temporary_file(local_client.abspath(doc_pair.local_path)))
                 if self._engine.use_trash():
                     local_client.delete(doc_pair.local_path)
                 else:
@@ -1,23 +1,64 @@
 # coding: utf-8
 import time
 from Queue import Empty, Queue
+from collections import Counter, OrderedDict
 from copy import deepcopy
-from threading import Lock, local
+from heapq import heappop, heappush, nsmallest
+from itertools import count, islice
+from threading import Condition, Lock, RLock, Thread, local
 
 from PyQt4.QtCore import QObject, QTimer, pyqtSignal, pyqtSlot
 
+from nxdrive.engine.blacklist_queue import RetryScheduler, jittered
+from nxdrive.engine.concurrency import ConcurrencyController
+from nxdrive.engine.prefetch import RemoteInfoPrefetcher
 from nxdrive.engine.processor import Processor
 from nxdrive.logging_config import get_logger
 
 log = get_logger(__name__)
 WINERROR_CODE_PROCESS_CANNOT_ACCESS_FILE = 32
+# Maximum time an idle processor waits for an item before checking if it has to stop, in seconds
+PROCESSOR_IDLE_WAIT = 1
+# Default bounds of the generic processors count chosen from the throughput
+ADAPTIVE_MIN_PROCESSORS = 1
+ADAPTIVE_MAX_PROCESSORS = 16
+# Size classes of the files, a file of unknown size is a medium one
+SMALL_FILE_SIZE = 4 * 1024 * 1024
+LARGE_FILE_SIZE = 100 * 1024 * 1024
+SMALL_LANE = 'small'
+MEDIUM_LANE = 'medium'
+LARGE_LANE = 'large'
+LANES = (SMALL_LANE, MEDIUM_LANE, LARGE_LANE)
+# File processors kept for each lane having files waiting, always kept from the large files for the small ones
+LANE_RESERVED_PROCESSORS = {SMALL_LANE: 1, MEDIUM_LANE: 1, LARGE_LANE: 1}
+
+
+def get_size(pair):
+    """ Size of the file of a pair or a queue item, None while there is no local file. """
+    if getattr(pair, 'local_state', None) == 'unknown':
+        return None
+    return getattr(pair, 'size', None)
+
+
+def get_lane(pair):
+    size = get_size(pair)
+    if size is None:
+        return MEDIUM_LANE
+    if size < SMALL_FILE_SIZE:
+        return SMALL_LANE
+    if size >= LARGE_FILE_SIZE:
+        return LARGE_LANE
+    return MEDIUM_LANE
 
 
 class QueueItem(object):
-    def __init__(self, row_id, folderish, pair_state):
+    def __init__(self, row_id, folderish, pair_state, size=None, remote_ref=None):
         self.id = row_id
         self.folderish = folderish
         self.pair_state = pair_state
+        self.size = size
+        # For the prefetch of the remote info, without reading the pair
+        self.remote_ref = remote_ref
 
     def __repr__(self):
         return "%s[%s](Folderish:%s, State: %s)" % (
@@ -25,6 +66,138 @@ class QueueItem(object):
                         self.folderish, self.pair_state)
 
 
+class CoalescingQueue(Queue):
+    """
+    FIFO queue holding at most one item by row id.
+
+    Pushing a pair already waiting replaces its item at the same position,
+    the processor reads the pair state from the database anyway.
+    """
+
+    def _init(self, maxsize):
+        self.queue = OrderedDict()
+        self.coalesced = 0
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def __contains__(self, row_id):
+        return row_id in self.queue
+
+    def _put(self, item):
+        if item.id in self.queue:
+            self.coalesced += 1
+        self.queue[item.id] = item
+
+    def _get(self):
+        return self.queue.popitem(last=False)[1]
+
+    def discard(self, row_id):
+        """ Remove the item of the row id, if any. """
+        self.mutex.acquire()
+        try:
+            return self.queue.pop(row_id, None)
+        finally:
+            self.mutex.release()
+
+    def items(self):
+        self.mutex.acquire()
+        try:
+            return self.queue.values()
+        finally:
+            self.mutex.release()
+
+    def peek(self, size):
+        """ Return the next items, at most size, without removing them. """
+        self.mutex.acquire()
+        try:
+            return self._peek(size)
+        finally:
+            self.mutex.release()
+
+    def _peek(self, size):
+        return list(islice(self.queue.itervalues(), size))
+
+
+class LaneQueue(CoalescingQueue):
+    """
+    Coalescing queue of files split in size lanes.
+
+    The lanes are FIFO but the small one, giving the smallest files first.
+    A plain get takes from the first lane having files.
+    """
+
+    def _init(self, maxsize):
+        CoalescingQueue._init(self, maxsize)
+        self._lanes = dict((lane, OrderedDict()) for lane in LANES)
+        # Smallest first: (size, order, row id), the entries of the items gone are skipped
+        self._small = []
+        self._order = count()
+
+    def _put(self, item):
+        self._remove(item.id)
+        CoalescingQueue._put(self, item)
+        lane = get_lane(item)
+        self._lanes[lane][item.id] = item
+        if lane == SMALL_LANE:
+            heappush(self._small, (get_size(item), next(self._order), item.id))
+
+    def _get(self):
+        return self._pop(LANES)
+
+    def _remove(self, row_id):
+        for items in self._lanes.itervalues():
+            items.pop(row_id, None)
+
+    def _pop(self, lanes):
+        for lane in lanes:
+            items = self._lanes[lane]
+            if not items:
+                continue
+            if lane == SMALL_LANE:
+                row_id = heappop(self._small)[2]
+                while row_id not in items:
+                    row_id = heappop(self._small)[2]
+                if len(items) == 1:
+                    del self._small[:]
+            else:
+                row_id = next(iter(items))
+            del items[row_id]
+            return self.queue.pop(row_id)
+        return None
+
+    def _peek(self, size):
+        small = self._lanes[SMALL_LANE]
+        row_ids = [row_id for _, _, row_id in nsmallest(size, self._small) if row_id in small]
+        for lane in LANES[1:]:
+            row_ids.extend(islice(self._lanes[lane], size))
+        return [self.queue[row_id] for row_id in OrderedDict.fromkeys(row_ids)][:size]
+
+    def discard(self, row_id):
+        self.mutex.acquire()
+        try:
+            self._remove(row_id)
+            return self.queue.pop(row_id, None)
+        finally:
+            self.mutex.release()
+
+    def get_from(self, lanes):
+        """ Return the next item of the first given lane having one, without blocking. """
+        self.mutex.acquire()
+        try:
+            return self._pop(lanes)
+        finally:
+            self.mutex.release()
+
+    def get_lanes(self):
+        """ Return the lanes having files waiting. """
+        self.mutex.acquire()
+        try:
+            return set(lane for lane, items in self._lanes.iteritems() if items)
+        finally:
+            self.mutex.release()
+
+
 class QueueManager(QObject):
     # Always create thread from the main thread
     newItem = pyqtSignal(object)
@@ -36,14 +209,17 @@ class QueueManager(QObject):
     # Only used by Unit Test
     _disable = False
 
-    def __init__(self, engine, dao, max_file_processors=5):
+    def __init__(self, engine, dao, max_file_processors=5, adaptive=True,
+                 min_processors=ADAPTIVE_MIN_PROCESSORS, max_processors=ADAPTIVE_MAX_PROCESSORS):
         super(QueueManager, self).__init__()
         self._dao = dao
         self._engine = engine
-        self._local_folder_queue = Queue()
-        self._local_file_queue = Queue()
-        self._remote_file_queue = Queue()
-        self._remote_folder_queue = Queue()
+        self._local_folder_queue = CoalescingQueue()
+        self._local_file_queue = LaneQueue()
+        self._remote_file_queue = LaneQueue()
+        self._remote_folder_queue = CoalescingQueue()
+        self._queues = (self._local_folder_queue, self._local_file_queue,
+                        self._remote_file_queue, self._remote_folder_queue)
         self._connected = local()
         self._local_folder_enable = True
         self._local_file_enable = True
@@ -55,10 +231,22 @@ class QueueManager(QObject):
         self._remote_file_thread = None
         self._error_threshold = 3
         self._error_interval = 60
-        self.set_max_processors(max_file_processors)
+        # The processors wait on it for new items
+        self._condition = Condition()
+        # Row id handled by each busy processor, None once released, and generic processors leaving a shrunk pool
+        self._busy = dict()
+        self._retired = set()
+        # Size lane of the file handled by each busy processor
+        self._busy_lanes = dict()
         self._threads_pool = list()
         self._processors_pool = list()
+        self._concurrency = None
+        self._resize(max_file_processors)
+        # Start from the given count, then follow the throughput
+        if adaptive:
+            self._concurrency = ConcurrencyController(self._max_processors, min_processors, max_processors)
         self._get_file_lock = Lock()
+        self._prefetcher = RemoteInfoPrefetcher(engine)
         # Should not operate on thread while we are inspecting them
         '''
         This error required to add a lock for inspecting threads, as the below Traceback shows the processor thread was ended while the method was running
@@ -76,14 +264,35 @@ class QueueManager(QObject):
         self._thread_inspection = Lock()
 
         # ERROR HANDLING
-        self._error_lock = Lock()
-        self._on_error_queue = dict()
+        self._error_lock = RLock()
+        self._on_error_queue = RetryScheduler()
+        # Postponed pairs waiting for a parent: parent id or remote ref to pairs by id, and the reverse
+        self._dependents = dict()
+        self._dependencies = dict()
+        # Deadline the timer is armed for
+        self._error_deadline = None
         self._error_timer = QTimer()
+        self._error_timer.setSingleShot(True)
         self._error_timer.timeout.connect(self._on_error_timer)
         self.newError.connect(self._on_new_error)
         self.queueProcessing.connect(self.launch_processors)
         # LAST ACTION
-        self._dao.register_queue_manager(self)
+        self._dao.register_queue_manager(self, load=False)
+        # Load the queue in background, the processors start on the first items
+        self._loader = Thread(target=self._load_queue, name='QueueLoader')
+        self._loader.daemon = True
+        self._loader.start()
+
+    def _load_queue(self):
+        try:
+            self._dao.load_queue()
+        except Exception as e:
+            log.exception("Cannot load the queue: %r", e)
+        finally:
+            self._dao.dispose_thread()
+
+    def is_loading(self):
+        return self._loader.is_alive()
 
     def init_processors(self):
         log.trace("Init processors")
@@ -97,6 +306,8 @@ class QueueManager(QObject):
         except TypeError:
             # TypeError: disconnect() failed between 'newItem' and 'launch_processors'
             pass
+        # The idle processors leave if they or the engine are stopped
+        self._notify()
 
     def init_queue(self, queue):
         # Dont need to change modify as State is compatible with QueueItem
@@ -105,14 +316,94 @@ class QueueManager(QObject):
 
     @staticmethod
     def _copy_queue(queue):
-        result = deepcopy(queue.queue)
+        result = deepcopy(queue.items())
         result.reverse()
         return result
 
     def set_max_processors(self, max_file_processors):
+        """ Limit the file processors, the adaptive count stays under the limit. """
+        if self._concurrency is not None:
+            self._concurrency.set_max_level(max_file_processors - 2)
+            max_file_processors = min(max_file_processors, self._concurrency.level + 2)
+        self._resize(max_file_processors)
+
+    def _resize(self, max_file_processors):
+        """ Resize the pool of generic processors, the running ones are kept or released when idle. """
         if max_file_processors < 2:
             max_file_processors = 2
         self._max_processors = max_file_processors - 2
+        # Release the extra idle processors, or start the missing ones
+        self._notify()
+        self.queueProcessing.emit()
+
+    def _adapt(self):
+        if self._concurrency is None:
+            return
+        level = self._concurrency.update(self.get_overall_size())
+        if level != self._max_processors:
+            log.debug('Adapting the generic processors count from %d to %d', self._max_processors, level)
+            self._resize(level + 2)
+
+    @pyqtSlot(object, object)
+    def _on_pair_sync(self, doc_pair, metrics):
+        if self._concurrency is not None:
+            self._concurrency.record_sync(metrics.get('size'))
+            self._adapt()
+
+    def record_congestion(self):
+        """ The server or the network is overloaded, use less processors. """
+        if self._concurrency is not None:
+            self._concurrency.record_congestion()
+            self._adapt()
+
+    def get_remote_info(self, remote_client, doc_pair):
+        """ Return the remote info of a locally changed pair, the ones of the next pairs are fetched meanwhile. """
+        size = self._prefetcher.size
+        self._prefetcher.prefetch(self._local_file_queue.peek(size) + self._local_folder_queue.peek(size))
+        return self._prefetcher.get_info(remote_client, doc_pair)
+
+    def _notify(self):
+        self._condition.acquire()
+        try:
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+
+    def _wait_item(self, getter, worker, generic=False):
+        """
+        Block the processor until the getter returns an item.
+        Return None when the processor has to end: the worker or the
+        engine is stopping, or the pool of generic processors is too big.
+        """
+        self._condition.acquire()
+        try:
+            busy = worker in self._busy
+            self._busy.pop(worker, None)
+            idle = busy and not self._busy
+            if self._busy_lanes.pop(worker, None) is not None:
+                # The slot may be reserved to a lane another processor waits for
+                self._condition.notify_all()
+        finally:
+            self._condition.release()
+        if idle:
+            # Let launch_processors tell that the processing is finished
+            self.newItem.emit(None)
+        while worker.is_started() and not self._engine.is_stopped():
+            self._condition.acquire()
+            try:
+                if generic and len(self._processors_pool) - len(self._retired) > self._max_processors:
+                    self._retired.add(worker)
+                    return None
+                item = getter()
+                if item is not None:
+                    self._busy[worker] = item.id
+                    if not item.folderish:
+                        self._busy_lanes[worker] = get_lane(item)
+                    return item
+                self._condition.wait(PROCESSOR_IDLE_WAIT)
+            finally:
+                self._condition.release()
+        return None
 
     def resume(self):
         log.debug("Resuming queue")
@@ -135,31 +426,50 @@ class QueueManager(QObject):
         self.enable_remote_file_queue(False)
         self.enable_remote_folder_queue(False)
 
+    def _quit_processor(self, thread):
+        """ The processor of a disabled queue leaves if idle, a busy one ends its item first. """
+        self._condition.acquire()
+        try:
+            if thread.worker not in self._busy:
+                thread.worker.quit()
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+        thread.quit()
+
     def enable_local_file_queue(self, value=True, emit=True):
         self._local_file_enable = value
         if self._local_file_thread is not None and not value:
-            self._local_file_thread.quit()
+            self._quit_processor(self._local_file_thread)
+        else:
+            self._notify()
         if value and emit:
             self.queueProcessing.emit()
 
     def enable_local_folder_queue(self, value=True, emit=True):
         self._local_folder_enable = value
         if self._local_folder_thread is not None and not value:
-            self._local_folder_thread.quit()
+            self._quit_processor(self._local_folder_thread)
+        else:
+            self._notify()
         if value and emit:
             self.queueProcessing.emit()
 
     def enable_remote_file_queue(self, value=True, emit=True):
         self._remote_file_enable = value
         if self._remote_file_thread is not None and not value:
-            self._remote_file_thread.quit()
+            self._quit_processor(self._remote_file_thread)
+        else:
+            self._notify()
         if value and emit:
             self.queueProcessing.emit()
 
     def enable_remote_folder_queue(self, value=True, emit=True):
         self._remote_folder_enable = value
         if self._remote_folder_thread is not None and not value:
-            self._remote_folder_thread.quit()
+            self._quit_processor(self._remote_folder_thread)
+        else:
+            self._notify()
         if value and emit:
             self.queueProcessing.emit()
 
@@ -175,8 +485,8 @@ class QueueManager(QObject):
     def get_remote_folder_queue(self):
         return self._copy_queue(self._remote_folder_queue)
 
-    def push_ref(self, row_id, folderish, pair_state):
-        self.push(QueueItem(row_id, folderish, pair_state))
+    def push_ref(self, row_id, folderish, pair_state, size=None, remote_ref=None):
+        self.push(QueueItem(row_id, folderish, pair_state, size=size, remote_ref=remote_ref))
 
     def push(self, state):
         if state.pair_state is None:
@@ -186,50 +496,153 @@ class QueueManager(QObject):
         row_id = state.id
         if state.pair_state.startswith('locally'):
             if state.folderish:
-                self._local_folder_queue.put(state)
+                self._put(self._local_folder_queue, state)
                 log.trace('Pushed to _local_folder_queue, now of size: %d', self._local_folder_queue.qsize())
             else:
                 if "deleted" in state.pair_state:
                     self._engine.cancel_action_on(state.id)
-                self._local_file_queue.put(state)
+                self._put(self._local_file_queue, state)
                 log.trace('Pushed to _local_file_queue, now of size: %d', self._local_file_queue.qsize())
             self.newItem.emit(row_id)
         elif state.pair_state.startswith('remotely'):
             if state.folderish:
-                self._remote_folder_queue.put(state)
+                self._put(self._remote_folder_queue, state)
                 log.trace('Pushed to _remote_folder_queue, now of size: %d', self._remote_folder_queue.qsize())
             else:
                 if "deleted" in state.pair_state:
                     self._engine.cancel_action_on(state.id)
-                self._remote_file_queue.put(state)
+                self._put(self._remote_file_queue, state)
                 log.trace('Pushed to _remote_file_queue, now of size: %d', self._remote_file_queue.qsize())
             self.newItem.emit(row_id)
         else:
             # deleted and conflicted
             log.debug("Not processable state: %r", state)
 
+    def _put(self, queue, state):
+        # A pair changing of side or of type leaves its previous queue
+        for other in self._queues:
+            if other is not queue:
+                other.discard(state.id)
+        queue.put(state)
+        self._notify()
+
     @pyqtSlot()
     def _on_error_timer(self):
-        cur_time = int(time.time())
+        cur_time = time.time()
         self._error_lock.acquire()
         try:
-            for doc_pair in self._on_error_queue.values():
-                if doc_pair.error_next_try < cur_time:
-                    queue_item = QueueItem(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
-                    del self._on_error_queue[doc_pair.id]
-                    log.debug('End of blacklist period, pushing doc_pair: %r', doc_pair)
-                    self.push(queue_item)
-            if len(self._on_error_queue) == 0:
-                self._error_timer.stop()
+            doc_pair = self._on_error_queue.pop(cur_time)
+            while doc_pair is not None:
+                self._forget_dependency(doc_pair.id)
+                queue_item = QueueItem(doc_pair.id, doc_pair.folderish, doc_pair.pair_state,
+                                       size=get_size(doc_pair), remote_ref=doc_pair.remote_ref)
+                log.debug('End of blacklist period, pushing doc_pair: %r', doc_pair)
+                self.push(queue_item)
+                doc_pair = self._on_error_queue.pop(cur_time)
+            self._arm_error_timer()
         finally:
             self._error_lock.release()
 
+    def _arm_error_timer(self):
+        """ Wake up for the next deadline only, the timer is single shot. """
+        self._error_deadline = self._on_error_queue.next_deadline()
+        if self._error_deadline is None:
+            self._error_timer.stop()
+            return
+        delay = max(0, int((self._error_deadline - time.time()) * 1000) + 1)
+        self._error_timer.start(delay)
+
     def _is_on_error(self, row_id):
         return row_id in self._on_error_queue
 
+    def is_pending(self, row_id):
+        """ Return True if the pair is queued, handled by a processor or waiting for a retry. """
+        return (row_id in self._busy.values()
+                or self._is_on_error(row_id)
+                or any(row_id in queue for queue in self._queues))
+
+    def push_after(self, doc_pair, parent, interval=None):
+        """
+        Postpone the pair until the processing of its parent, given by its
+        row id or its remote ref, is over.  The usual retry delay still
+        applies if the parent is never processed.
+
+        A parent row id is checked again with the release of the dependents
+        locked out: if its processing ended since the caller saw it pending,
+        the pair is pushed straight back instead of waiting for the delay.
+        """
+        self._error_lock.acquire()
+        try:
+            self._forget_dependency(doc_pair.id)
+            released = isinstance(parent, (int, long)) and not self.is_pending(parent)
+            if not released:
+                self._dependents.setdefault(parent, dict())[doc_pair.id] = doc_pair
+                self._dependencies[doc_pair.id] = parent
+                self.push_error(doc_pair, interval=interval)
+        finally:
+            self._error_lock.release()
+        if released:
+            log.debug('Parent %r already processed, pushing doc_pair: %r', parent, doc_pair)
+            self.push(QueueItem(doc_pair.id, doc_pair.folderish, doc_pair.pair_state, size=get_size(doc_pair),
+                                remote_ref=doc_pair.remote_ref))
+
+    def _forget_dependency(self, row_id):
+        parent = self._dependencies.pop(row_id, None)
+        if parent is None:
+            return
+        dependents = self._dependents[parent]
+        del dependents[row_id]
+        if not dependents:
+            del self._dependents[parent]
+
+    def release_dependents(self, doc_pair):
+        """ Push back the pairs postponed until the end of the processing of doc_pair. """
+        released = []
+        self._error_lock.acquire()
+        try:
+            # Not pending anymore for push_after(), even if the processor is not idle yet
+            for worker, row_id in self._busy.items():
+                if row_id == doc_pair.id:
+                    self._busy[worker] = None
+            if self._is_on_error(doc_pair.id):
+                # Postponed itself, its dependents keep waiting for it
+                return
+            for parent in (doc_pair.id, doc_pair.remote_ref):
+                for row_id, dependent in self._dependents.pop(parent, dict()).iteritems():
+                    del self._dependencies[row_id]
+                    # Already retried if not in the error queue anymore
+                    if self._on_error_queue.remove(row_id) is not None:
+                        released.append(dependent)
+        finally:
+            self._error_lock.release()
+        for dependent in released:
+            log.debug('End of parent processing, pushing doc_pair: %r', dependent)
+            self.push(QueueItem(dependent.id, dependent.folderish, dependent.pair_state,
+                                size=get_size(dependent), remote_ref=dependent.remote_ref))
+
     @pyqtSlot()
     def _on_new_error(self):
-        self._error_timer.start(1000)
+        # The timer must be started from the thread it belongs to
+        self._error_lock.acquire()
+        try:
+            self._arm_error_timer()
+        finally:
+            self._error_lock.release()
+
+    def _schedule_error(self, doc_pair, interval):
+        doc_pair.error_next_try = interval + time.time()
+        self._error_lock.acquire()
+        try:
+            self._on_error_queue.push(doc_pair.id, doc_pair, doc_pair.error_next_try)
+            # Rearm the timer only when this pair comes before its deadline
+            emit_sig = self._error_deadline is None or doc_pair.error_next_try < self._error_deadline
+            if emit_sig:
+                self._error_deadline = doc_pair.error_next_try
+        finally:
+            self._error_lock.release()
+        # Out of the lock, the slot is directly called from the main thread
+        if emit_sig:
+            self.newError.emit(doc_pair.id)
 
     def get_errors_count(self):
         return len(self._on_error_queue)
@@ -251,70 +664,83 @@ class QueueManager(QObject):
             log.debug("Giving up on pair : %r", doc_pair)
             return
         if interval is None:
-            interval = self._error_interval * error_count
-        doc_pair.error_next_try = interval + int(time.time())
+            interval = jittered(self._error_interval * error_count)
         log.debug("Blacklisting pair for %ds: %r", interval, doc_pair)
-        self._error_lock.acquire()
-        try:
-            emit_sig = False
-            if doc_pair.id not in self._on_error_queue:
-                emit_sig = True
-            self._on_error_queue[doc_pair.id] = doc_pair
-            if emit_sig:
-                self.newError.emit(doc_pair.id)
-        finally:
-            self._error_lock.release()
+        self._schedule_error(doc_pair, interval)
 
     def requeue_errors(self):
         self._error_lock.acquire()
         try:
-            for doc_pair in self._on_error_queue.values():
+            for doc_pair in self._on_error_queue.items():
                 doc_pair.error_next_try = 0
+            self._on_error_queue.reschedule_all(0)
+            emit_sig = len(self._on_error_queue) > 0
+            if emit_sig:
+                self._error_deadline = 0
         finally:
             self._error_lock.release()
+        if emit_sig:
+            self.newError.emit(None)
 
     def _get_local_folder(self):
-        if self._local_folder_queue.empty():
+        if not self._local_folder_enable or self._local_folder_queue.empty():
             return None
         try:
-            state = self._local_folder_queue.get(True, 3)
+            state = self._local_folder_queue.get_nowait()
         except Empty:
             return None
         if state is not None and self._is_on_error(state.id):
             return self._get_local_folder()
         return state
 
-    def _get_local_file(self):
-        if self._local_file_queue.empty():
-            return None
-        try:
-            state = self._local_file_queue.get(True, 3)
-        except Empty:
+    def _get_lanes(self):
+        """
+        Return the size lanes a free file processor can take a file from,
+        by priority: the lanes below their reserved processors count, then
+        the smallest files first as long as the other lanes keep their slots.
+        The large files always leave theirs to the small files, these must
+        not wait for a large transfer to end.
+        """
+        waiting = self._local_file_queue.get_lanes() | self._remote_file_queue.get_lanes()
+        busy = Counter(self._busy_lanes.itervalues())
+        free = self._max_processors + 2 - len(self._busy_lanes)
+        missing = dict((lane, max(0, LANE_RESERVED_PROCESSORS[lane] - busy[lane])) for lane in LANES)
+        lanes = [lane for lane in LANES if lane in waiting and missing[lane]]
+        kept = sum(missing[lane] for lane in waiting)
+        for lane in LANES:
+            if lane not in waiting or lane in lanes:
+                continue
+            if lane == LARGE_LANE and SMALL_LANE not in waiting:
+                kept += missing[SMALL_LANE]
+            if free > kept:
+                lanes.append(lane)
+        return lanes
+
+    def _get_local_file(self, lanes=None):
+        if not self._local_file_enable or self._local_file_queue.empty():
             return None
+        state = self._local_file_queue.get_from(self._get_lanes() if lanes is None else lanes)
         if state is not None and self._is_on_error(state.id):
-            return self._get_local_file()
+            return self._get_local_file(lanes)
         return state
 
     def _get_remote_folder(self):
-        if self._remote_folder_queue.empty():
+        if not self._remote_folder_enable or self._remote_folder_queue.empty():
             return None
         try:
-            state = self._remote_folder_queue.get(True, 3)
+            state = self._remote_folder_queue.get_nowait()
         except Empty:
             return None
         if state is not None and self._is_on_error(state.id):
             return self._get_remote_folder()
         return state
 
-    def _get_remote_file(self):
-        if self._remote_file_queue.empty():
-            return None
-        try:
-            state = self._remote_file_queue.get(True, 3)
-        except Empty:
+    def _get_remote_file(self, lanes=None):
+        if not self._remote_file_enable or self._remote_file_queue.empty():
             return None
+        state = self._remote_file_queue.get_from(self._get_lanes() if lanes is None else lanes)
         if state is not None and self._is_on_error(state.id):
-            return self._get_remote_file()
+            return self._get_remote_file(lanes)
         return state
 
     def _get_file(self):
@@ -322,10 +748,14 @@ class QueueManager(QObject):
         if self._remote_file_queue.empty() and self._local_file_queue.empty():
             self._get_file_lock.release()
             return None
-        if self._remote_file_queue.qsize() > self._local_file_queue.qsize():
-            state = self._get_remote_file()
-        else:
-            state = self._get_local_file()
+        state = None
+        for lane in self._get_lanes():
+            if self._remote_file_queue.qsize() > self._local_file_queue.qsize():
+                state = self._get_remote_file((lane,)) or self._get_local_file((lane,))
+            else:
+                state = self._get_local_file((lane,)) or self._get_remote_file((lane,))
+            if state is not None:
+                break
         self._get_file_lock.release()
         if state is not None and self._is_on_error(state.id):
             return self._get_file()
@@ -335,7 +765,16 @@ class QueueManager(QObject):
     def _thread_finished(self):
         self._thread_inspection.acquire()
         try:
-            for thread in self._processors_pool:
+            self._condition.acquire()
+            try:
+                for thread in self._get_threads():
+                    if thread.isFinished():
+                        self._busy.pop(thread.worker, None)
+                        self._busy_lanes.pop(thread.worker, None)
+                        self._retired.discard(thread.worker)
+            finally:
+                self._condition.release()
+            for thread in self._processors_pool[:]:
                 if thread.isFinished():
                     self._processors_pool.remove(thread)
             if (self._local_folder_thread is not None and
@@ -361,15 +800,21 @@ class QueueManager(QObject):
         return self.is_active()
 
     def is_active(self):
-        return (self._local_folder_thread is not None
-                or self._local_file_thread is not None
-                or self._remote_file_thread is not None
-                or self._remote_folder_thread is not None
-                or len(self._processors_pool) > 0)
+        # The processors stay alive while idle, only the ones handling an item count
+        return self.is_loading() or len(self._busy) > 0
 
-    def _create_thread(self, item_getter, **kwargs):
+    def _get_threads(self):
+        threads = [self._local_folder_thread, self._local_file_thread,
+                   self._remote_folder_thread, self._remote_file_thread]
+        return [thread for thread in threads if thread is not None] + self._processors_pool
+
+    def _create_thread(self, item_getter, generic=False, **kwargs):
         log.debug('Creating %s', kwargs.get('name'))
-        processor = self._engine.create_processor(item_getter, **kwargs)
+
+        def get_item():
+            return self._wait_item(item_getter, processor, generic=generic)
+        processor = self._engine.create_processor(get_item, **kwargs)
+        processor.pairSync.connect(self._on_pair_sync)
         thread = self._engine.create_thread(worker=processor)
         thread.finished.connect(self._thread_finished)
         thread.terminated.connect(self._thread_finished)
@@ -387,9 +832,18 @@ class QueueManager(QObject):
         metrics["local_file_thread"] = self._local_file_thread is not None
         metrics["local_folder_thread"] = self._local_folder_thread is not None
         metrics["error_queue"] = self.get_errors_count()
+        metrics["waiting_parent"] = len(self._dependencies)
         metrics["total_queue"] = (metrics["local_folder_queue"] + metrics["local_file_queue"]
                                 + metrics["remote_folder_queue"] + metrics["remote_file_queue"])
+        metrics["coalesced_items"] = sum(queue.coalesced for queue in self._queues)
         metrics["additional_processors"] = len(self._processors_pool)
+        metrics["busy_processors"] = len(self._busy)
+        busy = Counter(self._busy_lanes.itervalues())
+        for lane in LANES:
+            metrics[lane + "_lane_processors"] = busy[lane]
+        if self._concurrency is not None:
+            metrics.update(self._concurrency.get_metrics())
+        metrics.update(self._prefetcher.get_metrics())
         return metrics
 
     def get_overall_size(self):
@@ -495,6 +949,6 @@ class QueueManager(QObject):
             if self._local_file_queue.qsize() == 0:
                 return
 
-        while len(self._processors_pool) < self._max_processors:
+        while len(self._processors_pool) - len(self._retired) < self._max_processors:
             self._processors_pool.append(self._create_thread(
-                self._get_file, name='GenericProcessor'))
+                self._get_file, generic=True, name='GenericProcessor'))
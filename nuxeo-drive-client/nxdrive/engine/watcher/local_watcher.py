@@ -11,7 +11,7 @@ from PyQt4.QtCore import pyqtSignal, pyqtSlot
 from watchdog.events import PatternMatchingEventHandler
 from watchdog.observers import Observer
 
-from nxdrive.client.base_automation_client import DOWNLOAD_TMP_FILE_SUFFIX
+from nxdrive.client.base_automation_client import DOWNLOAD_TMP_FILE_SUFFIX, clean_partial_downloads
 from nxdrive.client.local_client import LocalClient
 from nxdrive.engine.activity import Action
 from nxdrive.engine.workers import EngineWorker, ThreadInterrupt
@@ -239,8 +239,13 @@ class LocalWatcher(EngineWorker):
         self._protected_files = dict()
 
         info = self.client.get_info(u'/')
-        self._scan_recursive(info)
-        self._scan_handle_deleted_files()
+        # Group the writes of the scan in a few transactions
+        self._dao.begin_batch()
+        try:
+            self._scan_recursive(info)
+            self._scan_handle_deleted_files()
+        finally:
+            self._dao.end_batch()
         self._metrics['last_local_scan_time'] = current_milli_time() - start_ms
         log.debug("Full scan finished in %dms", self._metrics['last_local_scan_time'])
         self._local_scan_finished = True
@@ -318,6 +323,8 @@ class LocalWatcher(EngineWorker):
         except OSError:
             # The folder has been deleted in the mean time
             return
+        # Ignored by the scan, the partial downloads of the renamed, moved or deleted documents are dropped
+        clean_partial_downloads(self.client.abspath(info.path))
 
         # Get remote children to be able to check if a local child found during the scan is really a new item
         # or if it is just the result of a remote creation performed on the file system but not yet updated in the DB
@@ -195,6 +195,14 @@ class RemoteWatcher(EngineWorker):
             db_descendants = self._dao.get_remote_descendants(remote_parent_path)
         descendants = {desc.remote_ref: desc for desc in db_descendants}
 
+        # Group the writes of the scan in a few transactions
+        self._dao.begin_batch()
+        try:
+            self._scan_remote_scroll_descendants(remote_info, descendants)
+        finally:
+            self._dao.end_batch()
+
+    def _scan_remote_scroll_descendants(self, remote_info, descendants):
         to_process = []
         scroll_id = None
         batch_size = 100
@@ -224,7 +232,13 @@ class RemoteWatcher(EngineWorker):
             descendants_info = sorted(descendants_info, key=lambda x: x.path)
 
             # Handle descendants
+            updates = []
+            new_descendants = []
             for descendant_info in descendants_info:
+                if self._client.is_filtered(descendant_info.path):
+                    # A filtered folder and its whole subtree, not even looked up in the database
+                    log.trace('Skipping filtered remote descendant: %r', descendant_info)
+                    continue
                 if self.filtered(descendant_info):
                     log.debug('Ignoring banned file: %r', descendant_info)
                     continue
@@ -234,16 +248,15 @@ class RemoteWatcher(EngineWorker):
                     descendant_pair = descendants.pop(descendant_info.uid)
                     if self._check_modified(descendant_pair, descendant_info):
                         descendant_pair.remote_state = 'modified'
-                    self._dao.update_remote_state(descendant_pair, descendant_info)
+                    updates.append((descendant_pair, descendant_info))
                 else:
-                    parent_pair = self._dao.get_normal_state_from_remote(descendant_info.parent_uid)
-                    if parent_pair is None:
-                        log.trace('Cannot find parent pair of remote descendant, postponing processing of %r',
-                                  descendant_info)
-                        to_process.append(descendant_info)
-                        continue
-                    descendant_pair, _ = self._find_remote_child_match_or_create(parent_pair, descendant_info)
+                    new_descendants.append(descendant_info)
+            # Apply the whole page at once
+            self._dao.update_remote_states(updates)
+            to_process.extend(self._create_remote_descendants(new_descendants))
 
+            # Dont keep the writes pending while waiting for the server or a resume
+            self._dao.commit_batch()
             # Check if synchronization thread was suspended
             self._interact()
 
@@ -265,6 +278,50 @@ class RemoteWatcher(EngineWorker):
         for deleted in descendants.values():
             self._dao.delete_remote_state(deleted)
 
+    def _create_remote_descendants(self, descendants_info):
+        """
+        Create the pairs of new remote descendants sorted by path, in bulk
+        unless they can match an existing pair or local file.
+        Return the descendants whose parent pair cannot be found.
+        """
+        postponed = []
+        if not descendants_info:
+            return postponed
+        parents = self._dao.get_normal_states_from_remote(set(info.parent_uid for info in descendants_info))
+        # Local path and children remote parent path of the known folders
+        folders = {ref: (pair.local_path, pair.remote_parent_path + '/' + ref)
+                   for ref, pair in parents.iteritems()}
+        children = []
+        for descendant_info in descendants_info:
+            if descendant_info.parent_uid not in folders:
+                log.trace('Cannot find parent pair of remote descendant, postponing processing of %r',
+                          descendant_info)
+                postponed.append(descendant_info)
+                continue
+            parent_path, remote_parent_path = folders[descendant_info.parent_uid]
+            local_path = path_join(parent_path, safe_filename(descendant_info.name))
+            children.append((descendant_info, remote_parent_path, local_path, parent_path))
+            if descendant_info.folderish:
+                folders[descendant_info.uid] = (local_path, remote_parent_path + '/' + descendant_info.uid)
+
+        existing = self._dao.get_states_from_local_paths(child[2] for child in children)
+        local_folders = dict()
+        to_insert = []
+        for child in children:
+            descendant_info, _, local_path, parent_path = child
+            if parent_path not in local_folders:
+                local_folders[parent_path] = self._local_client.exists(parent_path)
+            if local_path not in existing and not local_folders[parent_path]:
+                to_insert.append(child)
+                continue
+            # Keep the order as the match can need the previous pairs
+            self._dao.insert_remote_states(to_insert)
+            to_insert = []
+            parent_pair = self._dao.get_normal_state_from_remote(descendant_info.parent_uid)
+            self._find_remote_child_match_or_create(parent_pair, descendant_info)
+        self._dao.insert_remote_states(to_insert)
+        return postponed
+
     @staticmethod
     def _get_elapsed_time_milliseconds(t0, t1):
         delta = t1 - t0
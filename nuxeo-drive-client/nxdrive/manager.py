@@ -319,6 +319,14 @@ class Manager(QtCore.QObject):
             os.mkdir(self.nxdrive_home)
         self.remote_watcher_delay = options.delay
         self._nofscheck = options.nofscheck
+        self.db_wal = options.db_wal
+        self.db_profile = options.db_profile
+        self.compact_db = options.compact_db
+        self.segmented_download = options.segmented_download
+        self.chunked_upload = options.chunked_upload
+        self.upload_connections = options.upload_connections
+        self.min_processors = options.min_processors
+        self.max_processors = options.max_processors
         self.debug = options.debug
         self._engine_definitions = None
 
@@ -495,7 +503,7 @@ class Manager(QtCore.QObject):
 
     def _migrate(self):
         from nxdrive.engine.dao.sqlite import ManagerDAO
-        self._dao = ManagerDAO(self._get_db())
+        self._dao = ManagerDAO(self._get_db(), wal=self.db_wal)
         old_db = os.path.join(normalized_path(self.nxdrive_home), "nxdrive.db")
         if os.path.exists(old_db):
             import sqlite3
@@ -549,7 +557,7 @@ class Manager(QtCore.QObject):
         if not os.path.exists(self._get_db()):
             self._migrate()
             return
-        self._dao = ManagerDAO(self._get_db())
+        self._dao = ManagerDAO(self._get_db(), wal=self.db_wal)
 
     def _create_updater(self, update_check_delay):
         if update_check_delay == 0:
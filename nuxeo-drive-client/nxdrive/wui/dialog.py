@@ -15,7 +15,7 @@ from dateutil.tz import tzlocal
 from nxdrive.client.base_automation_client import Unauthorized
 from nxdrive.client.common import DEFAULT_BETA_SITE_URL
 from nxdrive.engine.activity import Action, FileAction
-from nxdrive.engine.dao.sqlite import StateRow
+from nxdrive.engine.dao.sqlite import DocPair, StateRow
 from nxdrive.engine.engine import Engine
 from nxdrive.engine.workers import Worker
 from nxdrive.logging_config import get_logger
@@ -88,7 +88,7 @@ class WebDriveApi(QtCore.QObject):
             return self._export_engine(obj)
         if isinstance(obj, Notification):
             return self._export_notification(obj)
-        if isinstance(obj, StateRow):
+        if isinstance(obj, (DocPair, StateRow)):
             return self._export_state(obj)
         if isinstance(obj, Worker):
             return self._export_worker(obj)
@@ -0,0 +1,92 @@
+# coding: utf-8
+""" Local HTTP server standing for the Nuxeo Automation API in the tests. """
+
+import json
+import shutil
+import tempfile
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread
+from unittest import TestCase
+
+from nxdrive.client.base_automation_client import BaseAutomationClient, CHANGE_SUMMARY_OPERATION
+
+
+class AutomationHandler(BaseHTTPRequestHandler):
+    """
+    Serve the description of the automation API, the subclasses answer the
+    other requests in get() and post().
+    """
+
+    operations = (CHANGE_SUMMARY_OPERATION,)
+
+    def do_GET(self):
+        if self.path.endswith('/site/automation/'):
+            self.send_json(200, {'operations': [{'id': op_id, 'params': []} for op_id in self.operations]})
+        else:
+            self.get()
+
+    def do_POST(self):
+        self.post()
+
+    def get(self):
+        self.send_empty(404)
+
+    def post(self):
+        self.send_empty(404)
+
+    def send_json(self, status, value):
+        body = json.dumps(value)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class AutomationServer(ThreadingMixIn, HTTPServer):
+    """ Serve each request in its own thread, until stop(). """
+
+    daemon_threads = True
+
+    def __init__(self, handler):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.url = 'http://127.0.0.1:%d/nuxeo/' % self.server_address[1]
+        self._thread = Thread(target=self.serve_forever)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def get_client(url, tmpdir, factory=BaseAutomationClient):
+    return factory(url, 'Administrator', 'device', '1.0', password='Administrator', upload_tmp_dir=tmpdir)
+
+
+class AutomationServerTestCase(TestCase):
+    """ Run a local automation server and a client of it, the handler class adds the routes. """
+
+    handler = AutomationHandler
+
+    def setUp(self):
+        self.server = AutomationServer(self.handler)
+        self.server.start()
+        self.url = self.server.url
+        self.tmpdir = tempfile.mkdtemp()
+        self.client = get_client(self.url, self.tmpdir)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
@@ -351,6 +351,12 @@ class UnitTestCase(SimpleUnitTestCase):
         options.autolock_interval = 30
         options.ignored_prefixes = DEFAULT_IGNORED_PREFIXES
         options.ignored_suffixes = DEFAULT_IGNORED_SUFFIXES
+        options.compact_db = False
+        options.segmented_download = False
+        options.chunked_upload = False
+        options.upload_connections = 1
+        options.min_processors = 1
+        options.max_processors = 16
         options.nxdrive_home = self.nxdrive_conf_folder_1
         self.manager_1 = Manager(options)
         self.connected = False
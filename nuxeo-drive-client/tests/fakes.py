@@ -0,0 +1,83 @@
+# coding: utf-8
+""" Light stand-ins of the engine objects for the tests and the benchmarks without a server. """
+
+from datetime import datetime
+
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
+
+
+def remote_info(uid, parent_uid, name, folderish=False):
+    return RemoteFileInfo(name, uid, parent_uid, '/' + name, folderish,
+                          datetime.utcnow(), 'Administrator', 'digest', 'md5',
+                          None, True, True, True, folderish, None, None,
+                          False)
+
+
+class FakeEngine(object):
+    stopped = False
+
+    def __init__(self, remote_client=None):
+        self.remote_client = remote_client
+
+    def cancel_action_on(self, row_id):
+        pass
+
+    def is_stopped(self):
+        return self.stopped
+
+    def get_remote_client(self):
+        return self.remote_client
+
+
+class FakeDAO(object):
+
+    def register_queue_manager(self, manager, load=True):
+        pass
+
+    def load_queue(self):
+        pass
+
+    def dispose_thread(self):
+        pass
+
+
+class FakeWorker(object):
+
+    def __init__(self):
+        self.started = True
+
+    def is_started(self):
+        return self.started
+
+    def quit(self):
+        self.started = False
+
+
+class FakeThread(object):
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def quit(self):
+        pass
+
+
+class FakeQueueManager(object):
+    """ Count the queued items instead of processing them. """
+
+    def __init__(self):
+        self.count = 0
+
+    def push_ref(self, row_id, folderish, pair_state, size=None, remote_ref=None):
+        self.count += 1
+
+
+class FakePair(object):
+
+    def __init__(self, row_id, pair_state='locally_modified', error_count=1, remote_ref=None, size=None):
+        self.id = row_id
+        self.remote_ref = remote_ref
+        self.folderish = False
+        self.pair_state = pair_state
+        self.error_count = error_count
+        self.size = size
@@ -0,0 +1,135 @@
+# coding: utf-8
+"""
+Upload of a large file in a single request or in chunks, then after a failure.
+
+A local HTTP server stands for the Nuxeo batch upload API on a high latency
+link: it answers after the round trip time and reads each connection at a
+fixed speed, like a TCP window does.  The upload is then interrupted when
+the server got most of the bytes, and tried again:
+
+    python tests/manual/benchmark_chunked_upload.py [--size 64] [--speed 8]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from threading import Lock
+
+from nxdrive.client import base_automation_client
+from tests.automation_server import AutomationHandler, AutomationServer, get_client
+
+CHUNK = 64 * 1024
+
+
+class Handler(AutomationHandler):
+
+    def get(self):
+        server = self.server
+        time.sleep(server.rtt)
+        chunks = server.batches.get(self.path.split('/')[-2])
+        if not chunks:
+            self.send_empty(404)
+            return
+        self.send_json(200, {'uploadType': 'chunked', 'uploadedChunkIds': sorted(chunks)})
+
+    def post(self):
+        server = self.server
+        time.sleep(server.rtt)
+        parts = self.path.split('/')
+        if self.path.endswith('/api/v1/upload'):
+            with server.lock:
+                batch_id = 'batch%d' % len(server.batches)
+                server.batches[batch_id] = dict()
+            self.send_json(201, {'batchId': batch_id})
+            return
+        if 'execute' in parts:
+            server.batches.pop(parts[-4])
+            self.send_json(200, {'uid': 'doc'})
+            return
+        length = int(self.headers.getheader('Content-Length'))
+        begin = time.time()
+        for offset in range(0, length, CHUNK):
+            size = min(CHUNK, length - offset)
+            with server.lock:
+                if server.cut is not None and server.received + size > server.cut:
+                    # The network goes down
+                    server.cut = None
+                    self.close_connection = 1
+                    return
+                server.received += size
+            self.rfile.read(size)
+            # Hold the speed of the connection
+            delay = begin + float(offset + size) / server.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        index = self.headers.getheader('X-Upload-Chunk-Index')
+        with server.lock:
+            chunks = server.batches[parts[-2]]
+            chunks[int(index or 0)] = True
+            count = int(self.headers.getheader('X-Upload-Chunk-Count') or 1)
+            done = len(chunks) == count
+        self.send_json(201 if done else 308, {'batchId': parts[-2], 'uploaded': 'true'})
+
+
+def upload(client, file_path, chunked, connections):
+    return client.execute_with_blob_streaming('NuxeoDrive.CreateFile', file_path, chunked=chunked,
+                                              connections=connections)
+
+
+def bench(server, client, file_path, label, chunked, connections, size):
+    server.received = 0
+    start = time.time()
+    upload(client, file_path, chunked, connections)
+    elapsed = time.time() - start
+    # Interrupted at 90%, then tried again
+    server.received = 0
+    server.cut = int(size * 0.9)
+    try:
+        upload(client, file_path, chunked, connections)
+    except Exception:
+        pass
+    server.cut = None
+    server.received = 0
+    upload(client, file_path, chunked, connections)
+    resent = server.received
+    print('%-11s %4d MB | %6.2fs | %6.1f MB/s | %6.1f MB sent again after a failure' % (
+        label, size // 1024 ** 2, elapsed, size / elapsed / 1024 ** 2, resent / 1024.0 ** 2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=64, help='size of the file, in MB')
+    parser.add_argument('--chunk-size', type=int, default=8, help='size of a chunk, in MB')
+    parser.add_argument('--connections', type=int, default=4, help='parallel chunk uploads')
+    parser.add_argument('--speed', type=float, default=8, help='speed of a connection, in MB/s')
+    parser.add_argument('--rtt', type=float, default=0.1, help='round trip time, in seconds')
+    args = parser.parse_args()
+    base_automation_client.UPLOAD_CHUNK_SIZE = args.chunk_size * 1024 ** 2
+    server = AutomationServer(Handler)
+    server.batches = dict()
+    server.lock = Lock()
+    server.speed = args.speed * 1024 ** 2
+    server.rtt = args.rtt
+    server.cut = None
+    server.start()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        client = get_client(server.url, tmpdir)
+        file_path = os.path.join(tmpdir, 'video.mp4')
+        size = args.size * 1024 ** 2
+        with open(file_path, 'wb') as f:
+            f.write(os.urandom(size))
+        bench(server, client, file_path, 'single', False, 1, size)
+        bench(server, client, file_path, 'chunked', True, 1, size)
+        bench(server, client, file_path, 'chunked x%d' % args.connections, True, args.connections, size)
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
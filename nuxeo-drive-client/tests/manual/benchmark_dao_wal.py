@@ -0,0 +1,99 @@
+# coding: utf-8
+"""
+Read latency of the engine database while a remote full scan is writing.
+
+A writer thread inserts remote states by scroll pages, one transaction
+per page, while a reader thread fetches states and children lists as the
+UI and the processors do.  Both journal modes are measured:
+
+    python tests/manual/benchmark_dao_wal.py [--items 20000] [--page 100]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from threading import Event, Thread
+
+from nxdrive.engine.dao.sqlite import EngineDAO
+from tests.fakes import remote_info
+
+
+def scan(dao, items, page, folders):
+    """ Insert the items as the remote watcher does for a scroll page. """
+
+    for start in range(0, items, page):
+        dao.begin_transaction()
+        try:
+            for i in range(start, min(start + page, items)):
+                folder = u'folder%d' % (i % folders)
+                name = u'file%d.txt' % i
+                dao.insert_remote_state(
+                    remote_info('remote#%d' % i, 'remote#' + folder, name),
+                    u'/root/' + folder, u'/' + folder + u'/' + name,
+                    u'/' + folder)
+        finally:
+            dao.end_transaction()
+
+
+def read(dao, folders, stop, latencies):
+    """ Fetch states like the UI and the processors. """
+
+    i = 0
+    while not stop.is_set():
+        folder = u'/folder%d' % (i % folders)
+        start = time.time()
+        dao.get_state_from_local(folder)
+        dao.get_local_children(folder)
+        latencies.append(time.time() - start)
+        i += 1
+    dao.dispose_thread()
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def bench(wal, items, page, folders):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dao = EngineDAO(os.path.join(tmpdir, 'bench.db'), wal=wal)
+        for i in range(folders):
+            name = u'folder%d' % i
+            dao.insert_remote_state(remote_info('remote#' + name, 'remote#root', name, folderish=True),
+                                    u'/root', u'/' + name, u'/')
+        latencies = []
+        stop = Event()
+        reader = Thread(target=read, args=(dao, folders, stop, latencies))
+        reader.start()
+        start = time.time()
+        scan(dao, items, page, folders)
+        elapsed = time.time() - start
+        stop.set()
+        reader.join()
+        dao.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('%-6s scan %6.2fs | %6d reads | p50 %7.2fms | p95 %7.2fms | max %7.2fms' % (
+        'WAL' if wal else 'MEMORY', elapsed, len(latencies),
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000,
+        max(latencies) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--page', type=int, default=100)
+    parser.add_argument('--folders', type=int, default=50)
+    args = parser.parse_args()
+    for wal in (False, True):
+        bench(wal, args.items, args.page, args.folders)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# coding: utf-8
+"""
+Time to synchronize a new deep tree whose items are queued before their parents.
+
+The processors of the queue manager handle a tree of new items pushed in a
+random order.  An item whose parent is not synchronized yet is postponed,
+either with the retry delay like before or until the end of its parent
+processing.  The retry delay is shortened, it is 60s in Drive:
+
+    python tests/manual/benchmark_dependent_pairs.py [--items 50000] [--depth 10]
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import time
+from threading import Thread
+
+from nxdrive.engine.queue_manager import QueueManager
+from tests.fakes import FakeDAO, FakeEngine, FakePair, FakeWorker
+
+
+def build_tree(items, depth):
+    """ Items spread on the levels, each one with a random parent on the previous level. """
+    tree = dict()
+    level = [None]
+    row_id = 1
+    for index in range(depth):
+        size = items // depth + (1 if index < items % depth else 0)
+        parents = level
+        level = []
+        for _ in range(size):
+            pair = FakePair(row_id, pair_state='locally_created')
+            pair.parent = random.choice(parents)
+            tree[row_id] = pair
+            level.append(row_id)
+            row_id += 1
+    return tree
+
+
+def process(manager, tree, done, dependency, interval, cost, worker):
+    while 'There are items in the queue':
+        item = manager._wait_item(manager._get_file, worker)
+        if item is None:
+            return
+        pair = tree[item.id]
+        if pair.parent is not None and pair.parent not in done:
+            if dependency:
+                manager.push_after(pair, pair.parent, interval=interval)
+            else:
+                manager.push_error(pair, interval=interval)
+        else:
+            time.sleep(cost)
+            done.add(pair.id)
+        manager.release_dependents(pair)
+
+
+def bench(tree, dependency, args):
+    manager = QueueManager(FakeEngine(), FakeDAO())
+    # No Qt event loop here, the error timer is triggered below
+    manager.newError.disconnect(manager._on_new_error)
+    done = set()
+    workers = [FakeWorker() for _ in range(args.processors)]
+    threads = [Thread(target=process, args=(manager, tree, done, dependency, args.interval, args.cost, worker))
+               for worker in workers]
+    ids = list(tree)
+    random.shuffle(ids)
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for row_id in ids:
+        manager.push(tree[row_id])
+    while len(done) < len(tree):
+        time.sleep(0.01)
+        manager._on_error_timer()
+    elapsed = time.time() - start
+    for worker in workers:
+        worker.started = False
+    for thread in threads:
+        thread.join()
+    print('%-10s %6d items | %7.2fs' % ('dependency' if dependency else 'postpone', len(tree), elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--items', type=int, default=50000)
+    parser.add_argument('--depth', type=int, default=10)
+    parser.add_argument('--processors', type=int, default=5)
+    parser.add_argument('--interval', type=float, default=5, help='retry delay of a postponed pair, in seconds')
+    parser.add_argument('--cost', type=float, default=0.0001, help='synchronization time of an item, in seconds')
+    args = parser.parse_args()
+    tree = build_tree(args.items, args.depth)
+    for dependency in (False, True):
+        bench(tree, dependency, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# coding: utf-8
+"""
+Queue related queries against growing trees with the same hot pairs.
+
+Each tree has the same number of pairs to synchronize, in error and in
+conflict, all the others are synchronized.  The query times should not
+depend on the tree size:
+
+    python tests/manual/benchmark_hot_states.py [--sizes 10000 100000 500000]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from nxdrive.engine.dao.sqlite import EngineDAO
+from tests.fakes import FakeQueueManager, remote_info
+
+PAGE = 1000
+
+
+def populate(db, size, pending, errors, conflicts, folders):
+    dao = EngineDAO(db)
+    dao.insert_remote_states([
+        (remote_info('remote#folder%d' % i, 'remote#root', u'folder%d' % i, folderish=True),
+         u'/root', u'/folder%d' % i, u'/') for i in range(folders)])
+    for start in range(0, size, PAGE):
+        dao.insert_remote_states([
+            (remote_info('remote#%d' % i, 'remote#folder%d' % (i % folders), u'file%d.txt' % i),
+             u'/root/folder%d' % (i % folders), u'/folder%d/file%d.txt' % (i % folders, i),
+             u'/folder%d' % (i % folders)) for i in range(start, min(start + PAGE, size))])
+    con = dao._get_write_connection()
+    hot = pending + errors + conflicts
+    con.execute("UPDATE States SET local_state='synchronized', remote_state='synchronized',"
+                " pair_state='synchronized' WHERE id > ?", (hot,))
+    con.execute("UPDATE States SET error_count=5, last_error='ERROR' WHERE id > ? AND id <= ?",
+                (pending, pending + errors))
+    con.execute("UPDATE States SET pair_state='conflicted' WHERE id > ? AND id <= ?",
+                (pending + errors, hot))
+    con.commit()
+    dao.dispose()
+
+
+def timed(function, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        function()
+    return (time.time() - start) / repeat * 1000
+
+
+def bench(size, args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = os.path.join(tmpdir, 'bench.db')
+        populate(db, size, args.pending, args.errors, args.conflicts, args.folders)
+        start = time.time()
+        dao = EngineDAO(db)
+        startup = (time.time() - start) * 1000
+        queue_manager = FakeQueueManager()
+        dao.register_queue_manager(queue_manager, load=False)
+        results = [
+            ('startup', startup),
+            ('load_queue', timed(dao.load_queue, args.repeat)),
+            ('get_errors', timed(dao.get_errors, args.repeat)),
+            ('get_conflicts', timed(dao.get_conflicts, args.repeat)),
+            ('get_syncing_count', timed(dao.get_syncing_count, args.repeat)),
+            ('release_processor', timed(lambda: dao.release_processor(1), args.repeat)),
+            ('reinit_processors', timed(dao.reinit_processors, args.repeat)),
+        ]
+        dao.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+    print('%8d states | ' % size + ' | '.join('%s %7.2fms' % result for result in results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 500000])
+    parser.add_argument('--pending', type=int, default=1000)
+    parser.add_argument('--errors', type=int, default=100)
+    parser.add_argument('--conflicts', type=int, default=50)
+    parser.add_argument('--folders', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    for size in args.sizes:
+        bench(size, args)
+
+
+if __name__ == '__main__':
+    main()
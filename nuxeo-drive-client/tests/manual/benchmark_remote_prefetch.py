@@ -0,0 +1,91 @@
+# coding: utf-8
+"""
+Remote state check of the locally modified files over a slow link.
+
+The processors of the queue manager handle locally modified files, each one
+first asks for the remote info of its pair.  The remote client answers after
+the round trip time.  The time spent by the processors on that check is
+measured with a call by pair like before, then with the prefetched infos:
+
+    python tests/manual/benchmark_remote_prefetch.py [--items 500] [--rtt 0.1]
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+from threading import Lock, Thread
+
+from nxdrive.engine.queue_manager import QueueManager
+from tests.fakes import FakeDAO, FakeEngine, FakePair, FakeWorker
+
+
+class RemoteClient(object):
+
+    def __init__(self, rtt):
+        self.rtt = rtt
+
+    def get_info(self, remote_ref, raise_if_missing=True):
+        time.sleep(self.rtt)
+        return remote_ref
+
+
+def get_pair(row_id):
+    return FakePair(row_id, remote_ref='remote#%d' % row_id)
+
+
+def process(manager, remote_client, prefetch, cost, checks, lock, worker):
+    while 'There are items in the queue':
+        item = manager._wait_item(manager._get_file, worker)
+        if item is None:
+            return
+        pair = get_pair(item.id)
+        start = time.time()
+        if prefetch:
+            manager.get_remote_info(remote_client, pair)
+        else:
+            remote_client.get_info(pair.remote_ref)
+        with lock:
+            checks.append(time.time() - start)
+        # The upload
+        time.sleep(cost)
+
+
+def bench(prefetch, args):
+    remote_client = RemoteClient(args.rtt)
+    manager = QueueManager(FakeEngine(remote_client), FakeDAO(), max_file_processors=args.processors, adaptive=False)
+    manager._loader.join()
+    checks = []
+    lock = Lock()
+    workers = [FakeWorker() for _ in range(args.processors)]
+    threads = [Thread(target=process, args=(manager, remote_client, prefetch, args.cost, checks, lock, worker))
+               for worker in workers]
+    for row_id in range(args.items):
+        manager.push(get_pair(row_id))
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    while len(checks) < args.items or len(manager._busy):
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    for worker in workers:
+        worker.started = False
+    for thread in threads:
+        thread.join()
+    print('%-8s %5d files | remote check %6.1fms by file | total %6.2fs' % (
+        'prefetch' if prefetch else 'direct', len(checks), sum(checks) / len(checks) * 1000, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--items', type=int, default=500)
+    parser.add_argument('--processors', type=int, default=5)
+    parser.add_argument('--rtt', type=float, default=0.1, help='round trip time, in seconds')
+    parser.add_argument('--cost', type=float, default=0.2, help='upload time of a file, in seconds')
+    args = parser.parse_args()
+    for prefetch in (False, True):
+        bench(prefetch, args)
+
+
+if __name__ == '__main__':
+    main()
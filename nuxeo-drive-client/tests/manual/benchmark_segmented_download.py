@@ -0,0 +1,88 @@
+# coding: utf-8
+"""
+Download of a large blob over a single connection or parallel segments.
+
+A local HTTP server stands for the Nuxeo server on a high latency link:
+it answers after the round trip time and each connection is limited to a
+fixed speed, like a TCP window does.  It accepts the Range requests:
+
+    python tests/manual/benchmark_segmented_download.py [--size 64] [--speed 8]
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from tests.automation_server import AutomationHandler, AutomationServer, get_client
+
+CHUNK = 64 * 1024
+
+
+class Handler(AutomationHandler):
+
+    def get(self):
+        server = self.server
+        time.sleep(server.rtt)
+        start, end = 0, len(server.content)
+        range_ = self.headers.getheader('Range')
+        if range_ is not None:
+            first, last = range_[len('bytes='):].split('-')
+            start = int(first)
+            if last:
+                end = min(end, int(last) + 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, len(server.content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('ETag', '"blob"')
+        self.end_headers()
+        begin = time.time()
+        for offset in range(start, end, CHUNK):
+            self.wfile.write(server.content[offset:min(end, offset + CHUNK)])
+            # Hold the speed of the connection
+            delay = begin + float(offset + CHUNK - start) / server.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def bench(client, url, file_out, digest, segmented, size):
+    start = time.time()
+    client.do_get(url, file_out=file_out, digest=digest, digest_algorithm='md5', segmented=segmented)
+    elapsed = time.time() - start
+    os.remove(file_out)
+    print('%-9s %4d MB | %6.2fs | %6.1f MB/s' % ('segmented' if segmented else 'single', size, elapsed,
+                                                 size / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=64, help='size of the blob, in MB')
+    parser.add_argument('--speed', type=float, default=8, help='speed of a connection, in MB/s')
+    parser.add_argument('--rtt', type=float, default=0.1, help='round trip time, in seconds')
+    args = parser.parse_args()
+    server = AutomationServer(Handler)
+    server.content = os.urandom(args.size * 1024 ** 2)
+    server.speed = args.speed * 1024 ** 2
+    server.rtt = args.rtt
+    server.start()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        url = server.url
+        client = get_client(url, tmpdir)
+        file_out = os.path.join(tmpdir, '.blob.nxpart')
+        digest = hashlib.md5(server.content).hexdigest()
+        for segmented in (False, True):
+            bench(client, url + 'blob', file_out, digest, segmented, args.size)
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# coding: utf-8
+"""
+Sync latency of the office documents during large media transfers.
+
+The processors of the queue manager download large files, the transfer
+time depends on the size, while small documents keep being modified.  The
+median and 90th percentile latencies of the documents, from their push to
+the end of their synchronization, are measured without the sizes (a single
+FIFO lane like before) and with the size lanes:
+
+    python tests/manual/benchmark_size_lanes.py [--large 20] [--small 200]
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import time
+from threading import Thread
+
+from nxdrive.engine.queue_manager import QueueManager, SMALL_LANE, get_lane
+from tests.fakes import FakeDAO, FakeEngine, FakePair, FakeWorker
+
+KB = 1024
+MB = 1024 * KB
+
+
+def process(manager, pairs, pushed, latencies, bandwidth, worker):
+    while 'There are items in the queue':
+        item = manager._wait_item(manager._get_file, worker)
+        if item is None:
+            return
+        pair = pairs[item.id]
+        time.sleep(float(pair.size) / bandwidth)
+        if get_lane(pair) == SMALL_LANE:
+            latencies.append(time.time() - pushed[pair.id])
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def bench(lanes, args):
+    manager = QueueManager(FakeEngine(), FakeDAO(), max_file_processors=args.processors, adaptive=False)
+    manager._loader.join()
+    pairs = dict()
+    pushed = dict()
+    latencies = []
+    workers = [FakeWorker() for _ in range(args.processors)]
+    threads = [Thread(target=process, args=(manager, pairs, pushed, latencies, args.bandwidth * MB, worker))
+               for worker in workers]
+    for thread in threads:
+        thread.start()
+
+    def push(pair):
+        pairs[pair.id] = pair
+        pushed[pair.id] = time.time()
+        if lanes:
+            manager.push(pair)
+        else:
+            manager.push_ref(pair.id, pair.folderish, pair.pair_state)
+
+    random.seed(args.seed)
+    start = time.time()
+    for row_id in range(args.large):
+        push(FakePair(row_id, pair_state='remotely_modified', size=args.large_size * MB))
+    # The documents are saved at a steady pace during the transfers
+    for row_id in range(args.large, args.large + args.small):
+        time.sleep(args.pace)
+        push(FakePair(row_id, size=random.randint(10, 500) * KB))
+    while len(latencies) < args.small or manager.get_overall_size() or len(manager._busy):
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    for worker in workers:
+        worker.started = False
+    for thread in threads:
+        thread.join()
+    print('%-8s %4d documents | median %6.3fs | p90 %6.3fs | total %6.2fs' % (
+        'lanes' if lanes else 'fifo', len(latencies), percentile(latencies, 0.5), percentile(latencies, 0.9),
+        elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--large', type=int, default=20, help='count of large media files')
+    parser.add_argument('--large-size', type=int, default=200, help='size of a media file, in MB')
+    parser.add_argument('--small', type=int, default=200, help='count of office documents')
+    parser.add_argument('--pace', type=float, default=0.02, help='time between two documents, in seconds')
+    parser.add_argument('--processors', type=int, default=5)
+    parser.add_argument('--bandwidth', type=float, default=100, help='transfer speed of a processor, in MB/s')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for lanes in (False, True):
+        bench(lanes, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# coding: utf-8
+"""
+Cost of the state rows: sqlite3.Row with a lookup by name or DocPair slots.
+
+The same database is read with both row factories by the queue init,
+the children listing and a loop reading the pairs as the processors do:
+
+    python tests/manual/benchmark_state_rows.py [--items 50000]
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import os
+import shutil
+import tempfile
+import time
+
+import psutil
+
+from nxdrive.engine.dao.sqlite import EngineDAO, StateRow, doc_pair_factory
+from tests.fakes import FakeQueueManager, remote_info
+
+# Attributes read by Processor._execute and its handlers for a pair
+PROCESSOR_ATTRIBUTES = ('id', 'pair_state', 'local_state', 'remote_state', 'folderish', 'local_path',
+                        'local_parent_path', 'remote_ref', 'remote_parent_ref', 'local_digest',
+                        'remote_digest', 'remote_name', 'local_name', 'version', 'processor')
+
+
+def populate(db, items, folders):
+    dao = EngineDAO(db)
+    dao.insert_remote_states([
+        (remote_info('remote#folder%d' % i, 'remote#root', u'folder%d' % i, folderish=True),
+         u'/root', u'/folder%d' % i, u'/') for i in range(folders)])
+    dao.insert_remote_states([
+        (remote_info('remote#%d' % i, 'remote#folder%d' % (i % folders), u'file%d.txt' % i),
+         u'/root/folder%d' % (i % folders), u'/folder%d/file%d.txt' % (i % folders, i),
+         u'/folder%d' % (i % folders)) for i in range(items)])
+    dao.dispose()
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def read_children(dao, folders):
+    for i in range(folders):
+        for pair in dao.get_local_children(u'/folder%d' % i):
+            pair.local_path
+
+
+def read_pairs(pairs):
+    for pair in pairs:
+        for name in PROCESSOR_ATTRIBUTES:
+            getattr(pair, name)
+
+
+def memory(dao):
+    """ Resident memory taken by all the states, in bytes by state. """
+
+    gc.collect()
+    process = psutil.Process()
+    before = process.memory_info().rss
+    pairs = dao.get_states_from_partial_local(u'/')
+    after = process.memory_info().rss
+    return pairs, float(after - before) / len(pairs)
+
+
+def bench(db, factory, folders):
+    dao = EngineDAO(db, state_factory=factory)
+    queue_manager = FakeQueueManager()
+    init = timed(dao.register_queue_manager, queue_manager)
+    children = timed(read_children, dao, folders)
+    pairs, size = memory(dao)
+    loop = timed(read_pairs, pairs)
+    dao.dispose()
+    print('%-16s queue init %6.3fs (%d) | children %6.3fs | processor loop %6.3fs | %5d bytes by state' % (
+        factory.__name__, init, queue_manager.count, children, loop, size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--items', type=int, default=50000)
+    parser.add_argument('--folders', type=int, default=100)
+    args = parser.parse_args()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = os.path.join(tmpdir, 'bench.db')
+        populate(db, args.items, args.folders)
+        for factory in (StateRow, doc_pair_factory):
+            bench(db, factory, args.folders)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,8 @@
 # coding: utf-8
 import unittest
-from time import sleep
+from time import sleep, time
 
-from nxdrive.engine.blacklist_queue import BlacklistQueue
+from nxdrive.engine.blacklist_queue import BlacklistQueue, RetryScheduler, jittered
 from tests.common_unit_test import RandomBug
 
 
@@ -11,8 +11,8 @@ class BlacklistQueueTest(unittest.TestCase):
     @RandomBug('NXDRIVE-767', target='mac', mode='BYPASS')
     def test_delay(self):
         sleep_time = 3
-        # Push two items with a delay of 1s
-        queue = BlacklistQueue(delay=1)
+        # Push two items with a delay of 1s, exactly
+        queue = BlacklistQueue(delay=1, jitter=0)
         queue.push(1, "Item1")
         queue.push(2, "Item2")
 
@@ -58,3 +58,55 @@ class BlacklistQueueTest(unittest.TestCase):
         self.assertEqual(item._count, 3)
         item = queue.get()
         self.assertIsNone(item)
+
+
+    def test_jitter(self):
+        queue = BlacklistQueue(delay=60)
+        for item_id in range(100):
+            queue.push(item_id, "Item")
+        start = time()
+        items = queue._queue.items()
+        self.assertTrue(all(start + 50 <= item.get_next_try() <= start + 67 for item in items))
+        self.assertGreater(len(set(item.get_next_try() for item in items)), 1)
+        # The growing delays are spread too
+        for item in items:
+            item.increase()
+        self.assertTrue(all(start + 104 <= item.get_next_try() <= start + 133 for item in items))
+
+
+class RetrySchedulerTest(unittest.TestCase):
+
+    def test_order(self):
+        scheduler = RetryScheduler()
+        scheduler.push(1, "Item1", 30)
+        scheduler.push(2, "Item2", 10)
+        scheduler.push(3, "Item3", 20)
+        self.assertEqual(len(scheduler), 3)
+        self.assertEqual(scheduler.next_deadline(), 10)
+        self.assertIsNone(scheduler.pop(10))
+        self.assertEqual(scheduler.pop(25), "Item2")
+        self.assertEqual(scheduler.pop(25), "Item3")
+        self.assertIsNone(scheduler.pop(25))
+        self.assertEqual(scheduler.pop(31), "Item1")
+        self.assertEqual(len(scheduler), 0)
+        self.assertIsNone(scheduler.next_deadline())
+
+    def test_reschedule(self):
+        scheduler = RetryScheduler()
+        scheduler.push(1, "Item1", 10)
+        scheduler.push(2, "Item2", 20)
+        # Only the last schedule of an item counts
+        scheduler.push(1, "Item1bis", 30)
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(scheduler.next_deadline(), 20)
+        self.assertEqual(scheduler.items(), ["Item2", "Item1bis"])
+        self.assertEqual(scheduler.remove(2), "Item2")
+        self.assertNotIn(2, scheduler)
+        self.assertIsNone(scheduler.pop(25))
+        scheduler.reschedule_all(0)
+        self.assertEqual(scheduler.pop(1), "Item1bis")
+
+    def test_jittered(self):
+        delays = [jittered(60) for _ in range(100)]
+        self.assertTrue(all(54 <= delay <= 66 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
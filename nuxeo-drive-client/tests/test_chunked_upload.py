@@ -0,0 +1,117 @@
+# coding: utf-8
+import hashlib
+import os
+import urllib2
+from threading import Lock
+
+from mock import patch
+
+from nxdrive.client.base_automation_client import get_chunks_count
+from tests.automation_server import AutomationHandler, AutomationServerTestCase, get_client
+
+CONTENT = os.urandom(3 * 1024 ** 2 + 100)
+
+
+class BatchHandler(AutomationHandler):
+    """ Serve the batch upload API, with the chunked uploads. """
+
+    def get(self):
+        server = self.server
+        # /nuxeo/api/v1/upload/<batch id>/<file index>
+        chunks = server.batches.get(self.path.split('/')[-2])
+        if not chunks:
+            self.send_empty(404)
+            return
+        self.send_json(200, {'uploadType': 'chunked', 'uploadedChunkIds': sorted(chunks),
+                             'chunkCount': server.chunk_count})
+
+    def post(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        parts = self.path.split('/')
+        if self.path.endswith('/api/v1/upload'):
+            with server.lock:
+                batch_id = 'batch%d' % len(server.batches)
+                server.batches[batch_id] = dict()
+            self.send_json(201, {'batchId': batch_id})
+        elif 'execute' in parts:
+            chunks = server.batches.pop(parts[-4])
+            content = ''.join(chunks[index] for index in sorted(chunks))
+            # The file system item of the document, when set
+            self.send_json(200, dict(server.fs_item, digest=hashlib.md5(content).hexdigest()))
+        elif self.headers.getheader('X-Upload-Type') != 'chunked':
+            # The whole file in a single request
+            with server.lock:
+                server.posted.append(None)
+                server.batches[parts[-2]][0] = body
+            self.send_json(201, {'batchId': parts[-2], 'uploaded': 'true'})
+        else:
+            index = int(self.headers.getheader('X-Upload-Chunk-Index'))
+            server.chunk_count = int(self.headers.getheader('X-Upload-Chunk-Count'))
+            with server.lock:
+                server.posted.append(index)
+                if index in server.fail:
+                    server.fail.remove(index)
+                    self.send_json(500, {'message': 'Chunk lost'})
+                    return
+                chunks = server.batches[parts[-2]]
+                chunks[index] = body
+                done = len(chunks) == server.chunk_count
+            self.send_json(201 if done else 308, {'batchId': parts[-2], 'uploaded': 'true'})
+
+
+def init_batch_server(server):
+    server.batches = dict()
+    server.chunk_count = None
+    server.fs_item = dict()
+    server.posted = []
+    server.fail = []
+    server.lock = Lock()
+
+
+@patch('nxdrive.client.base_automation_client.UPLOAD_CHUNK_SIZE', 1024 ** 2)
+class ChunkedUploadTest(AutomationServerTestCase):
+
+    handler = BatchHandler
+
+    def setUp(self):
+        super(ChunkedUploadTest, self).setUp()
+        init_batch_server(self.server)
+        self.file_path = os.path.join(self.tmpdir, 'video.mp4')
+        with open(self.file_path, 'wb') as f:
+            f.write(CONTENT)
+
+    def _upload(self, connections=1):
+        return self.client.execute_with_blob_streaming('NuxeoDrive.CreateFile', self.file_path, chunked=True,
+                                                       connections=connections)
+
+    def test_chunks_count(self):
+        self.assertEqual(get_chunks_count(0), 1)
+        self.assertEqual(get_chunks_count(len(CONTENT)), 4)
+        self.assertEqual(get_chunks_count(4 * 1024 ** 2), 4)
+
+    def test_chunked(self):
+        self.assertEqual(self._upload(connections=3), {'digest': hashlib.md5(CONTENT).hexdigest()})
+        self.assertEqual(sorted(self.server.posted), [0, 1, 2, 3])
+        self.assertFalse(os.path.exists(self.client.get_upload_state_file(self.file_path)))
+
+    def test_resume(self):
+        self.server.fail.append(2)
+        self.assertRaises(urllib2.HTTPError, self._upload)
+        self.assertEqual(self.server.posted, [0, 1, 2])
+        self.assertTrue(os.path.exists(self.client.get_upload_state_file(self.file_path)))
+        # After a restart, only the missing chunks are sent in the same batch
+        self.client = get_client(self.url, self.tmpdir)
+        self.assertEqual(self._upload(), {'digest': hashlib.md5(CONTENT).hexdigest()})
+        self.assertEqual(self.server.posted, [0, 1, 2, 2, 3])
+        self.assertFalse(self.server.batches)
+
+    def test_changed_file(self):
+        self.server.fail.append(1)
+        self.assertRaises(urllib2.HTTPError, self._upload)
+        with open(self.file_path, 'wb') as f:
+            f.write(CONTENT[10:])
+        # The chunks of the previous content are not used
+        self.assertEqual(self._upload(), {'digest': hashlib.md5(CONTENT[10:]).hexdigest()})
+        self.assertEqual(self.server.posted, [0, 1, 0, 1, 2, 3])
+        self.assertEqual(list(self.server.batches), ['batch0'])
@@ -53,6 +53,27 @@ class CommandLineTestCase(unittest.TestCase):
         self.assertEqual(options.update_site_url, "DEBUG_TEST",
                             "Should be debug test")
 
+    def test_compact_db(self):
+        self.assertFalse(self.cmd.parse_cli([]).compact_db)
+        self.assertTrue(self.cmd.parse_cli(["ndrive", "--compact-db"]).compact_db)
+
+    def test_processors_options(self):
+        options = self.cmd.parse_cli([])
+        self.assertEqual((options.min_processors, options.max_processors), (1, 16))
+        options = self.cmd.parse_cli(["ndrive", "--min-processors=2", "--max-processors=4"])
+        self.assertEqual((options.min_processors, options.max_processors), (2, 4))
+
+    def test_transfer_options(self):
+        options = self.cmd.parse_cli([])
+        self.assertFalse(options.segmented_download)
+        options = self.cmd.parse_cli(["ndrive", "--segmented-download"])
+        self.assertTrue(options.segmented_download)
+        self.assertFalse(options.chunked_upload)
+        self.assertEqual(options.upload_connections, 4)
+        options = self.cmd.parse_cli(["ndrive", "--chunked-upload", "--upload-connections=2"])
+        self.assertTrue(options.chunked_upload)
+        self.assertEqual(options.upload_connections, 2)
+
     def test_system_default(self):
         original = AbstractOSIntegration.get
         AbstractOSIntegration.get = staticmethod(getOSIntegration)
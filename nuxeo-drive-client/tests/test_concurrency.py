@@ -0,0 +1,67 @@
+# coding: utf-8
+import socket
+import unittest
+from urllib2 import HTTPError, URLError
+
+from nxdrive.engine.concurrency import ADAPTIVE_HOLD, ConcurrencyController, is_congestion
+
+
+class ConcurrencyControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = ConcurrencyController(3, 1, 8, window=10)
+        self.time = self.controller._window_start
+
+    def _window(self, files, size=0, congestions=0, backlog=100):
+        for _ in range(files):
+            self.controller.record_sync(size)
+        for _ in range(congestions):
+            self.controller.record_congestion()
+        self.time += 10
+        return self.controller.update(backlog, cur_time=self.time)
+
+    def test_window(self):
+        self.controller.record_sync(1024)
+        self.assertEqual(self.controller.update(100, cur_time=self.time + 5), 3)
+        self.assertEqual(self.controller.update(100, cur_time=self.time + 10), 4)
+        metrics = self.controller.get_metrics()
+        self.assertEqual(metrics['processors_level'], 4)
+        self.assertEqual(metrics['processors_files_rate'], 0.1)
+        self.assertEqual(metrics['processors_bytes_rate'], 102.4)
+
+    def test_additive_increase(self):
+        levels = [self._window(files) for files in (100, 200, 300, 400, 500, 600, 700)]
+        self.assertEqual(levels, [4, 5, 6, 7, 8, 8, 8])
+
+    def test_no_gain(self):
+        self.assertEqual(self._window(100), 4)
+        self.assertEqual(self._window(200), 5)
+        # The fifth processor did not bring more files or bytes
+        self.assertEqual(self._window(200), 4)
+        for _ in range(ADAPTIVE_HOLD):
+            self.assertEqual(self._window(200), 4)
+        self.assertEqual(self._window(200), 5)
+
+    def test_bytes_gain(self):
+        self.assertEqual(self._window(100, size=1000), 4)
+        # Less files but bigger ones
+        self.assertEqual(self._window(50, size=4000), 5)
+
+    def test_congestion(self):
+        self.assertEqual(self._window(100), 4)
+        self.assertEqual(self._window(100, congestions=1), 2)
+        self.assertEqual(self._window(100, congestions=5), 1)
+        self.assertEqual(self.controller.get_metrics()['processors_congestions'], 6)
+
+    def test_no_backlog(self):
+        self.assertEqual(self._window(100, backlog=0), 3)
+        self.assertEqual(self._window(0, backlog=0), 3)
+
+    def test_is_congestion(self):
+        self.assertTrue(is_congestion(HTTPError('http://localhost', 503, 'Service Unavailable', None, None)))
+        self.assertTrue(is_congestion(HTTPError('http://localhost', 429, 'Too Many Requests', None, None)))
+        self.assertFalse(is_congestion(HTTPError('http://localhost', 404, 'Not Found', None, None)))
+        self.assertTrue(is_congestion(socket.timeout('timed out')))
+        self.assertTrue(is_congestion(URLError(socket.timeout('timed out'))))
+        self.assertFalse(is_congestion(URLError('refused')))
+        self.assertFalse(is_congestion(ValueError()))
@@ -1,11 +1,17 @@
 # coding: utf-8
 import os
+import sqlite3
 import sys
 import tempfile
 import unittest
+from datetime import datetime
+from threading import Thread, Timer
 
-from nxdrive.engine.dao.sqlite import EngineDAO
+from mock import Mock, patch
+
+from nxdrive.engine.dao.sqlite import DocPair, EngineDAO, SCHEMA_VERSION, StateRow
 from nxdrive.engine.engine import Engine
+from tests.fakes import remote_info
 
 
 class EngineDAOTest(unittest.TestCase):
@@ -42,6 +48,15 @@ class EngineDAOTest(unittest.TestCase):
         if sys.platform == 'win32' and os.path.exists(self.tmp_db.name):
             os.remove(self.tmp_db.name)
 
+    def _get_file_info(self, path, folderish=False):
+        info = Mock()
+        info.path = path
+        info.folderish = folderish
+        info.size = 42
+        info.last_modification_time = datetime.utcnow()
+        info.get_digest.return_value = 'digest'
+        return info
+
     def test_init_db(self):
         init_db = self.get_db_temp_file()
         if sys.platform != 'win32':
@@ -234,3 +249,392 @@ class EngineDAOTest(unittest.TestCase):
         self.assertEqual(len(self._dao.get_filters()), 1)
         self._dao.add_filter(u"/otherFilter")
         self.assertEqual(len(self._dao.get_filters()), 2)
+
+    def test_is_filter(self):
+        self.assertTrue(self._dao.is_filter(u"/fakeFilter/Test_Parent"))
+        self.assertTrue(self._dao.is_filter(u"/fakeFilter/Test_Parent/"))
+        self.assertTrue(self._dao.is_filter(u"/fakeFilter/Retest/Child/File.txt"))
+        self.assertFalse(self._dao.is_filter(u"/fakeFilter"))
+        self.assertFalse(self._dao.is_filter(u"/fakeFilter/Test_Parent2"))
+        self.assertFalse(self._dao.is_filter(u"/fakeFilter/Other/Test_Parent"))
+        self._dao.add_filter(u"/fakeFilter")
+        self.assertTrue(self._dao.is_filter(u"/fakeFilter/Other/Test_Parent"))
+        self._dao.remove_filter(u"/fakeFilter")
+        self.assertFalse(self._dao.is_filter(u"/fakeFilter/Retest/Child"))
+        self._dao.add_filter(u"/")
+        self.assertTrue(self._dao.is_filter(u"/anything"))
+
+    def test_move_folder(self):
+        folder = self._dao.get_state_from_local(u'/SmallFolder')
+        children = len(self._dao.get_local_children(u'/SmallFolder/Test'))
+        con = self._dao._get_write_connection()
+        changes = con.total_changes
+        self._dao.update_local_parent_path(folder, u'MovedFolder', u'/')
+        # Only the interned folder paths and the folder itself are updated
+        self.assertLess(con.total_changes - changes, 10)
+        self.assertIsNone(self._dao.get_state_from_local(u'/SmallFolder/Test/IMG_6693.JPG'))
+        child = self._dao.get_state_from_local(u'/MovedFolder/Test/IMG_6693.JPG')
+        self.assertIsNotNone(child)
+        self.assertEqual(child.local_parent_path, u'/MovedFolder/Test')
+        self.assertEqual(len(self._dao.get_local_children(u'/MovedFolder/Test')), children)
+
+    def test_queue_children(self):
+        folder = self._dao.get_state_from_local(u'/SmallFolder')
+        children = self._dao.get_local_children(u'/SmallFolder')
+        # All the children have the folder as remote parent
+        self.assertEqual(set(child.remote_parent_ref for child in children), {folder.remote_ref})
+        expected = sorted((child.id, child.folderish, child.pair_state) for child in children
+                          if child.pair_state != 'synchronized')
+        self.assertEqual(len(expected), 4)
+        # The synchronized children are not queued
+        with patch.object(self._dao, '_queue_pair_state') as queue_pair_state:
+            self._dao.queue_children(folder)
+        self.assertEqual(sorted(call[0][:3] for call in queue_pair_state.call_args_list), expected)
+
+    def test_move_deep_folder(self):
+        folder = self._dao.get_state_from_local(u'/SmallFolder/Test')
+        remote_path = folder.remote_parent_path + '/' + folder.remote_ref
+        local_path = u'/SmallFolder/Test'
+        parent_ref = folder.remote_ref
+        rows = []
+        for depth in range(20):
+            ref = 'deep#%d' % depth
+            rows.append((remote_info(ref, parent_ref, u'Deep', folderish=True),
+                         remote_path, local_path + u'/Deep', local_path))
+            rows.append((remote_info('deep#%d#file' % depth, ref, u'file.txt'),
+                         remote_path + '/' + ref, local_path + u'/Deep/file.txt', local_path + u'/Deep'))
+            remote_path += '/' + ref
+            local_path += u'/Deep'
+            parent_ref = ref
+        self._dao.insert_remote_states(rows)
+        top = self._dao.get_state_from_remote_with_path('deep#0', rows[0][1])
+        self.assertEqual(len(self._dao.get_remote_descendants_from_ref('deep#0')), 39)
+        # Record the updated states
+        con = self._dao._get_write_connection()
+        con.execute("CREATE TEMP TABLE UpdatedStates(id INTEGER)")
+        con.execute("CREATE TEMP TRIGGER state_updated AFTER UPDATE ON States"
+                    " BEGIN INSERT INTO UpdatedStates(id) VALUES(new.id); END")
+        self._dao.update_local_parent_path(top, u'Deep', u'/SmallFolder')
+        self._dao.update_remote_parent_path(top, folder.remote_parent_path)
+        # Only the moved folder is updated, not its descendants
+        self.assertEqual([row[0] for row in con.execute("SELECT DISTINCT id FROM UpdatedStates")], [top.id])
+        deepest = self._dao.get_state_from_id(self._dao.get_normal_state_from_remote('deep#19#file').id)
+        self.assertEqual(deepest.local_path, u'/SmallFolder' + u'/Deep' * 20 + u'/file.txt')
+        self.assertEqual(deepest.remote_parent_path,
+                         folder.remote_parent_path + ''.join('/deep#%d' % depth for depth in range(20)))
+        self.assertEqual(len(self._dao.get_remote_descendants_from_ref('deep#0')), 39)
+        con.execute("DROP TRIGGER state_updated")
+
+    def test_wal_readers(self):
+        self._dao.dispose()
+        self._dao = EngineDAO(self.tmp_db.name, wal=True)
+        mode = self._dao._get_read_connection().execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, 'wal')
+        values = []
+
+        def read():
+            values.append(self._dao.get_config("wal_test"))
+            self._dao.dispose_thread()
+
+        self._dao.begin_transaction()
+        try:
+            self._dao.update_config("wal_test", "1")
+            # The reader does not wait for the transaction and sees the committed data
+            reader = Thread(target=read)
+            reader.start()
+            reader.join(5)
+            self.assertFalse(reader.is_alive())
+            self.assertEqual(values, [None])
+        finally:
+            self._dao.end_transaction()
+        reader = Thread(target=read)
+        reader.start()
+        reader.join(5)
+        self.assertEqual(values, [None, "1"])
+        self.assertIsNotNone(self._dao.checkpoint())
+
+    def test_contention_metrics(self):
+        self._dao.dispose()
+        self._dao = EngineDAO(self.tmp_db.name, busy_timeout=0, retry_budget=0.5)
+        # Another process holds the database lock longer than the retry budget
+        blocker = sqlite3.connect(self.tmp_db.name, isolation_level=None, check_same_thread=False)
+        blocker.execute("BEGIN EXCLUSIVE")
+        try:
+            self.assertRaises(sqlite3.OperationalError, self._dao.update_config, "lock_test", "1")
+        finally:
+            blocker.execute("ROLLBACK")
+        metrics = self._dao.get_metrics()
+        self.assertEqual(metrics["db_failures"], 1)
+        self.assertGreater(metrics["db_retries"], 0)
+        self.assertGreaterEqual(metrics["db_wait"], 0.5)
+        self.assertEqual(metrics["db_contention"]["update_config"]["failures"], 1)
+        retries = metrics["db_retries"]
+
+        # The lock is released within the budget: the statement succeeds
+        blocker.execute("BEGIN EXCLUSIVE")
+        Timer(0.1, blocker.execute, ["ROLLBACK"]).start()
+        self._dao.update_config("lock_test", "2")
+        blocker.close()
+        self.assertEqual(self._dao.get_config("lock_test"), "2")
+        metrics = self._dao.get_metrics()
+        self.assertEqual(metrics["db_failures"], 1)
+        self.assertGreater(metrics["db_contention"]["update_config"]["retries"], retries)
+
+    def test_compact(self):
+        # Free some pages
+        con = self._dao._get_write_connection()
+        con.execute("CREATE TABLE Compaction(value VARCHAR)")
+        con.executemany("INSERT INTO Compaction(value) VALUES(?)", (('x' * 1000,) for _ in range(2000)))
+        con.execute("DROP TABLE Compaction")
+        con.commit()
+        # The legacy database was converted to incremental auto vacuum by its migration
+        self.assertEqual(con.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+        free = con.execute("PRAGMA freelist_count").fetchone()[0]
+        self.assertGreater(free, 100)
+        self.assertEqual(self._dao.compact(min_ratio=1), 0)
+        self.assertEqual(self._dao.compact(max_pages=100), 100)
+        self.assertEqual(con.execute("PRAGMA freelist_count").fetchone()[0], free - 100)
+        self.assertEqual(self._dao.compact(max_pages=free), free - 100)
+        self.assertEqual(self._dao.compact(), 0)
+        self.assertTrue(self._dao.check_state_counts())
+        # Forced, all the free pages are released at once
+        con.execute("CREATE TABLE Compaction(value VARCHAR)")
+        con.executemany("INSERT INTO Compaction(value) VALUES(?)", (('x' * 1000,) for _ in range(2000)))
+        con.execute("DROP TABLE Compaction")
+        con.commit()
+        self._dao.vacuum()
+        self.assertEqual(con.execute("PRAGMA freelist_count").fetchone()[0], 0)
+        self.assertTrue(self._dao.check_state_counts())
+
+    def test_doc_pair(self):
+        c = self._dao._get_read_connection().cursor()
+        c.execute(self._dao._select_states + " WHERE States.id=1")
+        self.assertEqual(tuple(column[0] for column in c.description), DocPair.COLUMNS)
+        state = c.fetchone()
+        self.assertIsInstance(state, DocPair)
+        self.assertEqual(state, self._dao.get_state_from_local(state.local_path))
+        self.assertFalse(hasattr(state, '__dict__'))
+        state.update_state(local_state='modified')
+        self.assertEqual(state.local_state, 'modified')
+        self.assertNotEqual(state, self._dao.get_state_from_id(1))
+        # Any other query keeps the generic rows
+        self.assertIsInstance(self._dao.get_config(SCHEMA_VERSION), basestring)
+        row = c.execute("SELECT id, local_basename FROM States WHERE id=1").fetchone()
+        self.assertIsInstance(row, StateRow)
+        self.assertEqual(row.id, 1)
+
+    def test_load_queue(self):
+        # The parents first, the children of a folder to synchronize are left to it
+        folders = set()
+        expected = set()
+        for pair in sorted(self._dao.get_states_from_partial_local(u'/'), key=lambda pair: pair.local_path):
+            if pair.pair_state in ('synchronized', 'unsynchronized'):
+                continue
+            if pair.folderish:
+                folders.add(pair.local_path)
+            if pair.local_parent_path not in folders:
+                expected.add((pair.id, pair.folderish, pair.pair_state))
+        self.assertTrue(expected)
+        queue_manager = Mock()
+        self._dao.register_queue_manager(queue_manager, load=False)
+        self.assertFalse(queue_manager.push_ref.called)
+        for chunk_size in (1000, 2):
+            queue_manager.reset_mock()
+            self.assertEqual(self._dao.load_queue(chunk_size=chunk_size), len(expected))
+            pushed = [call[0] for call in queue_manager.push_ref.call_args_list]
+            self.assertEqual(len(pushed), len(expected))
+            self.assertEqual(set(pushed), expected)
+
+    def test_profiler(self):
+        self.assertNotIn("db_profile", self._dao.get_metrics())
+        self._dao.dispose()
+        self._dao = EngineDAO(self.tmp_db.name, profile=True)
+        children = self._dao.get_local_children(u'/')
+        self.assertTrue(children)
+        self.assertIsNotNone(self._dao.get_state_from_id(1))
+        self._dao.update_config("profile_test", "1")
+        profile = self._dao.get_metrics()["db_profile"]
+        self.assertEqual(profile["get_local_children"]["calls"], 1)
+        self.assertEqual(profile["get_local_children"]["rows"], len(children))
+        self.assertEqual(sum(profile["get_local_children"]["histogram"].values()), 1)
+        self.assertEqual(profile["get_state_from_id"]["rows"], 1)
+        self.assertEqual(profile["update_config"]["calls"], 2)
+        self.assertEqual(profile["update_config"]["rows"], 0)
+
+    def test_state_cache(self):
+        metrics = self._dao.get_metrics()
+        hits, misses = metrics["state_cache_hits"], metrics["state_cache_misses"]
+        state = self._dao.get_state_from_local(u'/SmallFolder/IMAG0061.jpg')
+        state.local_state = 'modified'
+        cached = self._dao.get_state_from_local(u'/SmallFolder/IMAG0061.jpg')
+        self.assertEqual(cached.local_state, 'synchronized')
+        self.assertEqual(self._dao.get_states_from_remote(cached.remote_ref), [cached])
+        self.assertEqual(self._dao.get_states_from_remote(cached.remote_ref), [cached])
+        self.assertIsNone(self._dao.get_state_from_local(u'/Unknown'))
+        self.assertIsNone(self._dao.get_state_from_local(u'/Unknown'))
+        metrics = self._dao.get_metrics()
+        self.assertEqual(metrics["state_cache_hits"] - hits, 3)
+        self.assertEqual(metrics["state_cache_misses"] - misses, 3)
+        self.assertEqual(metrics["state_cache_size"], 3)
+
+        # Any write clears it
+        self._dao.update_local_state(state, self._get_file_info(u'/SmallFolder/IMAG0061.jpg'))
+        self.assertEqual(self._dao.get_metrics()["state_cache_size"], 0)
+        self.assertEqual(self._dao.get_state_from_local(u'/SmallFolder/IMAG0061.jpg').local_state, 'modified')
+
+        # The uncommitted writes of a batch are not cached
+        metrics = self._dao.get_metrics()
+        self._dao.begin_batch()
+        try:
+            self._dao.update_local_state(state, self._get_file_info(u'/SmallFolder/IMAG0061.jpg'))
+            self.assertEqual(self._dao.get_state_from_local(u'/SmallFolder/IMAG0061.jpg').version, state.version + 2)
+            self.assertEqual(self._dao.get_metrics(), metrics)
+        finally:
+            self._dao.end_batch()
+        self.assertEqual(self._dao.get_metrics()["state_cache_size"], 0)
+
+        # The suffix of a remote_ref
+        ref = cached.remote_ref
+        self.assertEqual(self._dao.get_first_state_from_partial_remote(ref.split('#', 1)[1]).id, cached.id)
+        self.assertIsNone(self._dao.get_first_state_from_partial_remote(ref[-5:]))
+
+    def test_batch(self):
+        queue_manager = Mock()
+        self._dao.register_queue_manager(queue_manager)
+        queue_manager.reset_mock()
+        values = []
+
+        def read():
+            values.append(self._dao.get_config("batch_test"))
+            self._dao.dispose_thread()
+
+        def read_from_thread():
+            reader = Thread(target=read)
+            reader.start()
+            reader.join(5)
+            return values.pop()
+
+        self._dao.begin_batch(max_count=3, max_delay=60)
+        try:
+            self._dao.update_config("batch_test", "1")
+            # The batching thread reads its uncommitted writes
+            self.assertEqual(self._dao.get_config("batch_test"), "1")
+            # But the other threads do not
+            self.assertIsNone(read_from_thread())
+            self._dao.insert_local_state(self._get_file_info(u'/batch.txt'), u'')
+            # Not committed yet: not queued
+            self.assertFalse(queue_manager.push_ref.called)
+            self._dao.update_config("batch_test", "2")
+            # Third write commits the batch, then queues
+            self.assertEqual(read_from_thread(), "2")
+            self.assertEqual(queue_manager.push_ref.call_count, 1)
+            self._dao.update_config("batch_test", "3")
+        finally:
+            self._dao.end_batch()
+        self.assertEqual(read_from_thread(), "3")
+        self.assertIsNone(self._dao._get_batch())
+
+    def test_bulk_remote_states(self):
+        queue_manager = Mock()
+        self._dao.register_queue_manager(queue_manager)
+        queue_manager.reset_mock()
+        folder = self._dao.get_state_from_local(u'/SmallFolder/Test')
+        remote_path = folder.remote_parent_path + '/' + folder.remote_ref
+        ids = self._dao.insert_remote_states([
+            (remote_info('bulk#1', folder.remote_ref, u'Bulk', folderish=True),
+             remote_path, u'/SmallFolder/Test/Bulk', u'/SmallFolder/Test'),
+            (remote_info('bulk#2', 'bulk#1', u'file.txt'),
+             remote_path + '/bulk#1', u'/SmallFolder/Test/Bulk/file.txt', u'/SmallFolder/Test/Bulk'),
+        ])
+        self.assertEqual(len(ids), 2)
+        child = self._dao.get_state_from_id(ids[1])
+        self.assertEqual(child.remote_ref, 'bulk#2')
+        self.assertEqual(child.local_path, u'/SmallFolder/Test/Bulk/file.txt')
+        self.assertEqual(child.remote_parent_path, remote_path + '/bulk#1')
+        self.assertEqual(child.pair_state, 'remotely_created')
+        # The child of a folder in creation is queued with its parent, later
+        queue_manager.push_ref.assert_called_once_with(ids[0], True, 'remotely_created', size=None,
+                                                       remote_ref='bulk#1')
+        states = self._dao.get_normal_states_from_remote(['bulk#1', 'bulk#2', 'unknown'])
+        self.assertEqual(sorted(states), ['bulk#1', 'bulk#2'])
+        states = self._dao.get_states_from_local_paths([u'/SmallFolder/Test/Bulk/file.txt', u'/SmallFolder/none'])
+        self.assertEqual(states.keys(), [u'/SmallFolder/Test/Bulk/file.txt'])
+
+        self._dao.update_remote_states([
+            (child, remote_info('bulk#2', 'bulk#1', u'renamed.txt')),
+            # Not dirty
+            (folder, remote_info(folder.remote_ref, folder.remote_parent_ref, folder.remote_name,
+                                 folderish=True)._replace(digest=folder.remote_digest,
+                                                          can_create_child=folder.remote_can_create_child,
+                                                          can_rename=folder.remote_can_rename,
+                                                          can_delete=folder.remote_can_delete,
+                                                          can_update=folder.remote_can_update)),
+        ])
+        updated = self._dao.get_state_from_id(ids[1])
+        self.assertEqual(updated.remote_name, u'renamed.txt')
+        self.assertEqual(updated.version, child.version + 1)
+        self.assertEqual(self._dao.get_state_from_id(folder.id).version, folder.version)
+
+    def test_bulk_remote_states_duplicates(self):
+        self._dao.register_queue_manager(Mock())
+        folder = self._dao.get_state_from_local(u'/SmallFolder/Test')
+        remote_path = folder.remote_parent_path + '/' + folder.remote_ref
+        other = self._dao.get_state_from_local(u'/SmallFolder')
+        other_path = other.remote_parent_path + '/' + other.remote_ref
+        page = [
+            (remote_info('dup#1', folder.remote_ref, u'dup.txt'),
+             remote_path, u'/SmallFolder/Test/dup.txt', u'/SmallFolder/Test'),
+            (remote_info('dup#2', folder.remote_ref, u'other.txt'),
+             remote_path, u'/SmallFolder/Test/other.txt', u'/SmallFolder/Test'),
+            # Listed twice in the page
+            (remote_info('dup#1', folder.remote_ref, u'dup.txt'),
+             remote_path, u'/SmallFolder/Test/dup.txt', u'/SmallFolder/Test'),
+            # Also under another parent
+            (remote_info('dup#1', other.remote_ref, u'dup.txt'),
+             other_path, u'/SmallFolder/dup.txt', u'/SmallFolder'),
+        ]
+        ids = self._dao.insert_remote_states(page)
+        self.assertEqual(len(set(ids)), 3)
+        self.assertEqual(ids[0], ids[2])
+        for row_id, (info, _, local_path, _) in zip(ids, page):
+            state = self._dao.get_state_from_id(row_id)
+            self.assertEqual((state.remote_ref, state.remote_parent_ref, state.local_path),
+                             (info.uid, info.parent_uid, local_path))
+        self.assertTrue(self._dao.check_state_counts())
+
+    def test_state_counts(self):
+        def get_counts():
+            return (self._dao.get_sync_count(), self._dao.get_sync_count('file'), self._dao.get_sync_count('folder'),
+                    self._dao.get_syncing_count(), self._dao.get_conflict_count(), self._dao.get_error_count(),
+                    self._dao.get_error_count(20), self._dao.get_unsynchronized_count(), self._dao.get_global_size())
+
+        def count(condition, params=()):
+            return self._dao.get_count(condition, params)
+
+        def get_expected():
+            size = self._dao._get_read_connection().execute(
+                "SELECT SUM(size) FROM States WHERE pair_state='synchronized'").fetchone()[0]
+            return (count("pair_state='synchronized'"), count("pair_state='synchronized' AND folderish=0"),
+                    count("pair_state='synchronized' AND folderish=1"),
+                    count("pair_state NOT IN ('synchronized', 'unsynchronized', 'conflicted') AND error_count < 3"),
+                    count("pair_state='conflicted'"), count("error_count > 3"), count("error_count > 20"),
+                    count("pair_state='unsynchronized'"), size)
+
+        self.assertTrue(self._dao.check_state_counts())
+        self.assertEqual(get_counts(), get_expected())
+        row = self._dao.get_state_from_id(58)
+        for _ in range(4):
+            self._dao.increase_error(row, "Test")
+            row = self._dao.get_state_from_id(58)
+        self._dao.unsynchronize_state(self._dao.get_state_from_id(3))
+        self._dao.insert_local_state(self._get_file_info(u'/counted.txt'), u'')
+        self._dao.remove_state(self._dao.get_state_from_local(u'/SmallFolder/Test'))
+        self.assertEqual(get_counts(), get_expected())
+        self.assertTrue(self._dao.check_state_counts())
+
+        # Broken counts are fixed by the check
+        con = self._dao._get_write_connection()
+        con.execute("UPDATE StatesCounts SET count = count + 1")
+        con.commit()
+        self.assertFalse(self._dao.check_state_counts())
+        self.assertEqual(get_counts(), get_expected())
@@ -0,0 +1,248 @@
+# coding: utf-8
+import inspect
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+
+from mock import Mock
+
+from nxdrive.engine.dao.sqlite import AutoRetryCursor, EngineDAO
+from tests.fakes import remote_info
+
+# Plan details are "SCAN States" since SQLite 3.36, "SCAN TABLE States" before
+DML_PATTERN = re.compile(r'\s*(?:SELECT|INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+SCAN_PATTERN = re.compile(r'^SCAN (?:TABLE )?States\b(?: USING (?:COVERING )?INDEX (\w+))?')
+
+# Methods allowed to scan States, with the reason why
+ALLOWED_SCANS = {
+    # One time resets done at startup / on reinit
+    'reinit_states': 'Drop and recreate the whole table',
+    # Count of all the rows
+    'get_count': 'No condition given',
+    'check_state_counts': 'On demand check of the maintained counts',
+}
+
+# Schema related methods and helpers, checked through the methods using them
+SCHEMA_METHODS = {'_create_state_table', '_create_state_indexes', '_init_db',
+                  '_migrate_db', '_migrate_state', '_migrate_state_paths',
+                  '_has_legacy_paths', '_reinit_states', '_create_table',
+                  '_move_paths', '_get_pair_states_from_remote', '_create_state_counts',
+                  '_get_state_counts_query', '_rebuild_state_counts', '_get_state_count'}
+
+
+class EngineDAOQueryPlanTest(unittest.TestCase):
+
+    def _get_default_db(self, name='test_engine.db'):
+        return os.path.join(os.path.dirname(__file__), 'resources', name)
+
+    def _clean_dao(self, dao):
+        dao.dispose()
+        if sys.platform == 'win32':
+            os.remove(dao.get_db())
+
+    def get_db_temp_file(self):
+        tmp_db = tempfile.NamedTemporaryFile(suffix="test_db", dir=self.tmpdir)
+        if sys.platform == 'win32':
+            tmp_db.close()
+        return tmp_db
+
+    def _copy_db(self, name):
+        tmp_db = self.get_db_temp_file()
+        db = open(self._get_default_db(name), 'rb')
+        with open(tmp_db.name, 'wb') as f:
+            f.write(db.read())
+        return tmp_db
+
+    def setUp(self):
+        self.build_workspace = os.environ.get('WORKSPACE')
+        self.tmpdir = None
+        if self.build_workspace is not None:
+            self.tmpdir = os.path.join(self.build_workspace, "tmp")
+            if not os.path.isdir(self.tmpdir):
+                os.makedirs(self.tmpdir)
+        self.tmp_db = self._copy_db('test_engine.db')
+        self._dao = EngineDAO(self.tmp_db.name)
+        self._dao.register_queue_manager(Mock())
+        self._statements = []
+        self._execute = AutoRetryCursor.execute
+        statements = self._statements
+        execute = self._execute
+
+        def recording_execute(cursor, *args, **kwargs):
+            statements.append(args)
+            return execute(cursor, *args, **kwargs)
+        AutoRetryCursor.execute = recording_execute
+
+    def tearDown(self):
+        AutoRetryCursor.execute = self._execute
+        self._clean_dao(self._dao)
+        if sys.platform == 'win32' and os.path.exists(self.tmp_db.name):
+            os.remove(self.tmp_db.name)
+
+    def _get_partial_indexes(self, con):
+        return set(row[0] for row in con.execute(
+            "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='States' AND sql LIKE '% WHERE %'"))
+
+    def _get_scans(self, statements):
+        con = sqlite3.connect(self.tmp_db.name)
+        try:
+            partial_indexes = self._get_partial_indexes(con)
+            scans = []
+            for statement in statements:
+                query = statement[0]
+                # Only the DML, the schema statements have no plan
+                if not DML_PATTERN.match(query) or not re.search(r'\bStates\b', query):
+                    continue
+                params = statement[1] if len(statement) > 1 else ()
+                for row in con.execute("EXPLAIN QUERY PLAN " + query, params):
+                    match = SCAN_PATTERN.match(row[-1])
+                    # Scanning a partial index is bounded by the pairs to sync
+                    if match and match.group(1) not in partial_indexes:
+                        scans.append((query, row[-1]))
+            return scans
+        finally:
+            con.close()
+
+    def _get_file_info(self, path, folderish=False):
+        info = Mock()
+        info.path = path
+        info.folderish = folderish
+        info.size = 42
+        info.last_modification_time = datetime.utcnow()
+        info.get_digest.return_value = 'digest'
+        return info
+
+    def _get_queries(self):
+        """ Return the method name and a call for every States query. """
+        dao = self._dao
+        file_pair = lambda: dao.get_state_from_id(58)
+        folder_pair = lambda: dao.get_state_from_id(2)
+        ref = file_pair().remote_ref
+        return [
+            ('acquire_processor', lambda: dao.acquire_processor(666, 3)),
+            ('release_processor', lambda: dao.release_processor(666)),
+            ('acquire_state', lambda: dao.acquire_state(666, 3)),
+            ('release_state', lambda: dao.release_state(666)),
+            ('reinit_processors', dao.reinit_processors),
+            ('clean_paths', dao.clean_paths),
+            ('insert_local_state', lambda: dao.insert_local_state(
+                self._get_file_info(u'/SmallFolder/new.txt'), u'/SmallFolder')),
+            ('insert_remote_state', lambda: dao.insert_remote_state(
+                remote_info('remote#new', folder_pair().remote_ref, u'new2.txt'),
+                folder_pair().remote_parent_path, u'/SmallFolder/new2.txt', u'/SmallFolder')),
+            ('insert_remote_states', lambda: dao.insert_remote_states([
+                (remote_info('remote#new3', folder_pair().remote_ref, u'new3.txt'),
+                 folder_pair().remote_parent_path + '/' + folder_pair().remote_ref,
+                 u'/SmallFolder/new3.txt', u'/SmallFolder')])),
+            ('get_last_files', lambda: dao.get_last_files(5, 'remote')),
+            ('register_queue_manager', lambda: dao.register_queue_manager(Mock())),
+            ('load_queue', dao.load_queue),
+            ('update_last_transfer', lambda: dao.update_last_transfer(58, 'upload')),
+            ('get_dedupe_pair', lambda: dao.get_dedupe_pair(u'name', ref, 58)),
+            ('remove_local_path', lambda: dao.remove_local_path(63)),
+            ('update_local_state', lambda: dao.update_local_state(
+                file_pair(), self._get_file_info(file_pair().local_path))),
+            ('update_local_modification_time', lambda: dao.update_local_modification_time(
+                file_pair(), self._get_file_info(file_pair().local_path))),
+            ('update_local_paths', lambda: dao.update_local_paths(file_pair())),
+            ('get_valid_duplicate_file', lambda: dao.get_valid_duplicate_file('digest')),
+            ('get_remote_descendants', lambda: dao.get_remote_descendants(u'/path')),
+            ('get_remote_descendants_from_ref', lambda: dao.get_remote_descendants_from_ref(ref)),
+            ('get_remote_children', lambda: dao.get_remote_children(ref)),
+            ('get_new_remote_children', lambda: dao.get_new_remote_children(ref)),
+            ('get_unsynchronized_count', dao.get_unsynchronized_count),
+            ('get_conflict_count', dao.get_conflict_count),
+            ('get_error_count', dao.get_error_count),
+            ('get_syncing_count', dao.get_syncing_count),
+            ('get_sync_count', lambda: dao.get_sync_count('file')),
+            ('get_count', dao.get_count),
+            ('get_global_size', dao.get_global_size),
+            ('check_state_counts', dao.check_state_counts),
+            ('get_unsynchronizeds', dao.get_unsynchronizeds),
+            ('get_conflicts', dao.get_conflicts),
+            ('get_errors', dao.get_errors),
+            ('get_local_children', lambda: dao.get_local_children(u'/SmallFolder')),
+            ('get_states_from_partial_local', lambda: dao.get_states_from_partial_local(u'/Small')),
+            ('get_first_state_from_partial_remote', lambda: dao.get_first_state_from_partial_remote(ref)),
+            ('get_normal_states_from_remote', lambda: dao.get_normal_states_from_remote([ref, 'remote#new'])),
+            ('get_states_from_local_paths', lambda: dao.get_states_from_local_paths(
+                [u'/SmallFolder', u'/SmallFolder/new.txt'])),
+            ('get_normal_state_from_remote', lambda: dao.get_normal_state_from_remote(ref)),
+            ('get_state_from_remote_with_path', lambda: dao.get_state_from_remote_with_path(ref, u'/')),
+            ('get_states_from_remote', lambda: dao.get_states_from_remote(ref)),
+            ('get_state_from_id', lambda: dao.get_state_from_id(1)),
+            ('get_state_from_local', lambda: dao.get_state_from_local(u'/SmallFolder')),
+            ('queue_children', lambda: dao.queue_children(folder_pair())),
+            ('increase_error', lambda: dao.increase_error(file_pair(), 'Test')),
+            ('reset_error', lambda: dao.reset_error(file_pair())),
+            ('force_remote', lambda: dao.force_remote(file_pair())),
+            ('force_local', lambda: dao.force_local(file_pair())),
+            ('set_conflict_state', lambda: dao.set_conflict_state(file_pair())),
+            ('unsynchronize_state', lambda: dao.unsynchronize_state(file_pair())),
+            ('synchronize_state', lambda: dao.synchronize_state(folder_pair(), version=-1)),
+            ('update_remote_state', lambda: dao.update_remote_state(
+                file_pair(), remote_info(ref, file_pair().remote_parent_ref, u'renamed.txt'))),
+            ('update_remote_states', lambda: dao.update_remote_states([
+                (file_pair(), remote_info(ref, file_pair().remote_parent_ref, u'renamed2.txt'))])),
+            ('get_previous_sync_file', lambda: dao.get_previous_sync_file(ref, 'upload')),
+            ('get_next_sync_file', lambda: dao.get_next_sync_file(ref, 'upload')),
+            ('get_next_folder_file', lambda: dao.get_next_folder_file(ref)),
+            ('get_previous_folder_file', lambda: dao.get_previous_folder_file(ref)),
+            ('add_filter', lambda: dao.add_filter(u'/otherFilter')),
+            ('remove_filter', lambda: dao.remove_filter(u'/otherFilter')),
+            ('update_remote_parent_path', lambda: dao.update_remote_parent_path(folder_pair(), u'/new')),
+            ('update_local_parent_path', lambda: dao.update_local_parent_path(
+                folder_pair(), u'SmallFolder2', u'/')),
+            ('mark_descendants_remotely_deleted', lambda: dao.mark_descendants_remotely_deleted(folder_pair())),
+            ('mark_descendants_remotely_created', lambda: dao.mark_descendants_remotely_created(folder_pair())),
+            ('delete_remote_state', lambda: dao.delete_remote_state(folder_pair())),
+            ('delete_local_state', lambda: dao.delete_local_state(folder_pair())),
+            ('mark_descendants_locally_created', lambda: dao.mark_descendants_locally_created(folder_pair())),
+            ('remove_state', lambda: dao.remove_state(folder_pair())),
+            ('reinit_states', dao.reinit_states),
+        ]
+
+    def test_no_states_scan(self):
+        scans = dict()
+        for name, query in self._get_queries():
+            del self._statements[:]
+            query()
+            for scan in self._get_scans(self._statements):
+                if name not in ALLOWED_SCANS:
+                    scans.setdefault(name, []).append(scan)
+        self.assertEqual(scans, dict())
+
+    def test_all_queries_checked(self):
+        checked = set(name for name, _ in self._get_queries())
+        missing = []
+        for name, method in inspect.getmembers(EngineDAO, inspect.ismethod):
+            if name in SCHEMA_METHODS or name in checked:
+                continue
+            if 'States' in inspect.getsource(method):
+                missing.append(name)
+        self.assertEqual(missing, [])
+
+    def test_indexes_after_migration(self):
+        migrate_db = self._copy_db('test_engine_migration.db')
+        dao = EngineDAO(migrate_db.name)
+        try:
+            self.assertEqual(dao.get_config('schema_version'), '8')
+            con = dao._get_read_connection()
+            # Converted to be compacted by steps
+            self.assertEqual(con.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+            indexes = set(row.name for row in con.execute(
+                "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='States'"))
+            self.assertIn('idx_states_local_path', indexes)
+            self.assertIn('idx_states_remote_parent_path', indexes)
+            self.assertIn('idx_states_remote_parent_ref', indexes)
+            self.assertIn('idx_states_remote_digest', indexes)
+            self.assertIn('idx_states_pair_state', indexes)
+            self.assertIn('idx_states_hot', indexes)
+            self.assertIn('idx_states_errors', indexes)
+            self.assertIn('idx_states_processing', indexes)
+        finally:
+            self._clean_dao(dao)
@@ -0,0 +1,64 @@
+# coding: utf-8
+import unittest
+from threading import Event
+
+from nxdrive.client.common import NotFound
+from nxdrive.engine.prefetch import RemoteInfoPrefetcher
+from nxdrive.engine.queue_manager import QueueItem
+from tests.fakes import FakeEngine, FakePair
+
+
+class FakeRemoteClient(object):
+    server_url = 'http://localhost:8080/nuxeo/'
+
+    def __init__(self, missing=()):
+        self.missing = missing
+        self.calls = []
+        self.release = Event()
+        self.release.set()
+
+    def get_info(self, remote_ref, raise_if_missing=True):
+        self.release.wait()
+        self.calls.append(remote_ref)
+        if remote_ref in self.missing:
+            if raise_if_missing:
+                raise NotFound(remote_ref)
+            return None
+        return 'info#' + remote_ref
+
+
+class RemoteInfoPrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.remote_client = FakeRemoteClient(missing=('ref#4',))
+        self.prefetcher = RemoteInfoPrefetcher(FakeEngine(self.remote_client), size=10, workers=2)
+
+    def test_prefetch(self):
+        # Stop the fetching threads on the first call
+        self.remote_client.release.clear()
+        self.prefetcher.prefetch([QueueItem(1, False, 'locally_modified', remote_ref='ref#1'),
+                                  QueueItem(2, False, 'locally_created'),
+                                  QueueItem(3, False, 'locally_moved'),
+                                  QueueItem(4, False, 'locally_deleted', remote_ref='ref#4'),
+                                  QueueItem(5, False, 'remotely_modified', remote_ref='ref#5')])
+        # Already being fetched
+        self.prefetcher.prefetch([QueueItem(1, False, 'locally_modified', remote_ref='ref#1')])
+        self.remote_client.release.set()
+        self.assertEqual(self.prefetcher.get_info(self.remote_client, FakePair(1, remote_ref='ref#1')), 'info#ref#1')
+        self.assertRaises(NotFound, self.prefetcher.get_info, self.remote_client, FakePair(4, remote_ref='ref#4'))
+        self.assertEqual(sorted(self.remote_client.calls), ['ref#1', 'ref#4'])
+        # Used once
+        self.assertEqual(self.prefetcher.get_info(self.remote_client, FakePair(1, remote_ref='ref#1')), 'info#ref#1')
+        self.assertEqual(self.remote_client.calls.count('ref#1'), 2)
+        metrics = self.prefetcher.get_metrics()
+        self.assertEqual(metrics['prefetch_hits'], 2)
+        self.assertEqual(metrics['prefetch_misses'], 1)
+
+    def test_ttl(self):
+        self.prefetcher.ttl = -1
+        self.prefetcher.prefetch([QueueItem(1, False, 'locally_modified', remote_ref='ref#1')])
+        for thread in list(self.prefetcher._threads):
+            thread.join()
+        self.assertEqual(self.prefetcher.get_info(self.remote_client, FakePair(1, remote_ref='ref#1')), 'info#ref#1')
+        self.assertEqual(self.remote_client.calls, ['ref#1', 'ref#1'])
+        self.assertEqual(self.prefetcher.get_metrics()['prefetch_misses'], 1)
@@ -0,0 +1,314 @@
+# coding: utf-8
+import time
+import unittest
+from threading import Thread, Timer
+
+from nxdrive.engine.queue_manager import (CoalescingQueue, LARGE_FILE_SIZE, LARGE_LANE, LaneQueue, MEDIUM_LANE,
+                                          PROCESSOR_IDLE_WAIT, QueueItem, QueueManager, SMALL_LANE)
+from tests.fakes import FakeDAO, FakeEngine, FakePair, FakeThread, FakeWorker
+
+KB = 1024
+MB = 1024 * KB
+
+
+class CoalescingQueueTest(unittest.TestCase):
+
+    def test_coalesce(self):
+        queue = CoalescingQueue()
+        queue.put(QueueItem(1, False, 'locally_created'))
+        queue.put(QueueItem(2, False, 'locally_modified'))
+        queue.put(QueueItem(1, False, 'locally_modified'))
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual(queue.coalesced, 1)
+        # The first pushed pair keeps its position with its last state
+        item = queue.get(False)
+        self.assertEqual(item.id, 1)
+        self.assertEqual(item.pair_state, 'locally_modified')
+        self.assertEqual(queue.get(False).id, 2)
+        self.assertTrue(queue.empty())
+
+    def test_discard(self):
+        queue = CoalescingQueue()
+        queue.put(QueueItem(1, False, 'locally_created'))
+        self.assertIsNotNone(queue.discard(1))
+        self.assertIsNone(queue.discard(1))
+        self.assertTrue(queue.empty())
+
+
+class LaneQueueTest(unittest.TestCase):
+
+    def test_lanes(self):
+        queue = LaneQueue()
+        queue.put(QueueItem(1, False, 'locally_created', size=LARGE_FILE_SIZE))
+        queue.put(QueueItem(2, False, 'locally_created', size=300 * KB))
+        queue.put(QueueItem(3, False, 'remotely_created'))
+        queue.put(QueueItem(4, False, 'locally_created', size=10 * KB))
+        queue.put(QueueItem(5, False, 'locally_created', size=20 * KB))
+        self.assertEqual(queue.get_lanes(), {SMALL_LANE, MEDIUM_LANE, LARGE_LANE})
+        self.assertEqual([item.id for item in queue.peek(4)], [4, 5, 2, 3])
+        self.assertEqual(queue.get_from([LARGE_LANE]).id, 1)
+        self.assertIsNone(queue.get_from([LARGE_LANE]))
+        # Smallest first, a file of unknown size is a medium one
+        self.assertEqual(queue.get_from([SMALL_LANE]).id, 4)
+        self.assertEqual(queue.get_from([MEDIUM_LANE, SMALL_LANE]).id, 3)
+        # A modified file can change of lane
+        queue.put(QueueItem(5, False, 'locally_modified', size=5 * MB))
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual(queue.get_lanes(), {SMALL_LANE, MEDIUM_LANE})
+        self.assertIsNotNone(queue.discard(2))
+        self.assertEqual(queue.get(False).id, 5)
+        self.assertTrue(queue.empty())
+        self.assertEqual(queue.get_lanes(), set())
+
+
+class QueueManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = QueueManager(FakeEngine(), FakeDAO())
+        self.manager._loader.join()
+        # No processor threads, the tests take the items themselves
+        self.manager._disable = True
+
+    def _process(self):
+        """ Count the items a file processor would work on. """
+        count = 0
+        while self.manager._get_file() is not None:
+            count += 1
+        return count
+
+    def test_repeated_modifications(self):
+        for modifications in (1, 20, 100):
+            for _ in range(modifications):
+                self.manager.push_ref(1, False, 'locally_modified')
+            self.manager.push_ref(2, False, 'locally_created')
+            metrics = self.manager.get_metrics()
+            self.assertEqual(metrics['local_file_queue'], 2)
+            self.assertEqual(metrics['total_queue'], 2)
+            self.assertEqual(self._process(), 2)
+
+    def test_change_of_queue(self):
+        self.manager.push_ref(1, False, 'locally_modified')
+        self.manager.push_ref(1, False, 'remotely_modified')
+        metrics = self.manager.get_metrics()
+        self.assertEqual(metrics['local_file_queue'], 0)
+        self.assertEqual(metrics['remote_file_queue'], 1)
+        self.assertEqual(self._process(), 1)
+
+    def test_errors(self):
+        self.manager.push_error(FakePair(1), interval=60)
+        self.manager.push_error(FakePair(2), interval=0)
+        self.assertEqual(self.manager.get_errors_count(), 2)
+        # The timer is armed for the earliest deadline
+        self.manager._on_new_error()
+        self.assertLess(self.manager._error_deadline, time.time() + 1)
+        time.sleep(0.01)
+        self.manager._on_error_timer()
+        self.assertEqual(self.manager.get_errors_count(), 1)
+        self.assertEqual(self.manager.get_metrics()['local_file_queue'], 1)
+        self.assertGreater(self.manager._error_deadline, time.time() + 50)
+        self.manager.requeue_errors()
+        self.manager._on_error_timer()
+        self.assertEqual(self.manager.get_errors_count(), 0)
+        self.assertIsNone(self.manager._error_deadline)
+        self.assertEqual(self._process(), 2)
+
+    def test_wait_item(self):
+        worker = FakeWorker()
+        self.manager.push_ref(1, False, 'locally_modified')
+        item = self.manager._wait_item(self.manager._get_file, worker)
+        self.assertEqual(item.id, 1)
+        self.assertTrue(self.manager.is_active())
+        # The idle processor is woken up by the next push
+        Timer(0.1, self.manager.push_ref, (2, False, 'locally_modified')).start()
+        start = time.time()
+        item = self.manager._wait_item(self.manager._get_file, worker)
+        self.assertEqual(item.id, 2)
+        self.assertLess(time.time() - start, PROCESSOR_IDLE_WAIT)
+        # A disabled queue gives nothing until it is enabled again
+        self.manager.push_ref(3, False, 'locally_modified')
+        self.manager.enable_local_file_queue(False)
+        Timer(0.1, self.manager.enable_local_file_queue, (True, False)).start()
+        item = self.manager._wait_item(self.manager._get_file, worker)
+        self.assertEqual(item.id, 3)
+        # The stopped processor leaves
+        worker.started = False
+        self.assertIsNone(self.manager._wait_item(self.manager._get_file, worker))
+        self.assertFalse(self.manager.is_active())
+
+    def _wait_in_thread(self, worker):
+        """ Return the thread of an idle processor, and the time it left. """
+        result = []
+
+        def run():
+            self.assertIsNone(self.manager._wait_item(self.manager._get_local_file, worker))
+            result.append(time.time())
+        thread = Thread(target=run)
+        thread.start()
+        time.sleep(0.1)
+        self.assertTrue(thread.is_alive())
+        return thread, result
+
+    def test_wake_on_stop(self):
+        # The dedicated processor of a disabled queue leaves
+        worker = FakeWorker()
+        self.manager._local_file_thread = FakeThread(worker)
+        thread, result = self._wait_in_thread(worker)
+        start = time.time()
+        self.manager.enable_local_file_queue(False)
+        thread.join()
+        self.assertLess(result[0] - start, PROCESSOR_IDLE_WAIT / 2.0)
+        # All the idle processors leave when the engine stops
+        self.manager._local_file_thread = None
+        self.manager.enable_local_file_queue(True, False)
+        thread, result = self._wait_in_thread(FakeWorker())
+        start = time.time()
+        self.manager._engine.stopped = True
+        self.manager.shutdown_processors()
+        thread.join()
+        self.assertLess(result[0] - start, PROCESSOR_IDLE_WAIT / 2.0)
+
+    def test_resize(self):
+        workers = [FakeWorker() for _ in range(3)]
+        self.manager._processors_pool = list(workers)
+        # Two dedicated file and folder processors, and one generic
+        self.manager.set_max_processors(3)
+        self.manager.push_ref(1, False, 'locally_modified')
+        items = [self.manager._wait_item(self.manager._get_file, worker, generic=True)
+                 for worker in workers]
+        # The two extra processors are released, the last one takes the item
+        self.assertEqual([item.id if item else None for item in items], [None, None, 1])
+        self.assertEqual(len(self.manager._retired), 2)
+
+    def test_dependents(self):
+        parent = FakePair(1, pair_state='locally_created')
+        self.manager.push(parent)
+        self.assertTrue(self.manager.is_pending(1))
+        self.assertFalse(self.manager.is_pending(2))
+        self.manager.push_after(FakePair(2), 1)
+        self.manager.push_after(FakePair(3), 'remote#parent')
+        metrics = self.manager.get_metrics()
+        self.assertEqual(metrics['waiting_parent'], 2)
+        self.assertEqual(metrics['error_queue'], 2)
+        self.assertEqual(metrics['total_queue'], 1)
+        self.assertTrue(self.manager.is_pending(2))
+
+        # The child is pushed back as soon as its parent is processed
+        self.assertEqual(self.manager._get_file().id, 1)
+        self.manager.release_dependents(parent)
+        metrics = self.manager.get_metrics()
+        self.assertEqual(metrics['waiting_parent'], 1)
+        self.assertEqual(metrics['error_queue'], 1)
+        self.assertEqual(self._process(), 1)
+
+        # A postponed pair keeps its own dependents waiting
+        self.manager.push(FakePair(5, pair_state='locally_created'))
+        self.manager.push_after(FakePair(4, remote_ref='remote#parent'), 5)
+        self.manager.release_dependents(FakePair(4, remote_ref='remote#parent'))
+        self.assertEqual(self.manager.get_metrics()['waiting_parent'], 2)
+        self.manager.release_dependents(FakePair(5))
+        self.manager.release_dependents(FakePair(4, remote_ref='remote#parent'))
+        self.assertEqual(self.manager.get_metrics()['waiting_parent'], 0)
+        self.assertEqual(self._process(), 3)
+
+    def test_dependents_retry(self):
+        # A parent never processed does not hold the child more than the retry delay
+        self.manager.push(FakePair(1, pair_state='locally_created'))
+        self.manager.push_after(FakePair(2), 1, interval=0)
+        time.sleep(0.01)
+        self.manager._on_error_timer()
+        self.assertEqual(self.manager.get_metrics()['waiting_parent'], 0)
+        self.assertEqual(self._process(), 2)
+        self.manager.release_dependents(FakePair(1))
+        self.assertEqual(self._process(), 0)
+
+    def test_dependents_released_before(self):
+        parent = FakePair(1, pair_state='locally_created')
+        self.manager.push(parent)
+        worker = FakeWorker()
+        self.assertEqual(self.manager._wait_item(self.manager._get_file, worker).id, 1)
+        # The processor of the child sees the parent pending ...
+        self.assertTrue(self.manager.is_pending(1))
+        # ... then the processing of the parent ends before the child is postponed
+        self.manager.release_dependents(parent)
+        self.assertFalse(self.manager.is_pending(1))
+        self.manager.push_after(FakePair(2), 1)
+        # The child does not wait for the retry delay
+        metrics = self.manager.get_metrics()
+        self.assertEqual(metrics['waiting_parent'], 0)
+        self.assertEqual(metrics['error_queue'], 0)
+        self.assertEqual(self._process(), 1)
+        # The processor of the parent is still busy until it leaves
+        self.assertTrue(self.manager.is_active())
+        worker.started = False
+        self.assertIsNone(self.manager._wait_item(self.manager._get_file, worker))
+        self.assertFalse(self.manager.is_active())
+
+    def test_adaptive(self):
+        metrics = self.manager.get_metrics()
+        self.assertEqual(metrics['processors_level'], 3)
+        self.manager._concurrency.window = 0
+        self.manager.push_ref(1, False, 'locally_modified')
+        self.manager._on_pair_sync(FakePair(2), {'size': 1024})
+        self.assertEqual(self.manager._max_processors, 4)
+        self.manager.record_congestion()
+        self.assertEqual(self.manager._max_processors, 2)
+        self.assertEqual(self.manager.get_metrics()['processors_level'], 2)
+
+    def test_adaptive_bounds(self):
+        manager = QueueManager(FakeEngine(), FakeDAO(), max_file_processors=4, min_processors=2, max_processors=3)
+        manager._loader.join()
+        manager._disable = True
+        metrics = manager.get_metrics()
+        self.assertEqual((metrics['processors_min'], metrics['processors_max']), (2, 3))
+        manager._concurrency.window = 0
+        manager.push_ref(1, False, 'locally_modified')
+        for row_id in range(2, 5):
+            manager._on_pair_sync(FakePair(row_id), {'size': 1024})
+        self.assertEqual(manager._max_processors, 3)
+        manager.record_congestion()
+        self.assertEqual(manager._max_processors, 2)
+
+    def test_user_limit(self):
+        self.manager._concurrency.window = 0
+        self.manager.push_ref(1, False, 'locally_modified')
+        self.manager._on_pair_sync(FakePair(2), {'size': 1024})
+        self.assertEqual(self.manager._max_processors, 4)
+        # The user limit lowers the adaptive count, which does not grow over it in the next windows
+        self.manager.set_max_processors(4)
+        self.assertEqual(self.manager._max_processors, 2)
+        for row_id in range(3, 10):
+            self.manager._on_pair_sync(FakePair(row_id), {'size': 1024})
+        self.assertEqual(self.manager._max_processors, 2)
+        self.assertEqual(self.manager.get_metrics()['processors_max'], 2)
+
+    def test_size_lanes(self):
+        # 3 file processors
+        self.manager.set_max_processors(3)
+        for row_id in range(1, 4):
+            self.manager.push_ref(row_id, False, 'remotely_modified', size=LARGE_FILE_SIZE)
+        self.manager.push_ref(4, False, 'locally_created', size=10 * MB)
+        self.manager.push_ref(5, False, 'locally_created', size=KB)
+        workers = [FakeWorker() for _ in range(3)]
+        items = [self.manager._wait_item(self.manager._get_file, worker) for worker in workers]
+        self.assertEqual([item.id for item in items], [5, 4, 1])
+        # The large files get a single processor while there are small ones
+        self.manager.push_ref(6, False, 'locally_created', size=KB)
+        self.assertEqual(self.manager._wait_item(self.manager._get_file, workers[0]).id, 6)
+        self.assertEqual(self.manager.get_metrics()['large_lane_processors'], 1)
+        # The others when there is nothing else, but the one kept for the small files
+        self.assertEqual(self.manager._wait_item(self.manager._get_file, workers[1]).id, 2)
+        workers[0].started = False
+        self.assertIsNone(self.manager._wait_item(self.manager._get_file, workers[0]))
+        self.assertEqual(self.manager.get_metrics()['large_lane_processors'], 2)
+        self.assertIsNone(self.manager._get_file())
+        self.manager.push_ref(7, False, 'locally_created', size=KB)
+        self.assertEqual(self.manager._get_file().id, 7)
+        self.assertEqual(self.manager.get_metrics()['remote_file_queue'], 1)
+
+    def test_size_lanes_unknown(self):
+        self.manager.set_max_processors(3)
+        for row_id in range(1, 4):
+            self.manager.push_ref(row_id, False, 'remotely_created')
+        # Without small files waiting, only the large ones leave a processor
+        items = [self.manager._wait_item(self.manager._get_file, FakeWorker()) for _ in range(3)]
+        self.assertEqual([item.id for item in items], [1, 2, 3])
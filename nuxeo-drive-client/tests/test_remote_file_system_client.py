@@ -129,7 +129,7 @@ class TestRemoteFileSystemClient(UnitTestCase):
         fs_item_id = remote_client.make_file(self.workspace_id,
             'Document 1.txt', "Content of doc 1.").uid
         file_path = os.path.join(self.local_test_folder_1, 'Document 1.txt')
-        tmp_file = remote_client.stream_content(fs_item_id, file_path)
+        tmp_file, _ = remote_client.stream_content(fs_item_id, file_path)
         self.assertTrue(os.path.exists(tmp_file))
         self.assertEqual(os.path.basename(tmp_file), '.Document 1.txt' + str(current_thread().ident)+ '.nxpart')
         self.assertEqual(open(tmp_file, 'rb').read(), "Content of doc 1.")
@@ -0,0 +1,231 @@
+# coding: utf-8
+import hashlib
+import os
+import time
+import urllib2
+from datetime import datetime
+from httplib import IncompleteRead
+
+from mock import patch
+
+from nxdrive.client.base_automation_client import CorruptedFile, clean_partial_downloads, get_download_lock_file, \
+    get_download_state_file, get_segments_count, lock_partial_download, remove_partial_download, \
+    unlock_partial_download
+from nxdrive.client.remote_file_system_client import RemoteFileInfo, RemoteFileSystemClient
+from tests.automation_server import AutomationHandler, AutomationServerTestCase, get_client
+
+CONTENT = os.urandom(3 * 1024 ** 2 + 100)
+
+
+class BlobHandler(AutomationHandler):
+    """ Serve a blob, with its ETag and the Range requests. """
+
+    def get(self):
+        server = self.server
+        if server.gone:
+            self.send_empty(404)
+            return
+        start, end = 0, len(server.content)
+        range_ = self.headers.getheader('Range')
+        if_range = self.headers.getheader('If-Range')
+        server.ranges.append(range_)
+        if range_ is not None and (if_range is None or if_range == server.etag):
+            first, last = range_[len('bytes='):].split('-')
+            start = int(first)
+            if last:
+                end = min(end, int(last) + 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, len(server.content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('ETag', server.etag)
+        self.end_headers()
+        # Drop the connection after some bytes
+        if server.cut is not None:
+            end = min(end, server.cut)
+        server.sent += max(0, end - start)
+        self.wfile.write(server.content[start:end])
+
+
+class ResumableDownloadTest(AutomationServerTestCase):
+
+    handler = BlobHandler
+
+    def setUp(self):
+        super(ResumableDownloadTest, self).setUp()
+        self.server.content = CONTENT
+        self.server.etag = '"v1"'
+        self.server.cut = None
+        self.server.sent = 0
+        self.server.ranges = []
+        self.server.gone = False
+        self.file_out = os.path.join(self.tmpdir, '.video.mp4.nxpart')
+
+    def _download(self, content=CONTENT, segmented=False):
+        return self.client.do_get(self.url + 'blob', file_out=self.file_out, segmented=segmented,
+                                  digest=hashlib.md5(content).hexdigest(), digest_algorithm='md5')
+
+    def _read(self):
+        with open(self.file_out, 'rb') as f:
+            return f.read()
+
+    def test_resume(self):
+        self.server.cut = 2 * 1024 ** 2 + 10
+        self.assertRaises(IncompleteRead, self._download)
+        # The partial file is kept with its state
+        self.assertEqual(os.path.getsize(self.file_out), self.server.cut)
+        self.assertTrue(os.path.exists(get_download_state_file(self.file_out)))
+        self.server.cut = None
+        self.server.sent = 0
+        self.assertEqual(self._download(), (None, self.file_out))
+        self.assertEqual(self._read(), CONTENT)
+        self.assertEqual(self.server.ranges[-1], 'bytes=%d-' % (2 * 1024 ** 2 + 10))
+        self.assertEqual(self.server.sent, len(CONTENT) - 2 * 1024 ** 2 - 10)
+        self.assertFalse(os.path.exists(get_download_state_file(self.file_out)))
+
+    def test_changed_content(self):
+        self.server.cut = 1024 ** 2
+        self.assertRaises(IncompleteRead, self._download)
+        # Same digest expected, but the server content changed: it sends all of it
+        self.server.cut = None
+        self.server.etag = '"v2"'
+        self.assertEqual(self._download(), (None, self.file_out))
+        self.assertEqual(self._read(), CONTENT)
+        # Other digest expected: no resume
+        self.server.cut = 1024 ** 2
+        self.assertRaises(IncompleteRead, self._download)
+        self.server.cut = None
+        self.server.content = CONTENT[::-1]
+        self.assertEqual(self._download(CONTENT[::-1]), (None, self.file_out))
+        self.assertIsNone(self.server.ranges[-1])
+        self.assertEqual(self._read(), CONTENT[::-1])
+
+    def test_segments_count(self):
+        mb = 1024 ** 2
+        self.assertEqual(get_segments_count(5 * mb), 1)
+        self.assertEqual(get_segments_count(20 * mb), 2)
+        self.assertEqual(get_segments_count(4096 * mb), 8)
+        # A single connection gets it in 2s
+        self.assertEqual(get_segments_count(4096 * mb, speed=2048 * mb), 1)
+        self.assertEqual(get_segments_count(4096 * mb, speed=512 * mb), 4)
+
+    @patch('nxdrive.client.base_automation_client.SEGMENT_MIN_SIZE', 1024 ** 2)
+    def test_segmented(self):
+        # Hashed while downloaded, not read again at the end
+        with patch.object(self.client, '_hash_partial_download', side_effect=AssertionError):
+            self.assertEqual(self._download(segmented=True), (None, self.file_out))
+        self.assertEqual(self._read(), CONTENT)
+        self.assertEqual(sorted(self.server.ranges), ['bytes=0-0', 'bytes=0-1048608', 'bytes=1048609-2097217',
+                                                      'bytes=2097218-3145827'])
+        self.assertFalse(os.path.exists(get_download_state_file(self.file_out)))
+        self.assertIsNotNone(self.client.segment_speed)
+        # Small files are not split
+        del self.server.ranges[:]
+        self.server.content = CONTENT[:1024]
+        self.assertEqual(self._download(CONTENT[:1024], segmented=True), (None, self.file_out))
+        self.assertEqual(self.server.ranges, ['bytes=0-0', None])
+
+    def test_hash_segments(self):
+        with open(self.file_out, 'wb') as f:
+            f.write(CONTENT)
+        size = len(CONTENT)
+        segments = [[0, size // 3, 100], [size // 3, size * 2 // 3, size // 3], [size * 2 // 3, size, 0]]
+        h = hashlib.md5()
+        # Only the bytes in a row from the start
+        self.assertEqual(self.client._hash_segments(self.file_out, segments, h, 0), 100)
+        segments[0][2] = size // 3
+        self.assertEqual(self.client._hash_segments(self.file_out, segments, h, 100), size * 2 // 3)
+        segments[2][2] = size - size * 2 // 3
+        self.assertEqual(self.client._hash_segments(self.file_out, segments, h, size * 2 // 3), size)
+        self.assertEqual(h.hexdigest(), hashlib.md5(CONTENT).hexdigest())
+
+    @patch('nxdrive.client.base_automation_client.SEGMENT_MIN_SIZE', 1024 ** 2)
+    def test_segmented_resume(self):
+        self.server.cut = 1024 ** 2 + 1024 ** 2 // 2
+        self.assertRaises(IncompleteRead, self._download, segmented=True)
+        # The first bytes in a row are kept
+        offset = os.path.getsize(self.file_out)
+        self.assertEqual(offset, self.server.cut)
+        self.server.cut = None
+        self.assertEqual(self._download(segmented=True), (None, self.file_out))
+        self.assertEqual(self.server.ranges[-1], 'bytes=%d-' % offset)
+        self.assertEqual(self._read(), CONTENT)
+
+    def _stream_content(self):
+        client = get_client(self.url, self.tmpdir, factory=RemoteFileSystemClient)
+        info = RemoteFileInfo(u'video.mp4', 'doc#1', 'root', '/root/doc#1', False, datetime.utcnow(), None,
+                              hashlib.md5(CONTENT).hexdigest(), 'md5', 'blob', True, True, True, False, None, None,
+                              False)
+        return client.stream_content('doc#1', os.path.join(self.tmpdir, 'video.mp4'), fs_item_info=info)
+
+    def _assert_removed(self, file_out):
+        self.assertFalse(os.path.exists(file_out))
+        self.assertFalse(os.path.exists(get_download_state_file(file_out)))
+
+    def test_stream_content_in_progress(self):
+        # Another processor downloads the same file
+        self.assertTrue(lock_partial_download(self.file_out))
+        self.assertFalse(lock_partial_download(self.file_out))
+        with open(self.file_out, 'wb') as f:
+            f.write(CONTENT[:1024])
+        tmp_file, digest = self._stream_content()
+        self.assertEqual(digest, hashlib.md5(CONTENT).hexdigest())
+        self.assertNotEqual(tmp_file, self.file_out)
+        with open(tmp_file, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        os.remove(tmp_file)
+        # Its partial file is left alone, and the file of the thread is not kept on error
+        self.assertEqual(self._read(), CONTENT[:1024])
+        self.server.cut = 1024 ** 2
+        self.assertRaises(IncompleteRead, self._stream_content)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['.video.mp4.lock.nxpart', '.video.mp4.nxpart'])
+        unlock_partial_download(self.file_out)
+        # The lock of a previous run is taken over
+        with open(get_download_lock_file(self.file_out), 'w') as f:
+            f.write('0')
+        self.assertTrue(lock_partial_download(self.file_out))
+        unlock_partial_download(self.file_out)
+
+    def test_stream_content_errors(self):
+        # Kept to be resumed, without the lock
+        self.server.cut = 1024 ** 2
+        self.assertRaises(IncompleteRead, self._stream_content)
+        self.assertEqual(os.path.getsize(self.file_out), 1024 ** 2)
+        self.assertTrue(os.path.exists(get_download_state_file(self.file_out)))
+        self.assertFalse(os.path.exists(get_download_lock_file(self.file_out)))
+        # The document is gone
+        self.server.gone = True
+        self.assertRaises(urllib2.HTTPError, self._stream_content)
+        self._assert_removed(self.file_out)
+        # The partial file does not match the expected digest
+        self.server.gone = False
+        self.assertRaises(IncompleteRead, self._stream_content)
+        self.server.cut = None
+        self.server.content = CONTENT[:1024 ** 2] + CONTENT[::-1][1024 ** 2:]
+        self.assertRaises(CorruptedFile, self._stream_content)
+        self._assert_removed(self.file_out)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_clean_partial_downloads(self):
+        self.server.cut = 1024 ** 2
+        self.assertRaises(IncompleteRead, self._download)
+        other = os.path.join(self.tmpdir, '.movie.mp4.nxpart')
+        with open(other, 'wb') as f:
+            f.write(CONTENT[:1024])
+        # The lock of a previous run is dropped, the recent partial downloads are kept
+        with open(get_download_lock_file(other), 'w') as f:
+            f.write('0')
+        self.assertEqual(clean_partial_downloads(self.tmpdir), 1)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['.movie.mp4.nxpart', '.video.mp4.nxpart',
+                                                           '.video.mp4.state.nxpart'])
+        # The expired ones are dropped with their state, unless in progress
+        expired = time.time() - 2 * 24 * 3600
+        for name in os.listdir(self.tmpdir):
+            os.utime(os.path.join(self.tmpdir, name), (expired, expired))
+        self.assertTrue(lock_partial_download(other))
+        self.assertEqual(clean_partial_downloads(self.tmpdir), 2)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['.movie.mp4.lock.nxpart', '.movie.mp4.nxpart'])
+        # Removed with its lock
+        remove_partial_download(other)
+        self.assertEqual(os.listdir(self.tmpdir), [])
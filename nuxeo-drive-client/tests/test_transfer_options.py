@@ -0,0 +1,154 @@
+# coding: utf-8
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from nxdrive.client.local_client import LocalClient
+from nxdrive.client.remote_file_system_client import RemoteFileSystemClient
+from nxdrive.commandline import CliHandler
+from nxdrive.engine.engine import Engine
+from nxdrive.engine.processor import Processor
+from tests.automation_server import AutomationServer, get_client
+from tests.test_chunked_upload import BatchHandler, init_batch_server
+
+
+class FakeSignal(object):
+
+    def connect(self, slot):
+        pass
+
+
+class FakeManager(object):
+
+    def __init__(self, options):
+        self.segmented_download = options.segmented_download
+        self.chunked_upload = options.chunked_upload
+        self.upload_connections = options.upload_connections
+
+
+class FakeDAO(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def get_valid_duplicate_file(self, digest):
+        return None
+
+    def update_last_transfer(self, row_id, transfer):
+        self.calls.append('update_last_transfer')
+
+    def update_remote_state(self, row, info, **kwargs):
+        self.calls.append('update_remote_state')
+
+    def synchronize_state(self, row, **kwargs):
+        self.calls.append('synchronize_state')
+
+
+class FakeEngine(object):
+    invalidClientsCache = FakeSignal()
+
+    def __init__(self, manager):
+        self._manager = manager
+        self._dao = FakeDAO()
+
+    def get_dao(self):
+        return self._dao
+
+    # The options as the engine reads them from the manager
+    use_segmented_download = Engine.use_segmented_download.im_func
+    use_chunked_upload = Engine.use_chunked_upload.im_func
+    get_upload_connections = Engine.get_upload_connections.im_func
+
+
+class FakeRemoteClient(object):
+
+    def __init__(self, digest=None):
+        self.calls = []
+        self.digest = digest
+
+    def stream_content(self, fs_item_id, file_path, **kwargs):
+        self.calls.append(('stream_content', kwargs))
+        return file_path + '.nxpart', self.digest
+
+
+class FakePair(object):
+    id = 1
+    remote_ref = 'ref#1'
+    remote_parent_ref = 'ref#0'
+    remote_digest = 'digest'
+
+
+class FakeModifiedPair(FakePair):
+    local_path = u'/video.mp4'
+    local_name = u'video.mp4'
+    remote_name = u'video.mp4'
+    remote_can_update = True
+    remote_digest = hashlib.md5('previous content').hexdigest()
+    folderish = False
+
+
+class TransferOptionsTest(unittest.TestCase):
+
+    def _get_processor(self, argv):
+        options = CliHandler().parse_cli(['ndrive'] + argv)
+        processor = Processor(FakeEngine(FakeManager(options)), None)
+        processor._update_speed_metrics = lambda: None
+        return processor
+
+    def test_segmented_download(self):
+        for argv, segmented in (([], False), (['--segmented-download'], True)):
+            remote_client = FakeRemoteClient()
+            processor = self._get_processor(argv)
+            processor._download_content(None, remote_client, FakePair(), '/tmp/video.mp4')
+            self.assertEqual(remote_client.calls[0][1]['segmented'], segmented)
+
+    def test_download_digest(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            local_client = LocalClient(unicode(tmpdir))
+            processor = self._get_processor([])
+            # Checked while downloaded, the file is not hashed again
+            digest = hashlib.md5('content').hexdigest()
+            result = processor._download_content(local_client, FakeRemoteClient(digest), FakePair(), '/tmp/video.mp4')
+            self.assertEqual(result, ('/tmp/video.mp4.nxpart', digest))
+            # Not of the local digest function
+            digest = hashlib.sha1('content').hexdigest()
+            result = processor._download_content(local_client, FakeRemoteClient(digest), FakePair(), '/tmp/video.mp4')
+            self.assertEqual(result, ('/tmp/video.mp4.nxpart', None))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('nxdrive.client.base_automation_client.UPLOAD_CHUNK_SIZE', 1024 ** 2)
+    def test_chunked_upload(self):
+        content = os.urandom(3 * 1024 ** 2 + 100)
+        digest = hashlib.md5(content).hexdigest()
+        tmpdir = tempfile.mkdtemp()
+        server = AutomationServer(BatchHandler)
+        init_batch_server(server)
+        server.fs_item = {'id': 'ref#1', 'parentId': 'ref#0', 'path': '/ref#0/ref#1', 'name': 'video.mp4',
+                          'folder': False, 'lastModificationDate': 0, 'digestAlgorithm': 'MD5',
+                          'downloadURL': 'nxfile/default/1/blobholder:0/video.mp4', 'canUpdate': True,
+                          'canDelete': True, 'canRename': True}
+        server.start()
+        try:
+            local_client = LocalClient(unicode(tmpdir))
+            with open(local_client.abspath(u'/video.mp4'), 'wb') as f:
+                f.write(content)
+            remote_client = get_client(server.url, tmpdir, factory=RemoteFileSystemClient)
+            for argv, posted in (([], [None]), (['--chunked-upload', '--upload-connections=2'], [0, 1, 2, 3])):
+                server.posted = []
+                processor = self._get_processor(argv)
+                doc_pair = FakeModifiedPair()
+                doc_pair.local_digest = digest
+                processor._synchronize_locally_modified(doc_pair, local_client, remote_client)
+                # A single request, or the chunks of the file
+                self.assertEqual(sorted(server.posted), posted)
+                self.assertEqual(processor._dao.calls, ['update_last_transfer', 'update_remote_state',
+                                                       'synchronize_state'])
+        finally:
+            server.stop()
+            shutil.rmtree(tmpdir)